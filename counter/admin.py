@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import ApartmentBuilding, Flat, Tariff,  WaterCounter
+from .models import ApartmentBuilding, BuildingMonthlySummary, CalculationCheckpoint, CalculationJob, Flat, MeterReading, MonthlyCharge, ReadingImport, Tariff,  WaterCounter
 
 
 class FlatInline(admin.TabularInline):
@@ -13,6 +13,23 @@ class WaterCounterInline(admin.TabularInline):
     extra = 1
 
 
+class MonthlyChargeInline(admin.TabularInline):
+    model = MonthlyCharge
+    extra = 0
+    ordering = ('-year_month',)
+    readonly_fields = ('year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price', 'billed_by_norm', 'stale_since')
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class MeterReadingInline(admin.TabularInline):
+    model = MeterReading
+    extra = 1
+    ordering = ('-reading_date',)
+
+
 @admin.register(ApartmentBuilding)
 class ApartmentBuildingAdmin(admin.ModelAdmin):
     inlines = [FlatInline]
@@ -25,9 +42,9 @@ class ApartmentBuildingAdmin(admin.ModelAdmin):
 
 @admin.register(Flat)
 class FlatAdmin(admin.ModelAdmin): 
-    inlines = [WaterCounterInline]   
+    inlines = [WaterCounterInline, MonthlyChargeInline]   
     list_display = ('id', 'number', 'area', 'apartment_building')
-    fields = ('number', 'area', 'apartment_building', 'number_of_registered', 'calculations')
+    fields = ('number', 'area', 'apartment_building', 'number_of_registered')
     list_filter = ('apartment_building',)
     search_fields = ('number', 'apartment_building__address')
     ordering = ('number',)
@@ -35,17 +52,52 @@ class FlatAdmin(admin.ModelAdmin):
 
 @admin.register(Tariff)
 class TafiffAdmin(admin.ModelAdmin):
-    list_display = ('id', 'tariff_type', 'price')
-    fields = ('tariff_type', 'price')
-    list_filter = ('tariff_type',)
+    list_display = ('id', 'tariff_type', 'price', 'valid_from', 'valid_to')
+    fields = ('tariff_type', 'price', 'valid_from', 'valid_to')
+    list_filter = ('tariff_type', 'valid_from')
     search_fields = ('tariff_type',)
 
 
 @admin.register(WaterCounter)
 class WaterCounerAdmin(admin.ModelAdmin):
-    list_display = ('id', 'serial_number', 'verification_date', 'type_water_counter', 'flat',)
-    fields = ('serial_number', 'verification_date', 'type_water_counter', 'meters', 'flat',)
+    inlines = [MeterReadingInline]
+    list_display = ('id', 'serial_number', 'verification_date', 'expiration_date', 'type_water_counter', 'flat',)
+    fields = ('serial_number', 'verification_date', 'expiration_date', 'type_water_counter', 'flat',)
+    readonly_fields = ('expiration_date',)
     list_filter = ('type_water_counter', 'flat', 'verification_date',)
     search_fields = ('serial_number', 'flat__number', 'verification_date',)
     date_hierarchy = 'verification_date'
     ordering = ('serial_number',)
+
+
+@admin.register(ReadingImport)
+class ReadingImportAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_path', 'file_format', 'status', 'offset', 'saved', 'failed', 'created_at')
+    readonly_fields = ('file_path', 'file_format', 'status', 'offset', 'saved', 'failed', 'errors', 'error_message', 'created_at', 'updated_at')
+    list_filter = ('status', 'file_format')
+    ordering = ('-created_at',)
+
+
+@admin.register(CalculationCheckpoint)
+class CalculationCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('job_id', 'apartment_building', 'year_month', 'status', 'last_flat_id', 'calculated', 'updated_at')
+    readonly_fields = ('job_id', 'apartment_building', 'year_month', 'status', 'last_flat_id', 'calculated', 'error_message', 'created_at', 'updated_at')
+    list_filter = ('status', 'year_month')
+    search_fields = ('job_id',)
+    ordering = ('-created_at',)
+
+
+@admin.register(CalculationJob)
+class CalculationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'apartment_building', 'year_month', 'status', 'total_flats', 'calculated', 'created_at', 'started_at', 'finished_at')
+    readonly_fields = ('id', 'apartment_building', 'year_month', 'status', 'total_flats', 'calculated', 'error_message', 'created_at', 'started_at', 'finished_at')
+    list_filter = ('status', 'year_month')
+    ordering = ('-created_at',)
+
+
+@admin.register(BuildingMonthlySummary)
+class BuildingMonthlySummaryAdmin(admin.ModelAdmin):
+    list_display = ('apartment_building', 'year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price', 'flats_billed', 'flats_billed_by_norm', 'updated_at')
+    readonly_fields = ('apartment_building', 'year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price', 'flats_billed', 'flats_billed_by_norm', 'updated_at')
+    list_filter = ('year_month',)
+    ordering = ('-year_month', 'apartment_building')
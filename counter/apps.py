@@ -5,3 +5,6 @@ class CounterConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'counter'
     verbose_name = 'Счетчик водоснабжения'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,241 @@
+import datetime
+import json
+import math
+import platform
+import statistics
+import time
+from decimal import Decimal
+
+import django
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import kernel
+from .calculator import calculator_payment
+from .models import ApartmentBuilding, Flat, WaterCounter
+from .progress import get_calculation_progress
+from .readings import ingest_readings
+from .serials import invalidate_serial_numbers
+from .synthetic import create_dataset
+from .tariffs import bump_tariffs_version
+from .views import ApartmentBuildingDetailView
+
+
+"""
+Замеры основных операций на синтетических данных. Данные создаются и удаляются откатом транзакции,
+каждый замер выполняется в отдельной откатываемой точке сохранения, поэтому бд после замеров не меняется
+и результаты повторяются при одинаковых параметрах. Первый запуск каждой операции считает SQL-запросы,
+следующие repeat запусков - время без учета запросов
+"""
+def run_benchmarks(buildings: int = 1, flats: int = 1000, months: int = 12, year: str = '2024', month: str = '07',
+                   seed: int = 0, repeat: int = 3, polls: int = 100) -> dict:
+    serial_numbers = []
+    try:
+        with transaction.atomic():
+            dataset = create_dataset(buildings, flats, months, year, month, seed)
+            serial_numbers = list(
+                WaterCounter.objects.filter(flat__apartment_building_id__in=dataset['apartment_building_ids'])
+                .values_list('serial_number', flat=True)
+            )
+            results = measure_pipeline(dataset['apartment_building_ids'][0], flats, year, month, repeat, polls)
+            transaction.set_rollback(True)
+    finally:
+        # тарифы и счетчики откаченных синтетических данных не должны остаться в кешах
+        bump_tariffs_version()
+        invalidate_serial_numbers(*serial_numbers)
+
+    return {
+        'benchmark': 'billing_pipeline',
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'numpy': kernel.kernel_available(),
+        },
+        'parameters': {
+            'buildings': buildings, 'flats': flats, 'months': months, 'year_month': f'{year}-{month}',
+            'seed': seed, 'repeat': repeat, 'polls': polls,
+        },
+        'dataset': {key: value for key, value in dataset.items() if key != 'apartment_building_ids'},
+        'results': results,
+    }
+
+
+def measure_pipeline(apartment_building_id: int, flats: int, year: str, month: str, repeat: int, polls: int) -> dict:
+    results = {
+        'calculator_payment': measure(
+            lambda: check_calculation(calculator_payment(apartment_building_id, year, month)), repeat, flats,
+        ),
+    }
+    if kernel.kernel_available():
+        with override_settings(CALCULATION_KERNEL='numpy'):
+            results['calculator_payment_numpy'] = measure(
+                lambda: check_calculation(calculator_payment(apartment_building_id, year, month)), repeat, flats,
+            )
+
+    results['detail_view'] = measure(lambda: detail_view(apartment_building_id, 100), repeat, 100)
+
+    readings = reading_items(apartment_building_id, year, month)
+    results['reading_ingestion'] = measure(lambda: ingest_readings(readings), repeat, len(readings))
+
+    # прогресс расчета заполняется в кеше расчетом, откатываемым вместе с начислениями
+    with transaction.atomic():
+        check_calculation(calculator_payment(apartment_building_id, year, month))
+        transaction.set_rollback(True)
+    results['progress_polling'] = measure(
+        lambda: [get_calculation_progress(apartment_building_id) for _ in range(polls)], repeat, polls,
+    )
+
+    return results
+
+
+def measure(function, repeat: int, items: int) -> dict:
+    with transaction.atomic():
+        with CaptureQueriesContext(connection) as queries:
+            function()
+        transaction.set_rollback(True)
+
+    timings = []
+    for _ in range(max(repeat, 1)):
+        with transaction.atomic():
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+            transaction.set_rollback(True)
+
+    median = statistics.median(timings)
+    return {
+        'queries': len(queries),
+        'items': items,
+        'seconds_min': round(min(timings), 6),
+        'seconds_median': round(median, 6),
+        'items_per_second': round(items / median, 1) if median else None,
+    }
+
+
+def check_calculation(result: dict):
+    if result['status'] != 'success':
+        raise RuntimeError(result['message'])
+
+
+def detail_view(apartment_building_id: int, page_size: int):
+    request = RequestFactory(SERVER_NAME='localhost').get('/', {'page_size': page_size, 'include_charges': 'true'})
+    response = ApartmentBuildingDetailView.as_view()(request, pk=apartment_building_id)
+    response.render()
+    return response
+
+
+def reading_items(apartment_building_id: int, year: str, month: str) -> list:
+    # по одному показанию каждого счетчика дома на 28 число месяца расчета, но не позже сегодняшнего дня
+    reading_date = min(datetime.date(int(year), int(month), 28), datetime.date.today()).isoformat()
+    serial_numbers = WaterCounter.objects.filter(flat__apartment_building_id=apartment_building_id).values_list('serial_number', flat=True)
+    return [
+        {'serial_number': serial_number, 'meter_reading_value': 100000 + index, 'meter_reading_date': reading_date}
+        for index, serial_number in enumerate(serial_numbers)
+    ]
+
+
+# режимы соединений с бд для замера запросов передачи показаний
+CONNECTION_MODES = {
+    'no_reuse': {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False},
+    'persistent': {'CONN_MAX_AGE': 600, 'CONN_HEALTH_CHECKS': False},
+    'persistent_health_checks': {'CONN_MAX_AGE': 600, 'CONN_HEALTH_CHECKS': True},
+}
+
+
+"""
+Замер времени запросов передачи показаний с новым соединением на каждый запрос и с переиспользованием соединений.
+Запросы выполняются через WSGIHandler, как на сервере: сигналы начала и окончания запроса закрывают соединение
+или оставляют его открытым в зависимости от CONN_MAX_AGE. Поэтому замер нельзя выполнять в транзакции:
+дом со счетчиками создается перед замерами и удаляется после них
+"""
+def run_connection_benchmark(requests: int = 500, counters: int = 20) -> dict:
+    if connection.in_atomic_block:
+        raise RuntimeError('Замер соединений нельзя выполнять внутри транзакции.')
+
+    apartment_building = ApartmentBuilding.objects.create(address='Замер соединений с бд', total_area=Decimal('1000.00'))
+    serial_numbers = []
+    try:
+        flat = Flat.objects.create(apartment_building=apartment_building, number=1, area=Decimal('50.00'), number_of_registered=1)
+        water_counters = WaterCounter.objects.bulk_create([
+            WaterCounter(
+                flat=flat, serial_number=f'B{apartment_building.id % 10 ** 4:04d}{index:05d}',
+                verification_date=datetime.date.today(), type_water_counter='cold',
+            )
+            for index in range(counters)
+        ])
+        serial_numbers = [water_counter.serial_number for water_counter in water_counters]
+
+        handler = WSGIHandler()
+        results = {}
+        for mode, options in CONNECTION_MODES.items():
+            results[mode] = measure_requests(handler, serial_numbers, requests, options)
+    finally:
+        apartment_building.delete()
+        invalidate_serial_numbers(*serial_numbers)
+
+    return {
+        'benchmark': 'database_connections',
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'host': connection.settings_dict['HOST'],
+        },
+        'parameters': {'requests': requests, 'counters': counters},
+        'results': results,
+    }
+
+
+def measure_requests(handler, serial_numbers: list, requests: int, options: dict) -> dict:
+    opened = []
+
+    def count_connection(sender, connection, **kwargs):
+        opened.append(connection.alias)
+
+    saved = {key: connection.settings_dict[key] for key in options}
+    connection.settings_dict.update(options)
+    connection.close()
+    connection_created.connect(count_connection)
+    factory = RequestFactory(SERVER_NAME='localhost')
+    url = reverse('counter:add_meter_reading')
+    timings = []
+    try:
+        for index in range(requests):
+            data = {'serial_number': serial_numbers[index % len(serial_numbers)], 'meter_reading_value': index}
+            environ = factory.post(url, json.dumps(data), content_type='application/json').environ
+
+            started = time.perf_counter()
+            response = handler(environ, lambda status, headers: None)
+            # окончание запроса, как у WSGI-сервера: request_finished закрывает или сохраняет соединение
+            response.close()
+            timings.append(time.perf_counter() - started)
+            if response.status_code != 201:
+                raise RuntimeError(f'Передача показаний завершилась с кодом {response.status_code}.')
+    finally:
+        connection_created.disconnect(count_connection)
+        connection.close()
+        connection.settings_dict.update(saved)
+
+    timings.sort()
+    return {
+        'requests': requests,
+        'connections_opened': len(opened),
+        'latency_ms': {
+            'mean': round(statistics.mean(timings) * 1000, 3),
+            'p50': percentile(timings, 50),
+            'p99': percentile(timings, 99),
+        },
+    }
+
+
+def percentile(timings: list, value: int):
+    # ближайший ранг по отсортированным значениям, в миллисекундах
+    index = max(math.ceil(len(timings) * value / 100) - 1, 0)
+    return round(timings[index] * 1000, 3)
@@ -1,15 +1,22 @@
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
-import time
+import uuid
 
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.cache import cache
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch
 
-from .models import Flat, Tariff
+from . import kernel
+from .metrics import instrument_calculation, phase
+from .models import CalculationCheckpoint, Flat, MeterReading, MonthlyCharge, first_day_of_next_month
+from .progress import finish_progress, initialize_progress, update_progress
+from .summary import apply_summary_deltas, lock_summaries, summary_deltas
+from .tariffs import tariff_provider
 
-# нормативы потребления на квадратный метр
-NORM_COLD_WATER = Decimal(6.935)
-NORM_HOT_WATER = Decimal(4.745)
+# нормативы потребления на квадратный метр, задаются строкой: Decimal(6.935) хранит двоичное приближение float
+NORM_COLD_WATER = Decimal('6.935')
+NORM_HOT_WATER = Decimal('4.745')
 
 
 """
@@ -18,48 +25,341 @@ NORM_HOT_WATER = Decimal(4.745)
 - если просрочена поверка счетчика - по нормативу
 - если нет показаний за текущий месяц - по нормативу
 - если нет показаний за предыдущий, то считаем как новый счетчик
+- показания, переданные после месяца расчета, не учитываются
 - только при наличии показаний на месяц расчета и предыдущий, считаем разницу
 В бд по дому 1 есть записи для каждого из этих случаев.
 """
-def calculator_payment(apartment_building_id: int, year: str, month: str):
+@instrument_calculation('calculator_payment')
+def calculator_payment(apartment_building_id: int, year: str, month: str, tariffs: dict = None, job_id: str = None):
+    """
+    Начисления записываются пакетами по CALCULATION_BATCH_SIZE квартир, каждый пакет - в своей транзакции
+    вместе с контрольной точкой задания. Повторный запуск с тем же job_id продолжает расчет с квартиры,
+    следующей за последней зафиксированной. Ошибка записывается в контрольную точку и пробрасывается дальше
+    """
+    checkpoint = start_checkpoint(job_id, apartment_building_id, f"{year}-{month.zfill(2)}")
+    job_id = checkpoint.job_id
+    with record_result(checkpoint):
+        with phase('load'):
+            total_flats = Flat.objects.filter(apartment_building_id=apartment_building_id).count()
+        flats = pending_flats(apartment_building_id, year, month).filter(id__gt=checkpoint.last_flat_id)
+
+        charges = calculate_with_kernel(flats, year, month, tariffs)
+        if charges is not None:
+            with phase('progress'):
+                initialize_progress(job_id, apartment_building_id, total_flats, completed=total_flats - len(charges))
+            calculated = save_kernel_charges(job_id, apartment_building_id, charges, year, month, checkpoint)
+        else:
+            # квартиры без начислений за месяц, их счетчики и два последних показания каждого счетчика
+            # загружаются тремя запросами, без обращения к бд на каждую квартиру
+            with phase('load'):
+                flats = list(with_water_counters(flats, year, month))
+            with phase('progress'):
+                initialize_progress(job_id, apartment_building_id, total_flats, completed=total_flats - len(flats))
+            calculated = calculate_flats(job_id, apartment_building_id, flats, year, month, tariffs, checkpoint=checkpoint)
+
+        with phase('progress'):
+            finish_progress(job_id, apartment_building_id)
+
+    return {"status": "success", "calculated": calculated}
+
+
+def start_checkpoint(job_id: str, apartment_building_id: int, year_month_key: str):
+    if job_id is None:
+        return CalculationCheckpoint.objects.create(
+            job_id=uuid.uuid4().hex, apartment_building_id=apartment_building_id, year_month=year_month_key,
+        )
+    checkpoint, created = CalculationCheckpoint.objects.get_or_create(
+        job_id=job_id, apartment_building_id=apartment_building_id, defaults={'year_month': year_month_key},
+    )
+    if not created:
+        checkpoint.status = 'running'
+        checkpoint.error_message = ''
+        checkpoint.save(update_fields=['status', 'error_message', 'updated_at'])
+    return checkpoint
+
+
+@contextmanager
+def record_result(checkpoint: CalculationCheckpoint):
+    """
+    Статус расчета в контрольной точке: ошибка записывается и пробрасывается дальше,
+    чтобы задача Celery повторила расчет или завершилась с ошибкой
+    """
     try:
-        flats = Flat.objects.filter(apartment_building_id=apartment_building_id)
-        initialize_progress(apartment_building_id, flats.count())
-
-        tariffs = get_tariffs()
-        current_date = datetime.now().date()
-        year_month_key = f"{year}-{month.zfill(2)}"
-
-        for flat in flats:
-            if flat.calculations and year_month_key in flat.calculations:
-                continue
-
-            maintenance_cost = calculate_maintenance_cost(flat, tariffs['maintenance_of_common_property'])
-            cold_water_usage, hot_water_usage = calculate_water_usage(flat, current_date, year, month)
-
-            cold_water_price = cold_water_usage * tariffs['cold_water_for_flat']
-            hot_water_price = hot_water_usage * tariffs['hot_water_for_flat']
-
-            save_calculation(flat, year_month_key, maintenance_cost, cold_water_price, hot_water_price)
-            update_progress(apartment_building_id)
-
-    except ObjectDoesNotExist as e:
-        return {"status": "error", "message": str(e)}
+        yield
     except Exception as e:
-        return {"status": "error", "message": str(e)}
-
-
-def initialize_progress(apartment_building_id: int, total_flats: int):
-    progress = {'total': total_flats, 'completed': 0}
-    save_calculation_progress(apartment_building_id, progress)
-
-
-def get_tariffs():
-    return {
-        'maintenance_of_common_property': Tariff.objects.get(tariff_type='maintenance_of_common_property').price,
-        'cold_water_for_flat': Tariff.objects.get(tariff_type='cold_water_for_flat').price,
-        'hot_water_for_flat': Tariff.objects.get(tariff_type='hot_water_for_flat').price,
-    }
+        checkpoint.status = 'failed'
+        checkpoint.error_message = str(e)
+        checkpoint.save(update_fields=['status', 'error_message', 'updated_at'])
+        raise
+    checkpoint.status = 'done'
+    checkpoint.save(update_fields=['status', 'updated_at'])
+
+
+def advance_checkpoint(checkpoint: CalculationCheckpoint, last_flat_id: int, calculated: int):
+    checkpoint.last_flat_id = last_flat_id
+    checkpoint.calculated += calculated
+    checkpoint.save(update_fields=['last_flat_id', 'calculated', 'updated_at'])
+
+
+def split_calculation(apartment_building_id: int, year: str, month: str, chunk_size: int, job_id: str):
+    """
+    Подготовка параллельного расчета дома: инициализирует прогресс по всему дому
+    и возвращает идентификаторы квартир без начислений, разбитые на части по chunk_size
+    """
+    total_flats = Flat.objects.filter(apartment_building_id=apartment_building_id).count()
+    flat_ids = list(pending_flats(apartment_building_id, year, month).values_list('id', flat=True))
+    initialize_progress(job_id, apartment_building_id, total_flats, completed=total_flats - len(flat_ids))
+
+    return list(chunked(flat_ids, chunk_size))
+
+
+@instrument_calculation('calculator_payment_chunk')
+def calculator_payment_chunk(apartment_building_id: int, year: str, month: str, flat_ids: list, job_id: str):
+    """
+    Расчет части квартир дома. Квартиры, для которых начисления уже появились, пропускаются,
+    поэтому повторный запуск той же части безопасен. Контрольной точки у части нет: части задания
+    рассчитываются параллельно, ошибка пробрасывается в задачу и записывается в задание расчета
+    """
+    charges = calculate_with_kernel(pending_flats(apartment_building_id, year, month).filter(id__in=flat_ids), year, month)
+    if charges is not None:
+        with phase('progress'):
+            update_progress(job_id, apartment_building_id, len(flat_ids) - len(charges))
+        return {"status": "success", "calculated": save_kernel_charges(job_id, apartment_building_id, charges, year, month)}
+
+    with phase('load'):
+        flats = list(with_water_counters(pending_flats(apartment_building_id, year, month).filter(id__in=flat_ids), year, month))
+    # пропущенные квартиры тоже учитываются в прогрессе, иначе он не дойдет до конца
+    with phase('progress'):
+        update_progress(job_id, apartment_building_id, len(flat_ids) - len(flats))
+
+    calculated = calculate_flats(job_id, apartment_building_id, flats, year, month)
+    return {"status": "success", "calculated": calculated}
+
+
+def pending_flats(apartment_building_id: int, year: str, month: str):
+    year_month_key = f"{year}-{month.zfill(2)}"
+    return (
+        Flat.objects.filter(apartment_building_id=apartment_building_id)
+        .exclude(Exists(MonthlyCharge.objects.filter(flat=OuterRef('pk'), year_month=year_month_key)))
+        .order_by('id')
+    )
+
+
+def with_water_counters(flats, year: str, month: str):
+    return flats.prefetch_related(
+        'water_counters',
+        Prefetch(
+            'water_counters__readings',
+            queryset=MeterReading.objects.last_up_to_month(year, month),
+            to_attr='last_readings',
+        ),
+    )
+
+
+def calculate_flats(job_id: str, apartment_building_id: int, flats: list, year: str, month: str, tariffs: dict = None,
+                    overwrite: bool = False, checkpoint: CalculationCheckpoint = None):
+    if tariffs is None:
+        with phase('load'):
+            tariffs = get_tariffs(year, month)
+    current_date = datetime.now().date()
+    year_month_key = f"{year}-{month.zfill(2)}"
+
+    for batch in chunked(flats, settings.CALCULATION_BATCH_SIZE):
+        with phase('compute'):
+            charges = []
+            for flat in batch:
+                maintenance_cost, cold_water_price, hot_water_price = calculate_flat_payment(flat, tariffs, current_date, year, month)
+                charges.append(build_monthly_charge(
+                    flat, year_month_key, maintenance_cost, cold_water_price, hot_water_price,
+                    flat_billed_by_norm(flat, current_date, year, month),
+                ))
+
+        with phase('save'):
+            save_charges_batch(apartment_building_id, charges, overwrite, checkpoint, batch[-1].id)
+        with phase('progress'):
+            update_progress(job_id, apartment_building_id, len(batch))
+
+    return len(flats)
+
+
+def calculate_with_kernel(flats, year: str, month: str, tariffs: dict = None):
+    """
+    Расчет квартир векторным ядром на NumPy (kernel.py) при CALCULATION_KERNEL = 'numpy'.
+    Возвращает None, если ядро выключено, NumPy не установлен или данные не помещаются в целые числа,
+    в этом случае квартиры рассчитываются в Decimal
+    """
+    if settings.CALCULATION_KERNEL != 'numpy' or not kernel.kernel_available():
+        return None
+    if tariffs is None:
+        with phase('load'):
+            tariffs = get_tariffs(year, month)
+    try:
+        return kernel.calculate_charges(flats, tariffs, datetime.now().date(), year, month)
+    except kernel.KernelUnsupported:
+        return None
+
+
+def save_kernel_charges(job_id: str, apartment_building_id: int, charges: list, year: str, month: str,
+                        checkpoint: CalculationCheckpoint = None):
+    year_month_key = f"{year}-{month.zfill(2)}"
+    for batch in chunked(charges, settings.CALCULATION_BATCH_SIZE):
+        with phase('save'):
+            save_charges_batch(apartment_building_id, [
+                MonthlyCharge(
+                    flat_id=flat_id,
+                    year_month=year_month_key,
+                    maintenance_of_common_property=maintenance_cost,
+                    cold_water_usage_price=cold_water_price,
+                    hot_water_usage_price=hot_water_price,
+                    billed_by_norm=billed_by_norm,
+                )
+                for flat_id, maintenance_cost, cold_water_price, hot_water_price, billed_by_norm in batch
+            ], checkpoint=checkpoint, last_flat_id=batch[-1][0])
+        with phase('progress'):
+            update_progress(job_id, apartment_building_id, len(batch))
+    return len(charges)
+
+
+def save_charges_batch(apartment_building_id: int, charges: list, overwrite: bool = False,
+                       checkpoint: CalculationCheckpoint = None, last_flat_id: int = None):
+    # пакет начислений, итоги дома и контрольная точка фиксируются вместе,
+    # после сбоя расчет продолжается со следующего пакета, а итоги совпадают с записанными начислениями.
+    # Прежние начисления читаются после блокировки итогов: другой расчет того же дома за месяц ждет фиксации пакета
+    with transaction.atomic():
+        lock_summaries(apartment_building_id, {charge.year_month for charge in charges})
+        deltas = summary_deltas(charges, overwrite)
+        save_monthly_charges(charges, overwrite)
+        apply_summary_deltas(apartment_building_id, deltas)
+        if checkpoint is not None:
+            advance_checkpoint(checkpoint, last_flat_id, len(charges))
+
+
+def save_monthly_charges(charges: list, overwrite: bool = False):
+    if overwrite:
+        MonthlyCharge.objects.bulk_create(
+            charges,
+            update_conflicts=True,
+            unique_fields=['flat', 'year_month'],
+            update_fields=['maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price', 'billed_by_norm'],
+        )
+    else:
+        # начисления, записанные параллельно работающим расчетом, не перезаписываются
+        MonthlyCharge.objects.bulk_create(charges, ignore_conflicts=True)
+
+
+@instrument_calculation('recalculator_payment')
+def recalculator_payment(apartment_building_id: int, year_months: list, job_id: str = None):
+    """
+    Перерасчет дома за несколько месяцев за один проход: квартиры, счетчики и показания
+    загружаются один раз, тарифы определяются один раз на каждый месяц, существующие начисления перезаписываются.
+    Контрольная точка (по первому месяцу) хранит только статус и ошибку: перерасчет перезаписывает начисления
+    и при повторе выполняется целиком
+    """
+    year_months = sorted(set(year_months))
+    checkpoint = start_checkpoint(job_id, apartment_building_id, year_months[0])
+    job_id = checkpoint.job_id
+    with record_result(checkpoint):
+        last_year, last_month = year_months[-1].split('-')
+
+        with phase('load'):
+            flats = list(
+                Flat.objects.filter(apartment_building_id=apartment_building_id)
+                .prefetch_related(
+                    'water_counters',
+                    Prefetch(
+                        'water_counters__readings',
+                        queryset=MeterReading.objects.up_to_month(last_year, last_month).order_by('-reading_date'),
+                        to_attr='readings_up_to_last_month',
+                    ),
+                )
+                .order_by('id')
+            )
+        with phase('progress'):
+            initialize_progress(job_id, apartment_building_id, len(flats) * len(year_months))
+
+        for year_month in year_months:
+            year, month = year_month.split('-')
+            reading_date_bound = first_day_of_next_month(year, month)
+            for flat in flats:
+                for counter in flat.water_counters.all():
+                    counter.last_readings = [
+                        reading for reading in counter.readings_up_to_last_month if reading.reading_date < reading_date_bound
+                    ][:2]
+
+            calculate_flats(job_id, apartment_building_id, flats, year, month, overwrite=True)
+
+        with phase('progress'):
+            finish_progress(job_id, apartment_building_id)
+
+    return {"status": "success", "calculated": len(flats) * len(year_months)}
+
+
+@instrument_calculation('recalculate_stale_charges')
+def recalculate_stale_charges(apartment_building_id: int, job_id: str = None):
+    """
+    Перерасчет только устаревших начислений дома (см. stale.py): квартиры пересчитываются пакетно по месяцам,
+    остальные начисления дома не затрагиваются. Отметка снимается только с начислений, значение stale_since
+    которых не изменилось с момента чтения: отметку, сделанную транзакцией, зафиксированной после чтения,
+    не сравнить с началом перерасчета по времени, поэтому сравнивается само значение.
+    Контрольная точка (по первому устаревшему месяцу) хранит только статус и ошибку, как в recalculator_payment
+    """
+    stale_flats = {}
+    # квартиры, отмеченные одним изменением, имеют одинаковое stale_since и снимаются одним запросом
+    marks = {}
+    stale_charges = MonthlyCharge.objects.filter(
+        flat__apartment_building_id=apartment_building_id, stale_since__isnull=False
+    ).values_list('year_month', 'flat_id', 'stale_since')
+    with phase('load'):
+        for year_month, flat_id, stale_since in stale_charges:
+            stale_flats.setdefault(year_month, []).append(flat_id)
+            marks.setdefault((year_month, stale_since), []).append(flat_id)
+
+    checkpoint = start_checkpoint(job_id, apartment_building_id, min(stale_flats, default=datetime.now().strftime('%Y-%m')))
+    job_id = checkpoint.job_id
+    with record_result(checkpoint):
+        total = sum(len(flat_ids) for flat_ids in stale_flats.values())
+        with phase('progress'):
+            initialize_progress(job_id, apartment_building_id, total)
+
+        for year_month in sorted(stale_flats):
+            year, month = year_month.split('-')
+            flat_ids = stale_flats[year_month]
+            with phase('load'):
+                flats = list(with_water_counters(Flat.objects.filter(id__in=flat_ids).order_by('id'), year, month))
+
+            calculate_flats(job_id, apartment_building_id, flats, year, month, overwrite=True)
+            with phase('save'):
+                for (marked_year_month, stale_since), marked_flat_ids in marks.items():
+                    if marked_year_month == year_month:
+                        MonthlyCharge.objects.filter(
+                            flat_id__in=marked_flat_ids, year_month=year_month, stale_since=stale_since
+                        ).update(stale_since=None)
+
+        with phase('progress'):
+            finish_progress(job_id, apartment_building_id)
+
+    return {"status": "success", "calculated": total}
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def get_tariffs(year: str = None, month: str = None):
+    if year and month:
+        return tariff_provider.get_tariffs_for_month(year, month)
+    return tariff_provider.get_tariffs()
+
+
+def calculate_flat_payment(flat, tariffs, current_date, year, month):
+    maintenance_cost = calculate_maintenance_cost(flat, tariffs['maintenance_of_common_property'])
+    cold_water_usage, hot_water_usage = calculate_water_usage(flat, current_date, year, month)
+
+    cold_water_price = cold_water_usage * tariffs['cold_water_for_flat']
+    hot_water_price = hot_water_usage * tariffs['hot_water_for_flat']
+
+    return maintenance_cost, cold_water_price, hot_water_price
 
 
 def calculate_maintenance_cost(flat, maintenance_cost_per_square_meter):
@@ -79,9 +379,8 @@ def calculate_water_usage(flat, current_date, year, month):
         if counter.type_water_counter == 'hot':
             hot_water_counter_exists = True
 
-        expiration_date = counter_expiration_date(counter)
-
-        if current_date > expiration_date:
+        # срок поверки хранится в счетчике (WaterCounter.expiration_date)
+        if current_date > counter.expiration_date:
             if counter.type_water_counter == 'cold':
                 cold_water_usage += NORM_COLD_WATER * flat.number_of_registered
             else:
@@ -105,8 +404,9 @@ def calculate_water_usage(flat, current_date, year, month):
 
 
 def calculate_usage(flat, counter, year, month):
-    if counter.meters:
-        if len(counter.meters) == 1:
+    readings = get_last_readings(counter, year, month)
+    if readings:
+        if len(readings) == 1:
             return single_meter_usage(flat, counter, year, month)
         else:
             return multiple_meter_usage(flat, counter, year, month)
@@ -114,65 +414,60 @@ def calculate_usage(flat, counter, year, month):
         return NORM_COLD_WATER * flat.number_of_registered if counter.type_water_counter == 'cold' else NORM_HOT_WATER * flat.number_of_registered
 
 
+def get_last_readings(counter, year, month):
+    """
+    Два последних показания счетчика на месяц расчета, начиная с последнего.
+    При пакетном расчете показания уже загружены в counter.last_readings
+    """
+    if hasattr(counter, 'last_readings'):
+        return counter.last_readings
+    return list(counter.readings.up_to_month(year, month).order_by('-reading_date')[:2])
+
+
 def single_meter_usage(flat, counter, year, month):
-    only_reading = counter.meters[0]
-    only_reading_date = datetime.strptime(only_reading['meter_reading_date'], "%Y-%m-%d").date()
-    if only_reading_date.year == int(year) and only_reading_date.month == int(month):
-        return max(Decimal(only_reading['meter_reading_value']) - Decimal(0), Decimal(0))
+    only_reading = get_last_readings(counter, year, month)[0]
+    if only_reading.reading_date.year == int(year) and only_reading.reading_date.month == int(month):
+        return max(Decimal(only_reading.value) - Decimal(0), Decimal(0))
     else:
         return NORM_COLD_WATER * flat.number_of_registered if counter.type_water_counter == 'cold' else NORM_HOT_WATER * flat.number_of_registered
 
 
 def multiple_meter_usage(flat, counter, year, month):
-    last = counter.meters[-1]
-    last_reading_date = datetime.strptime(last['meter_reading_date'], "%Y-%m-%d").date()
-    if last_reading_date.year == int(year) and last_reading_date.month == int(month):
-        current_reading = Decimal(last['meter_reading_value'])
-        previous = counter.meters[-2]
-        last_reading = Decimal(previous['meter_reading_value'])
+    last, previous = get_last_readings(counter, year, month)[:2]
+    if last.reading_date.year == int(year) and last.reading_date.month == int(month):
+        current_reading = Decimal(last.value)
+        last_reading = Decimal(previous.value)
         return max(current_reading - last_reading, Decimal(0))
     else:
         return NORM_COLD_WATER * flat.number_of_registered if counter.type_water_counter == 'cold' else NORM_HOT_WATER * flat.number_of_registered
 
 
-def save_calculation(flat, year_month_key, maintenance_cost, cold_water_price, hot_water_price):
-    calculation_data = {
-        year_month_key: {
-            'maintenance_of_common_property': float(maintenance_cost),
-            'cold_water_usage_price': float(cold_water_price.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)),
-            'hot_water_usage_price': float(hot_water_price.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
-        }
-    }
-    if not flat.calculations:
-        flat.calculations = calculation_data
-    else:
-        flat.calculations[year_month_key] = calculation_data[year_month_key]
-    flat.save()
-
-
-def update_progress(apartment_building_id: int):
-    progress = get_calculation_progress(apartment_building_id)
-    progress['completed'] += 1
-    save_calculation_progress(apartment_building_id, progress)
-
-
-def counter_expiration_date(counter):
-    if counter.type_water_counter == 'cold':
-        return counter.verification_date + timedelta(days=6*365)
-    else:
-        return counter.verification_date + timedelta(days=4*365)
-
-
-def save_calculation_progress(apartment_building_id, progress):
-    cache_key = f"calculation_progress_{apartment_building_id}"
-    cache.set(cache_key, progress, timeout=60)
-
-
-def get_calculation_progress(apartment_building_id):
-    cache_key = f"calculation_progress_{apartment_building_id}"
-    progress = cache.get(cache_key)
-    if progress:
-        return progress
-    else:
-        return {"status": "error", "message": "No progress found."}
-    
\ No newline at end of file
+def flat_billed_by_norm(flat, current_date, year, month) -> bool:
+    """
+    Хотя бы один вид воды рассчитан по нормативу: нет счетчика этого вида, истек срок поверки
+    или нет показаний за месяц расчета (правила calculate_water_usage)
+    """
+    counter_types = set()
+    for counter in flat.water_counters.all():
+        counter_types.add(counter.type_water_counter)
+        if current_date > counter.expiration_date:
+            return True
+        readings = get_last_readings(counter, year, month)
+        if not readings or (readings[0].reading_date.year, readings[0].reading_date.month) != (int(year), int(month)):
+            return True
+    return counter_types != {'cold', 'hot'}
+
+
+def build_monthly_charge(flat, year_month_key, maintenance_cost, cold_water_price, hot_water_price, billed_by_norm=False):
+    return MonthlyCharge(
+        flat=flat,
+        year_month=year_month_key,
+        maintenance_of_common_property=to_price(maintenance_cost),
+        cold_water_usage_price=to_price(cold_water_price),
+        hot_water_usage_price=to_price(hot_water_price),
+        billed_by_norm=billed_by_norm,
+    )
+
+
+def to_price(value):
+    return value.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
@@ -0,0 +1,122 @@
+import csv
+from itertools import islice
+import json
+
+from asgiref.sync import sync_to_async
+
+from .models import MonthlyCharge
+
+
+# количество начислений, читаемых из бд за одно обращение к курсору
+EXPORT_CHUNK_SIZE = 2000
+# количество строк, отправляемых клиенту одним блоком
+EXPORT_BUFFER_ROWS = 500
+
+EXPORT_FIELDS = (
+    'apartment_building_id',
+    'flat_id',
+    'flat_number',
+    'year_month',
+    'maintenance_of_common_property',
+    'cold_water_usage_price',
+    'hot_water_usage_price',
+)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def export_charges(apartment_building_ids=None, start: str = None, end: str = None, file_format: str = 'csv',
+                   chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Потоковая выгрузка начислений по квартирам за период (start и end - месяцы в формате YYYY-MM).
+    Начисления читаются из бд курсором порциями по chunk_size и сразу отдаются блоками строк,
+    поэтому объем выгрузки не влияет на расход памяти
+    """
+    header, format_row = export_format(file_format)
+    if header:
+        # заголовок отдается до первого обращения к бд
+        yield header
+    rows = charge_rows(apartment_building_ids, start, end).iterator(chunk_size=chunk_size)
+    yield from buffered((format_row(row) for row in rows), EXPORT_BUFFER_ROWS)
+
+
+async def aexport_charges(apartment_building_ids=None, start: str = None, end: str = None, file_format: str = 'csv',
+                          chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    То же, что export_charges, для асинхронных представлений: StreamingHttpResponse под ASGI читает синхронный
+    итератор целиком до отправки ответа, асинхронный отдает блоки по мере чтения порций из бд
+    """
+    header, format_row = export_format(file_format)
+    if header:
+        yield header
+    # QuerySet.aiterator для values_list выполняет запрос в цикле событий, поэтому порции курсора
+    # читаются в потоке запроса
+    rows = charge_rows(apartment_building_ids, start, end).iterator(chunk_size=chunk_size)
+    read_chunk = sync_to_async(lambda: list(islice(rows, chunk_size)))
+    buffer = []
+    while chunk := await read_chunk():
+        for row in chunk:
+            buffer.append(format_row(row))
+            if len(buffer) >= EXPORT_BUFFER_ROWS:
+                yield ''.join(buffer)
+                buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def export_format(file_format: str):
+    """
+    Заголовок выгрузки (или None) и функция форматирования строки начисления
+    """
+    if file_format == 'csv':
+        writer = csv.writer(Echo())
+        return writer.writerow(EXPORT_FIELDS), writer.writerow
+    return None, ndjson_line
+
+
+def charge_rows(apartment_building_ids=None, start: str = None, end: str = None):
+    charges = MonthlyCharge.objects.all()
+    if apartment_building_ids:
+        charges = charges.filter(flat__apartment_building_id__in=apartment_building_ids)
+    # месяцы в формате YYYY-MM сравниваются как строки
+    if start:
+        charges = charges.filter(year_month__gte=start)
+    if end:
+        charges = charges.filter(year_month__lte=end)
+
+    # порядок уникального индекса (квартира, месяц), на PostgreSQL iterator читает серверным курсором
+    return charges.order_by('flat_id', 'year_month').values_list(
+        'flat__apartment_building_id',
+        'flat_id',
+        'flat__number',
+        'year_month',
+        'maintenance_of_common_property',
+        'cold_water_usage_price',
+        'hot_water_usage_price',
+    )
+
+
+class Echo:
+    """
+    Объект с методом write для csv.writer, возвращающий строку вместо записи
+    """
+    def write(self, value):
+        return value
+
+
+def ndjson_line(row) -> str:
+    return json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str) + '\n'
+
+
+def buffered(lines, size: int):
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,155 @@
+import csv
+import datetime
+import itertools
+
+from django.db import transaction
+
+from .models import ReadingImport
+from .readings import READINGS_BATCH_SIZE, build_counter_index, save_readings_batch
+
+
+# в загрузке сохраняется не больше MAX_STORED_ERRORS ошибок, остальные только подсчитываются
+MAX_STORED_ERRORS = 1000
+
+FIELDS = ('serial_number', 'meter_reading_value', 'meter_reading_date')
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+def run_import(reading_import: ReadingImport, batch_size: int = READINGS_BATCH_SIZE):
+    """
+    Потоковая загрузка показаний из файла. Строки читаются по одной, каждый пакет показаний
+    записывается в одной транзакции вместе с номером последней обработанной строки,
+    поэтому после сбоя загрузка продолжается с последнего зафиксированного пакета
+    """
+    reading_import.status = 'running'
+    reading_import.error_message = ''
+    reading_import.save(update_fields=['status', 'error_message', 'updated_at'])
+
+    try:
+        counters = build_counter_index()
+        rows = read_rows(reading_import.file_path, reading_import.file_format, reading_import.offset)
+
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            save_import_batch(reading_import, batch, counters)
+
+    except Exception as e:
+        reading_import.status = 'failed'
+        reading_import.error_message = str(e)
+        reading_import.save(update_fields=['status', 'error_message', 'updated_at'])
+        raise
+
+    reading_import.status = 'done'
+    reading_import.save(update_fields=['status', 'updated_at'])
+    return reading_import
+
+
+def save_import_batch(reading_import: ReadingImport, batch: list, counters: dict):
+    with transaction.atomic():
+        results = save_readings_batch(batch, counters)
+
+        errors = [
+            {'row': index + 2, 'errors': result['errors']}
+            for (index, _), result in zip(batch, results) if result['status'] == 'error'
+        ]
+        reading_import.offset = batch[-1][0] + 1
+        reading_import.saved += len(results) - len(errors)
+        reading_import.failed += len(errors)
+        reading_import.errors = (reading_import.errors + errors)[:MAX_STORED_ERRORS]
+        reading_import.save(update_fields=['offset', 'saved', 'failed', 'errors', 'updated_at'])
+
+
+def detect_format(file_name: str) -> str:
+    extension = file_name.rsplit('.', 1)[-1].lower() if '.' in file_name else ''
+    if extension not in dict(ReadingImport.FORMAT):
+        raise ImportFormatError('Поддерживаются файлы CSV и XLSX.')
+    return extension
+
+
+def read_rows(file_path: str, file_format: str, offset: int = 0):
+    """
+    Строки файла с номерами, начиная с offset (без учета строки заголовка)
+    """
+    if file_format == 'csv':
+        return read_csv_rows(file_path, offset)
+    if file_format == 'xlsx':
+        return read_xlsx_rows(file_path, offset)
+    raise ImportFormatError(f'Неподдерживаемый формат файла: {file_format}')
+
+
+def read_csv_rows(file_path: str, offset: int):
+    with open(file_path, newline='', encoding='utf-8-sig') as file:
+        reader = csv.reader(file, delimiter=detect_delimiter(file))
+        columns = read_header(next(reader, None))
+        for index, row in enumerate(itertools.islice(reader, offset, None), start=offset):
+            if not any(value.strip() for value in row):
+                continue
+            yield index, row_to_item(columns, row)
+
+
+def detect_delimiter(file):
+    sample = file.readline()
+    file.seek(0)
+    return ';' if sample.count(';') > sample.count(',') else ','
+
+
+def read_xlsx_rows(file_path: str, offset: int):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFormatError('Для загрузки файлов XLSX необходим пакет openpyxl.')
+
+    # в режиме read_only строки читаются с диска по мере обхода, файл не загружается целиком
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+        header = next(sheet.iter_rows(max_row=1, values_only=True), None)
+        columns = read_header(header)
+        for index, row in enumerate(sheet.iter_rows(min_row=offset + 2, values_only=True), start=offset):
+            if all(value is None for value in row):
+                continue
+            yield index, row_to_item(columns, row)
+    finally:
+        workbook.close()
+
+
+def read_header(header):
+    if header is None:
+        raise ImportFormatError('Файл пуст.')
+    names = [str(name).strip().lower() if name is not None else '' for name in header]
+    missing = [field for field in FIELDS[:2] if field not in names]
+    if missing:
+        raise ImportFormatError(f'В заголовке файла нет колонок: {", ".join(missing)}.')
+    return {field: names.index(field) for field in FIELDS if field in names}
+
+
+def row_to_item(columns: dict, row):
+    item = {}
+    for field, position in columns.items():
+        value = row[position] if position < len(row) else None
+        if isinstance(value, str):
+            value = value.strip() or None
+        if value is None:
+            continue
+
+        if field == 'serial_number':
+            value = str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+        elif field == 'meter_reading_value':
+            value = to_int(value)
+        elif field == 'meter_reading_date' and isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.strftime('%Y-%m-%d')
+        item[field] = value
+    return item
+
+
+def to_int(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        return int(value)
+    return value
@@ -0,0 +1,84 @@
+import datetime
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import CalculationJob, Flat
+
+
+"""
+Задания расчета дома за месяц (CalculationJob). Для дома и месяца может быть только одно задание в очереди
+или в работе (частичный уникальный индекс unique_active_calculation_job), повторный запуск возвращает
+уже созданное задание. Задание, не завершившееся за CALCULATION_JOB_TIMEOUT секунд (например, после потери
+задачи брокером), считается прерванным и не мешает запуску нового расчета.
+Статус, время ожидания в очереди и расчета, количество квартир хранятся в записи задания
+"""
+def submit_calculation_job(apartment_building_id: int, year_month_key: str):
+    """
+    Возвращает задание и признак того, что оно создано сейчас и расчет нужно запустить
+    """
+    expire_calculation_jobs(apartment_building_id, year_month_key)
+    try:
+        with transaction.atomic():
+            return CalculationJob.objects.create(apartment_building_id=apartment_building_id, year_month=year_month_key), True
+    except IntegrityError:
+        job = active_jobs(apartment_building_id, year_month_key).first()
+        if job is None:
+            # задание завершилось между попыткой создания и чтением
+            return CalculationJob.objects.create(apartment_building_id=apartment_building_id, year_month=year_month_key), True
+        return job, False
+
+
+def active_jobs(apartment_building_id: int, year_month_key: str):
+    return CalculationJob.objects.filter(
+        apartment_building_id=apartment_building_id, year_month=year_month_key, status__in=CalculationJob.ACTIVE_STATUSES,
+    )
+
+
+def expire_calculation_jobs(apartment_building_id: int, year_month_key: str):
+    now = timezone.now()
+    active_jobs(apartment_building_id, year_month_key).filter(
+        created_at__lt=now - datetime.timedelta(seconds=settings.CALCULATION_JOB_TIMEOUT),
+    ).update(status='failed', error_message='Расчет не завершился за отведенное время.', finished_at=now)
+
+
+def job_uuid(job_id: str):
+    # задачи расчета, запущенные без задания (командами), передают произвольный job_id
+    try:
+        return uuid.UUID(str(job_id))
+    except ValueError:
+        return None
+
+
+def update_job(job_id: str, **fields):
+    job_id = job_uuid(job_id)
+    if job_id is not None:
+        CalculationJob.objects.filter(id=job_id).update(**fields)
+
+
+def claim_job(job_id: str, apartment_building_id: int, redelivered: bool = False) -> bool:
+    """
+    Перевод задания из очереди в работу. False, если задание уже не в очереди: например, считается прерванным
+    после CALCULATION_JOB_TIMEOUT, и дом рассчитывается новым заданием.
+    redelivered - задача может быть доставлена повторно (acks_late, повтор после ошибки бд), тогда задание,
+    уже находящееся в работе, продолжается тем же job_id
+    """
+    job_id = job_uuid(job_id)
+    if job_id is None:
+        return True
+    claimed = CalculationJob.objects.filter(id=job_id, status='pending').update(
+        status='running',
+        started_at=timezone.now(),
+        total_flats=Flat.objects.filter(apartment_building_id=apartment_building_id).count(),
+    ) > 0
+    return claimed or redelivered and CalculationJob.objects.filter(id=job_id, status='running').exists()
+
+
+def finish_job(job_id: str, calculated: int):
+    update_job(job_id, status='done', calculated=calculated, finished_at=timezone.now())
+
+
+def fail_job(job_id: str, message: str, calculated: int = 0):
+    update_job(job_id, status='failed', error_message=message, calculated=calculated, finished_at=timezone.now())
@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from counter.benchmarks import run_connection_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Замер времени запросов передачи показаний с новым соединением с бд на каждый запрос, '
+            'с постоянным соединением и с постоянным соединением и проверкой перед запросом. Результат в JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Количество запросов в каждом режиме')
+        parser.add_argument('--counters', type=int, default=20, help='Количество счетчиков, по которым передаются показания')
+        parser.add_argument('--output', help='Файл результатов. Без указания - стандартный вывод')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['counters'] < 1:
+            raise CommandError('Количество запросов и счетчиков должно быть положительным.')
+
+        results = run_connection_benchmark(requests=options['requests'], counters=options['counters'])
+        output = json.dumps(results, ensure_ascii=False, indent=2)
+
+        if not options['output']:
+            self.stdout.write(output)
+            return
+        with open(options['output'], 'w', encoding='utf-8') as file:
+            file.write(output)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {options["output"]}'))
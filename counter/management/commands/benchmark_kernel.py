@@ -0,0 +1,59 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from counter import kernel
+from counter.calculator import calculate_flat_payment, flat_billed_by_norm, to_price
+from counter.synthetic import SYNTHETIC_TARIFFS, build_flats, generate_rows
+
+
+class Command(BaseCommand):
+    help = ('Сравнение скорости расчета начислений в Decimal и векторным ядром на NumPy '
+            'на синтетических квартирах, с проверкой совпадения результатов')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flats', type=int, default=100000, help='Количество синтетических квартир')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора данных')
+        parser.add_argument('--year', default='2024', help='Год расчета')
+        parser.add_argument('--month', default='07', help='Месяц расчета')
+
+    def handle(self, *args, **options):
+        if not kernel.kernel_available():
+            raise CommandError('Для векторного расчета необходим пакет numpy.')
+
+        year, month = options['year'], options['month']
+        current_date = datetime.date(int(year), int(month), 15)
+        tariffs = SYNTHETIC_TARIFFS
+        rows = generate_rows(options['flats'], year, month, options['seed'])
+        flats = build_flats(*rows)
+
+        started = time.perf_counter()
+        expected = [
+            (
+                flat.id,
+                *(to_price(price) for price in calculate_flat_payment(flat, tariffs, current_date, year, month)),
+                flat_billed_by_norm(flat, current_date, year, month),
+            )
+            for flat in flats
+        ]
+        decimal_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        columns = kernel.build_columns(*rows, year, month)
+        columns_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        charges = kernel.compute_charges(columns, tariffs, current_date)
+        compute_seconds = time.perf_counter() - started
+        result = kernel.charges_to_decimal(charges)
+        kernel_seconds = time.perf_counter() - started + columns_seconds
+
+        mismatches = sum(1 for left, right in zip(expected, result) if left != right)
+        self.stdout.write(f'Квартир: {len(flats)}, счетчиков: {len(rows[1])}, показаний: {len(rows[2])}')
+        self.stdout.write(f'Decimal: {decimal_seconds:.3f} с')
+        self.stdout.write(f'NumPy: {kernel_seconds:.3f} с (столбцы {columns_seconds:.3f} с, расчет {compute_seconds:.3f} с)')
+        self.stdout.write(f'Ускорение: {decimal_seconds / kernel_seconds:.1f}x, расчет без подготовки столбцов: '
+                          f'{decimal_seconds / max(compute_seconds, 1e-9):.0f}x')
+        if mismatches:
+            raise CommandError(f'Результаты расходятся для {mismatches} квартир.')
+        self.stdout.write(self.style.SUCCESS('Результаты совпадают до копейки'))
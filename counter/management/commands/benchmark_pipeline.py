@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from counter.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Замеры расчета начислений, просмотра дома, передачи показаний и опроса прогресса на синтетических данных. '
+            'Результат в JSON для сравнения между версиями, бд после замеров не меняется')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buildings', type=int, default=1, help='Количество синтетических домов')
+        parser.add_argument('--flats', type=int, default=1000, help='Количество квартир в доме')
+        parser.add_argument('--months', type=int, default=12, help='Количество месяцев показаний')
+        parser.add_argument('--year', default='2024', help='Год расчета')
+        parser.add_argument('--month', default='07', help='Месяц расчета')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора данных')
+        parser.add_argument('--repeat', type=int, default=3, help='Количество запусков каждого замера')
+        parser.add_argument('--polls', type=int, default=100, help='Количество запросов прогресса в одном замере')
+        parser.add_argument('--output', help='Файл результатов. Без указания - стандартный вывод')
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(
+            buildings=options['buildings'],
+            flats=options['flats'],
+            months=options['months'],
+            year=options['year'],
+            month=options['month'],
+            seed=options['seed'],
+            repeat=options['repeat'],
+            polls=options['polls'],
+        )
+        output = json.dumps(results, ensure_ascii=False, indent=2)
+
+        if not options['output']:
+            self.stdout.write(output)
+            return
+        with open(options['output'], 'w', encoding='utf-8') as file:
+            file.write(output)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {options["output"]}'))
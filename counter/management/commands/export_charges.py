@@ -0,0 +1,40 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from counter.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_charges
+
+
+class Command(BaseCommand):
+    help = 'Потоковая выгрузка начислений по квартирам в CSV или NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('apartment_building_ids', nargs='*', type=int, help='ID домов. Без указания - все дома')
+        parser.add_argument('--from', dest='start', help='Первый месяц в формате YYYY-MM')
+        parser.add_argument('--to', dest='end', help='Последний месяц в формате YYYY-MM')
+        parser.add_argument('--format', dest='file_format', choices=list(EXPORT_FORMATS), default='csv', help='Формат выгрузки')
+        parser.add_argument('--output', help='Файл выгрузки. Без указания - стандартный вывод')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Количество начислений, читаемых из бд за раз')
+
+    def handle(self, *args, **options):
+        for value in (options['start'], options['end']):
+            if value and not re.match(r'^\d{4}-(0[1-9]|1[0-2])$', value):
+                raise CommandError(f"Месяц должен быть в формате 'YYYY-MM': {value}")
+
+        chunks = export_charges(
+            options['apartment_building_ids'],
+            options['start'],
+            options['end'],
+            options['file_format'],
+            chunk_size=options['chunk_size'],
+        )
+
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        self.stdout.write(self.style.SUCCESS(f'Выгрузка сохранена в {options["output"]}'))
@@ -0,0 +1,27 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from counter.synthetic import create_dataset
+
+
+class Command(BaseCommand):
+    help = ('Создание синтетических домов, квартир, счетчиков и показаний для нагрузочных проверок. '
+            'Данные покрывают все случаи расчета: квартиры без счетчиков, просроченную поверку, '
+            'отсутствие показаний за месяц, новые счетчики, показания после месяца расчета')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buildings', type=int, default=1, help='Количество домов')
+        parser.add_argument('--flats', type=int, default=1000, help='Количество квартир в доме')
+        parser.add_argument('--months', type=int, default=12, help='Количество месяцев показаний')
+        parser.add_argument('--year', default='2024', help='Год последнего месяца показаний')
+        parser.add_argument('--month', default='07', help='Последний месяц показаний')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора данных')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            dataset = create_dataset(
+                options['buildings'], options['flats'], options['months'], options['year'], options['month'], options['seed'],
+            )
+        self.stdout.write(json.dumps(dataset, ensure_ascii=False))
@@ -0,0 +1,53 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from counter.imports import ImportFormatError, detect_format, run_import
+from counter.models import ReadingImport
+from counter.readings import READINGS_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Загрузка показаний счетчиков из файла CSV или XLSX с колонками serial_number, meter_reading_value '
+            'и необязательной meter_reading_date. Незавершенная загрузка того же файла продолжается с последней '
+            'зафиксированной строки')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file_path', help='Путь к файлу показаний')
+        parser.add_argument('--format', dest='file_format', choices=[value for value, _ in ReadingImport.FORMAT],
+                            help='Формат файла, по умолчанию определяется по расширению')
+        parser.add_argument('--restart', action='store_true', help='Начать загрузку файла заново')
+        parser.add_argument('--batch-size', type=int, default=READINGS_BATCH_SIZE, help='Количество строк в одной транзакции')
+
+    def handle(self, *args, **options):
+        file_path = os.path.abspath(options['file_path'])
+        if not os.path.isfile(file_path):
+            raise CommandError(f'Файл {file_path} не найден.')
+
+        try:
+            file_format = options['file_format'] or detect_format(file_path)
+        except ImportFormatError as e:
+            raise CommandError(str(e))
+
+        reading_import = None
+        if not options['restart']:
+            reading_import = ReadingImport.objects.filter(
+                file_path=file_path, status__in=['pending', 'running', 'failed']
+            ).order_by('-created_at').first()
+
+        if reading_import is None:
+            reading_import = ReadingImport.objects.create(file_path=file_path, file_format=file_format)
+        else:
+            self.stdout.write(f'Продолжение загрузки {reading_import.id} со строки {reading_import.offset + 2}')
+
+        try:
+            run_import(reading_import, batch_size=options['batch_size'])
+        except Exception as e:
+            raise CommandError(f'Загрузка {reading_import.id} прервана на строке {reading_import.offset + 2}: {e}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Загрузка {reading_import.id} завершена: записано показаний {reading_import.saved}, '
+            f'строк с ошибками {reading_import.failed}'
+        ))
+        for error in reading_import.errors[:20]:
+            self.stdout.write(f'Строка {error["row"]}: {"; ".join(error["errors"])}')
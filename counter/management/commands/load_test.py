@@ -0,0 +1,108 @@
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from counter.benchmarks import percentile
+from counter.models import ApartmentBuilding, WaterCounter
+
+
+SCENARIOS = ('progress', 'reading')
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочная проверка запущенного сервера параллельными запросами: опрос прогресса расчета или передача показаний. '
+            'Результат в JSON - запросов в секунду и задержки p50, p95, p99 для сравнения запуска через WSGI и ASGI')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Адрес сервера, например http://127.0.0.1:8000')
+        parser.add_argument('--scenario', choices=SCENARIOS, default='progress', help='Проверяемый эндпоинт')
+        parser.add_argument('--requests', type=int, default=2000, help='Общее количество запросов')
+        parser.add_argument('--concurrency', type=int, default=50, help='Количество одновременных запросов')
+        parser.add_argument('--counters', type=int, default=100, help='Количество счетчиков, по которым передаются показания')
+        parser.add_argument('--timeout', type=float, default=30, help='Время ожидания ответа, в секундах')
+        parser.add_argument('--output', help='Файл результатов. Без указания - стандартный вывод')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('Количество запросов и одновременных запросов должно быть положительным.')
+
+        requests = self.build_requests(options['url'].rstrip('/'), options)
+        timeout = options['timeout']
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(lambda request: send(request, timeout), requests))
+        elapsed = time.perf_counter() - started
+
+        statuses = {}
+        for status_code, _ in results:
+            statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+        latencies = sorted(latency for _, latency in results)
+
+        output = json.dumps({
+            'scenario': options['scenario'],
+            'url': options['url'],
+            'requests': len(results),
+            'concurrency': options['concurrency'],
+            # ошибки соединения (статус 0) и ошибки сервера
+            'errors': sum(1 for status_code, _ in results if status_code == 0 or status_code >= 500),
+            'statuses': statuses,
+            'elapsed_seconds': round(elapsed, 3),
+            'requests_per_second': round(len(results) / elapsed, 1),
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': round(latencies[-1] * 1000, 2),
+            },
+        }, ensure_ascii=False, indent=2)
+
+        if not options['output']:
+            self.stdout.write(output)
+            return
+        with open(options['output'], 'w', encoding='utf-8') as file:
+            file.write(output)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {options["output"]}'))
+
+    def build_requests(self, url: str, options: dict) -> list:
+        if options['scenario'] == 'progress':
+            apartment_building_id = ApartmentBuilding.objects.order_by('id').values_list('id', flat=True).first()
+            if apartment_building_id is None:
+                raise CommandError('В бд нет домов.')
+            request = urllib.request.Request(f'{url}/api/v1/calculate-progress/{apartment_building_id}/')
+            return [request] * options['requests']
+
+        serial_numbers = list(WaterCounter.objects.order_by('id').values_list('serial_number', flat=True)[:options['counters']])
+        if not serial_numbers:
+            raise CommandError('В бд нет счетчиков.')
+        rng = random.Random(0)
+        return [
+            urllib.request.Request(
+                f'{url}/api/v1/add-meter-reading/',
+                data=json.dumps({
+                    'serial_number': serial_numbers[index % len(serial_numbers)],
+                    'meter_reading_value': rng.randint(0, 100000),
+                }).encode(),
+                headers={'Content-Type': 'application/json'},
+                method='POST',
+            )
+            for index in range(options['requests'])
+        ]
+
+
+def send(request, timeout: float):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status_code = response.status
+    except urllib.error.HTTPError as e:
+        status_code = e.code
+    except (urllib.error.URLError, OSError):
+        status_code = 0
+    return status_code, time.perf_counter() - started
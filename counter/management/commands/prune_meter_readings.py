@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from counter.models import MeterReading
+
+
+class Command(BaseCommand):
+    help = 'Удаляет устаревшие показания счетчиков, оставляя заданное количество последних показаний каждого счетчика'
+
+    batch_size = 5000
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=settings.METER_READINGS_RETENTION,
+                            help='Количество последних показаний, которые сохраняются для каждого счетчика')
+        parser.add_argument('--dry-run', action='store_true', help='Только подсчитать показания для удаления')
+
+    def handle(self, *args, **options):
+        keep = options['keep']
+        # для расчета нужны два последних показания, их удалять нельзя
+        if keep < 2:
+            raise CommandError('Для расчета платы необходимо хранить не менее двух последних показаний.')
+
+        outdated_ids = list(
+            MeterReading.objects.annotate(
+                position=Window(
+                    expression=RowNumber(),
+                    partition_by=[F('counter_id')],
+                    order_by=F('reading_date').desc(),
+                )
+            ).filter(position__gt=keep).values_list('id', flat=True)
+        )
+
+        if options['dry_run']:
+            self.stdout.write(f'Показаний к удалению: {len(outdated_ids)}')
+            return
+
+        for start in range(0, len(outdated_ids), self.batch_size):
+            MeterReading.objects.filter(id__in=outdated_ids[start:start + self.batch_size]).delete()
+
+        self.stdout.write(self.style.SUCCESS(f'Удалено показаний: {len(outdated_ids)}'))
@@ -0,0 +1,82 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from counter.calculator import recalculate_stale_charges, recalculator_payment
+from counter.models import ApartmentBuilding, MonthlyCharge
+from counter.task import recalculate_payment_task, recalculate_stale_task
+
+
+def month_range(start: str, end: str) -> list:
+    start_year, start_month = map(int, start.split('-'))
+    end_year, end_month = map(int, end.split('-'))
+    months = []
+    year, month = start_year, start_month
+    while (year, month) <= (end_year, end_month):
+        months.append(f'{year}-{month:02d}')
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+class Command(BaseCommand):
+    help = ('Перерасчет платы за несколько месяцев с учетом тарифов, действовавших в каждом месяце. '
+            'С --stale пересчитываются только начисления, устаревшие после изменения показаний или данных квартир и счетчиков')
+
+    def add_arguments(self, parser):
+        parser.add_argument('apartment_building_ids', nargs='*', type=int, help='ID домов. Без указания - все дома')
+        parser.add_argument('--from', dest='start', help='Первый месяц перерасчета в формате YYYY-MM')
+        parser.add_argument('--to', dest='end', help='Последний месяц перерасчета в формате YYYY-MM')
+        parser.add_argument('--stale', action='store_true', help='Пересчитать только устаревшие начисления')
+        parser.add_argument('--async', dest='run_async', action='store_true', help='Запустить перерасчет задачами Celery')
+
+    def handle(self, *args, **options):
+        if options['stale']:
+            return self.recalculate_stale(options)
+
+        for value in (options['start'], options['end']):
+            if value is None:
+                raise CommandError('Укажите период перерасчета --from и --to или режим --stale.')
+            if not re.match(r'^\d{4}-(0[1-9]|1[0-2])$', value):
+                raise CommandError(f"Месяц должен быть в формате 'YYYY-MM': {value}")
+
+        year_months = month_range(options['start'], options['end'])
+        if not year_months:
+            raise CommandError('Первый месяц перерасчета позже последнего.')
+
+        apartment_building_ids = options['apartment_building_ids'] or list(
+            ApartmentBuilding.objects.order_by('id').values_list('id', flat=True)
+        )
+
+        for apartment_building_id in apartment_building_ids:
+            if options['run_async']:
+                recalculate_payment_task.delay(apartment_building_id, year_months)
+                self.stdout.write(f'Дом {apartment_building_id}: перерасчет запущен')
+                continue
+
+            self.run(apartment_building_id, recalculator_payment, apartment_building_id, year_months)
+
+    def recalculate_stale(self, options):
+        # пересчитываются только дома, в которых есть устаревшие начисления
+        stale_charges = MonthlyCharge.objects.filter(stale_since__isnull=False)
+        if options['apartment_building_ids']:
+            stale_charges = stale_charges.filter(flat__apartment_building_id__in=options['apartment_building_ids'])
+        apartment_building_ids = stale_charges.order_by('flat__apartment_building_id').values_list(
+            'flat__apartment_building_id', flat=True
+        ).distinct()
+
+        for apartment_building_id in apartment_building_ids:
+            if options['run_async']:
+                recalculate_stale_task.delay(apartment_building_id)
+                self.stdout.write(f'Дом {apartment_building_id}: перерасчет запущен')
+                continue
+
+            self.run(apartment_building_id, recalculate_stale_charges, apartment_building_id)
+
+    def run(self, apartment_building_id, function, *args):
+        # ошибка записана в контрольную точку перерасчета дома, остальные дома пересчитываются
+        try:
+            result = function(*args)
+        except Exception as e:
+            self.stderr.write(f'Дом {apartment_building_id}: {e}')
+            return
+        self.stdout.write(f'Дом {apartment_building_id}: рассчитано начислений {result["calculated"]}')
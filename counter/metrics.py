@@ -0,0 +1,388 @@
+import functools
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django_redis import get_redis_connection
+from django_redis.client import DefaultClient
+
+logger = logging.getLogger(__name__)
+
+# границы корзин гистограмм длительности, в секундах
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+PROCESSES_KEY = 'metrics:processes'
+
+METRICS = {
+    'counter_http_requests_total': ('counter', 'Количество запросов к API'),
+    'counter_http_request_duration_seconds': ('histogram', 'Время обработки запроса к API'),
+    'counter_http_db_queries_total': ('counter', 'Количество SQL-запросов при обработке запросов к API'),
+    'counter_http_db_query_duration_seconds_total': ('counter', 'Время выполнения SQL-запросов при обработке запросов к API'),
+    'counter_http_cache_calls_total': ('counter', 'Количество обращений к кешу при обработке запросов к API'),
+    'counter_calculation_duration_seconds': ('histogram', 'Время расчета начислений'),
+    'counter_calculation_phase_duration_seconds_total': ('counter', 'Время этапов расчета: load, compute, save, progress'),
+    'counter_calculation_flats_total': ('counter', 'Количество рассчитанных квартир'),
+    'counter_calculation_db_queries_total': ('counter', 'Количество SQL-запросов при расчете'),
+    'counter_calculation_cache_calls_total': ('counter', 'Количество обращений к кешу при расчете'),
+}
+
+
+"""
+Метрики запросов к API приложения counter и расчета начислений при METRICS_ENABLED.
+Каждый процесс (веб-приложение, воркер Celery) накапливает значения в памяти и не чаще
+чем раз в METRICS_FLUSH_INTERVAL секунд записывает их в кеш по ключу metrics:process:{хост}:{pid},
+ключи процессов добавляются в множество Redis metrics:processes (SADD), поэтому одновременно запущенные
+процессы не затирают друг друга. Эндпоинт /metrics суммирует значения всех живых процессов и отдает их
+в текстовом формате Prometheus, доступ - с адресов и сетей из METRICS_ALLOWED_IPS или с токеном METRICS_TOKEN. Кроме того, каждый запрос и расчет пишется
+в лог counter.metrics одной строкой JSON.
+При выключенных метриках middleware не подключается, а этапы расчета не замеряются
+"""
+def metric_key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.flushed_at = 0.0
+
+    def inc(self, name: str, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            # значения корзин накопительные, затем количество и сумма наблюдений
+            histogram = self.histograms.setdefault(key, [0] * len(DURATION_BUCKETS) + [0, 0.0])
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: list(histogram) for key, histogram in self.histograms.items()},
+            }
+
+    def flush(self):
+        key = f"metrics:process:{socket.gethostname()}:{os.getpid()}"
+        # значения завершившихся процессов удаляются из кеша по истечении времени хранения
+        cache.set(key, self.snapshot(), timeout=settings.METRICS_FLUSH_INTERVAL * 10)
+        register_process(key)
+        self.flushed_at = time.monotonic()
+
+    def maybe_flush(self):
+        if time.monotonic() - self.flushed_at >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+
+registry = MetricsRegistry()
+
+
+def redis_client():
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        # кеш без Redis (локальный запуск, тесты) хранится в памяти процесса, других процессов в нем нет
+        return None
+
+
+def register_process(key: str):
+    client = redis_client()
+    if client is not None:
+        client.sadd(PROCESSES_KEY, key)
+        return
+    processes = cache.get(PROCESSES_KEY) or set()
+    if key not in processes:
+        cache.set(PROCESSES_KEY, processes | {key}, timeout=None)
+
+
+def process_keys() -> set:
+    client = redis_client()
+    if client is not None:
+        return {key.decode() for key in client.smembers(PROCESSES_KEY)}
+    return cache.get(PROCESSES_KEY) or set()
+
+
+def unregister_processes(keys: set):
+    client = redis_client()
+    if client is not None:
+        client.srem(PROCESSES_KEY, *keys)
+        return
+    cache.set(PROCESSES_KEY, (cache.get(PROCESSES_KEY) or set()) - keys, timeout=None)
+
+
+def collect() -> dict:
+    """
+    Сумма значений всех процессов, записавших метрики в кеш
+    """
+    registry.flush()
+    processes = process_keys()
+    snapshots = cache.get_many(list(processes))
+    if len(snapshots) < len(processes):
+        # значения завершившихся процессов истекли, процесс, удаленный одновременно с записью, добавит себя снова
+        unregister_processes(processes - set(snapshots))
+
+    counters, histograms = {}, {}
+    for snapshot in snapshots.values():
+        for key, value in snapshot['counters'].items():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in snapshot['histograms'].items():
+            if key in histograms:
+                histograms[key] = [total + value for total, value in zip(histograms[key], histogram)]
+            else:
+                histograms[key] = list(histogram)
+    return {'counters': counters, 'histograms': histograms}
+
+
+def render_prometheus(metrics: dict) -> str:
+    series = {}
+    for (name, labels), value in metrics['counters'].items():
+        series.setdefault(name, []).append(f"{name}{format_labels(labels)} {format_value(value)}")
+    for (name, labels), histogram in metrics['histograms'].items():
+        lines = series.setdefault(name, [])
+        for bound, count in zip(DURATION_BUCKETS, histogram):
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+        lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram[-2]}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram[-2]}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram[-1])}")
+
+    output = []
+    for name in sorted(series):
+        metric_type, description = METRICS.get(name, ('untyped', name))
+        output.append(f"# HELP {name} {description}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(sorted(series[name]))
+    return '\n'.join(output) + '\n'
+
+
+def metrics_access_allowed(request) -> bool:
+    token = settings.METRICS_TOKEN
+    if token and hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    # адреса и сети в формате CIDR, например 172.16.0.0/12 для шлюза сети docker
+    return any(address in ipaddress.ip_network(network, strict=False) for network in settings.METRICS_ALLOWED_IPS)
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    values = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        values.append(f'{name}="{value}"')
+    return '{' + ','.join(values) + '}'
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class QueryStats:
+    """
+    Количество и время SQL-запросов (через connection.execute_wrapper) и количество обращений к кешу
+    """
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.cache_calls = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - started
+
+
+class CalculationStats(QueryStats):
+    def __init__(self):
+        super().__init__()
+        self.phases = {}
+
+
+current_stats = ContextVar('metrics_current_stats', default=None)
+
+
+def record_cache_call():
+    stats = current_stats.get()
+    if stats is not None:
+        stats.cache_calls += 1
+
+
+class InstrumentedRedisClient(DefaultClient):
+    """
+    Клиент django-redis, считающий обращения к Redis: каждая операция кеша, включая get_many и set_many,
+    получает соединение через get_client один раз
+    """
+    def get_client(self, *args, **kwargs):
+        record_cache_call()
+        return super().get_client(*args, **kwargs)
+
+
+class MetricsMiddleware:
+    """
+    Замер запросов к представлениям приложения counter. Для потоковых ответов (выгрузка начислений)
+    учитывается время до начала передачи тела ответа. В режиме ASGI SQL-запросы выполняются в потоках
+    со своими соединениями и не учитываются, остальные значения замеряются так же
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        stats = QueryStats()
+        token = current_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(stats):
+                response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        if match is not None and match.app_name == 'counter':
+            record_request(match.url_name, request.method, response.status_code, duration, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        token = current_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        if match is not None and match.app_name == 'counter':
+            await sync_to_async(record_request)(match.url_name, request.method, response.status_code, duration, stats)
+        return response
+
+
+def record_request(view: str, method: str, status_code: int, duration: float, stats: QueryStats):
+    registry.inc('counter_http_requests_total', view=view, method=method, status=str(status_code))
+    registry.observe('counter_http_request_duration_seconds', duration, view=view)
+    registry.inc('counter_http_db_queries_total', stats.queries, view=view)
+    registry.inc('counter_http_db_query_duration_seconds_total', stats.query_time, view=view)
+    registry.inc('counter_http_cache_calls_total', stats.cache_calls, view=view)
+    logger.info(json.dumps({
+        'event': 'request',
+        'view': view,
+        'method': method,
+        'status': status_code,
+        'duration': round(duration, 6),
+        'db_queries': stats.queries,
+        'db_time': round(stats.query_time, 6),
+        'cache_calls': stats.cache_calls,
+    }))
+    registry.maybe_flush()
+
+
+def instrument_calculation(operation: str):
+    """
+    Замер функции расчета дома: первый аргумент - ID дома, результат - словарь со status и calculated
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(apartment_building_id, *args, **kwargs):
+            if not settings.METRICS_ENABLED:
+                return function(apartment_building_id, *args, **kwargs)
+
+            stats = CalculationStats()
+            token = current_stats.set(stats)
+            started = time.perf_counter()
+            result = None
+            try:
+                with connection.execute_wrapper(stats):
+                    result = function(apartment_building_id, *args, **kwargs)
+            except Exception:
+                result = {'status': 'error'}
+                raise
+            finally:
+                current_stats.reset(token)
+                record_calculation(operation, apartment_building_id, time.perf_counter() - started, stats, result)
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Замер этапа расчета: load, compute, save или progress. Вне замеряемого расчета ничего не делает
+    """
+    stats = current_stats.get()
+    if not isinstance(stats, CalculationStats):
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[name] = stats.phases.get(name, 0.0) + time.perf_counter() - started
+
+
+def record_calculation(operation: str, apartment_building_id: int, duration: float, stats: CalculationStats, result: dict):
+    status = result.get('status') if isinstance(result, dict) else None
+    calculated = result.get('calculated', 0) if isinstance(result, dict) else 0
+
+    registry.observe('counter_calculation_duration_seconds', duration, operation=operation, status=status)
+    for name, seconds in stats.phases.items():
+        registry.inc('counter_calculation_phase_duration_seconds_total', seconds, operation=operation, phase=name)
+    registry.inc('counter_calculation_flats_total', calculated, operation=operation)
+    registry.inc('counter_calculation_db_queries_total', stats.queries, operation=operation)
+    registry.inc('counter_calculation_cache_calls_total', stats.cache_calls, operation=operation)
+    logger.info(json.dumps({
+        'event': 'calculation',
+        'operation': operation,
+        'apartment_building_id': apartment_building_id,
+        'status': status,
+        'calculated': calculated,
+        'duration': round(duration, 6),
+        'phases': {name: round(seconds, 6) for name, seconds in stats.phases.items()},
+        'db_queries': stats.queries,
+        'db_time': round(stats.query_time, 6),
+        'cache_calls': stats.cache_calls,
+    }))
+    # расчеты редкие и долгие, значения записываются сразу, воркер может долго не получать задач
+    registry.flush()
@@ -0,0 +1,77 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApartmentBuilding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_area', models.DecimalField(decimal_places=2, max_digits=8, verbose_name='Общая площадь дома')),
+                ('address', models.CharField(max_length=256, unique=True, verbose_name='Адрес дома')),
+            ],
+            options={
+                'verbose_name': 'Многоквартирный жилой дом',
+                'verbose_name_plural': 'Многоквартирные жилые дома',
+            },
+        ),
+        migrations.CreateModel(
+            name='Tariff',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tariff_type', models.CharField(choices=[('cold_water_for_flat', 'холодное водоснабжение в квартире'), ('hot_water_for_flat', 'горячее водоснабжение в квартире'), ('maintenance_of_common_property', 'содержание общего имущества')], max_length=124, verbose_name='Тип тарифа водоснабжения')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=6, verbose_name='Стоимость одного кубического метра')),
+            ],
+            options={
+                'verbose_name': 'Тариф',
+                'verbose_name_plural': 'Тарифы',
+            },
+        ),
+        migrations.CreateModel(
+            name='Flat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(verbose_name='Номер квартиры')),
+                ('number_of_registered', models.PositiveIntegerField(default=1, verbose_name='Количество зарегистрированных лиц')),
+                ('area', models.DecimalField(decimal_places=2, max_digits=6, verbose_name='Площадь квартиры')),
+                ('calculations', models.JSONField(blank=True, default=dict, verbose_name='Расчеты')),
+                ('apartment_building', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='flats', to='counter.apartmentbuilding', verbose_name='Дом, где расположена квартира')),
+            ],
+            options={
+                'verbose_name': 'Квартира',
+                'verbose_name_plural': 'Квартиры',
+            },
+        ),
+        migrations.CreateModel(
+            name='WaterCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.CharField(max_length=10, verbose_name='Серийный номер счетчика')),
+                ('verification_date', models.DateField(verbose_name='Дата поверки')),
+                ('type_water_counter', models.CharField(choices=[('cold', 'холодное'), ('hot', 'горячее')], max_length=8, verbose_name='Тип водоснабжения')),
+                ('meters', models.JSONField(blank=True, default=list, null=True, verbose_name='Показания счетчика')),
+                ('flat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='water_counters', to='counter.flat', verbose_name='Квартира')),
+            ],
+            options={
+                'verbose_name': 'Счетчик',
+                'verbose_name_plural': 'Счетчики',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='flat',
+            constraint=models.UniqueConstraint(fields=('number', 'apartment_building'), name='unique_flat_in_building'),
+        ),
+        migrations.AddConstraint(
+            model_name='watercounter',
+            constraint=models.UniqueConstraint(fields=('serial_number', 'flat'), name='unique_water_counter_in_flat'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeterReading',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reading_date', models.DateField(verbose_name='Дата передачи показаний')),
+                ('value', models.IntegerField(verbose_name='Показания счетчика')),
+                ('counter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='readings', to='counter.watercounter', verbose_name='Счетчик')),
+            ],
+            options={
+                'verbose_name': 'Показания счетчика',
+                'verbose_name_plural': 'Показания счетчиков',
+                'ordering': ['reading_date'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='meterreading',
+            constraint=models.UniqueConstraint(fields=('counter', 'reading_date'), name='unique_meter_reading_in_day'),
+        ),
+    ]
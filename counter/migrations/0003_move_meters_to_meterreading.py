@@ -0,0 +1,50 @@
+from django.db import migrations
+
+
+def move_meters_to_readings(apps, schema_editor):
+    WaterCounter = apps.get_model('counter', 'WaterCounter')
+    MeterReading = apps.get_model('counter', 'MeterReading')
+
+    readings = []
+    for counter in WaterCounter.objects.exclude(meters__isnull=True).iterator(chunk_size=2000):
+        # при нескольких показаниях за один день сохраняется последнее переданное
+        values_by_date = {}
+        for meter in counter.meters or []:
+            values_by_date[meter['meter_reading_date']] = meter['meter_reading_value']
+
+        readings.extend(
+            MeterReading(counter_id=counter.id, reading_date=reading_date, value=value)
+            for reading_date, value in values_by_date.items()
+        )
+        if len(readings) >= 2000:
+            MeterReading.objects.bulk_create(readings)
+            readings = []
+
+    MeterReading.objects.bulk_create(readings)
+
+
+def move_readings_to_meters(apps, schema_editor):
+    WaterCounter = apps.get_model('counter', 'WaterCounter')
+    MeterReading = apps.get_model('counter', 'MeterReading')
+
+    meters = {}
+    for counter_id, reading_date, value in MeterReading.objects.order_by('counter_id', 'reading_date').values_list('counter_id', 'reading_date', 'value').iterator(chunk_size=2000):
+        meters.setdefault(counter_id, []).append(
+            {'meter_reading_date': reading_date.strftime('%Y-%m-%d'), 'meter_reading_value': value}
+        )
+
+    counters = list(WaterCounter.objects.filter(id__in=meters.keys()))
+    for counter in counters:
+        counter.meters = meters[counter.id]
+    WaterCounter.objects.bulk_update(counters, ['meters'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0002_meterreading'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_meters_to_readings, move_readings_to_meters),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0003_move_meters_to_meterreading'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='watercounter',
+            name='meters',
+        ),
+    ]
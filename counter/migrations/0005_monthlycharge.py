@@ -0,0 +1,33 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0004_remove_watercounter_meters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyCharge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year_month', models.CharField(max_length=7, verbose_name='Расчетный месяц')),
+                ('maintenance_of_common_property', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Содержание общего имущества')),
+                ('cold_water_usage_price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Холодное водоснабжение')),
+                ('hot_water_usage_price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Горячее водоснабжение')),
+                ('flat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charges', to='counter.flat', verbose_name='Квартира')),
+            ],
+            options={
+                'verbose_name': 'Начисление',
+                'verbose_name_plural': 'Начисления',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='monthlycharge',
+            constraint=models.UniqueConstraint(fields=('flat', 'year_month'), name='unique_charge_for_flat_in_month'),
+        ),
+    ]
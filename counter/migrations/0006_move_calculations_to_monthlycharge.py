@@ -0,0 +1,57 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import migrations
+
+
+def to_price(value):
+    return Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+def move_calculations_to_charges(apps, schema_editor):
+    Flat = apps.get_model('counter', 'Flat')
+    MonthlyCharge = apps.get_model('counter', 'MonthlyCharge')
+
+    charges = []
+    for flat in Flat.objects.exclude(calculations={}).iterator(chunk_size=2000):
+        for year_month, calculation in (flat.calculations or {}).items():
+            charges.append(MonthlyCharge(
+                flat_id=flat.id,
+                year_month=year_month,
+                maintenance_of_common_property=to_price(calculation['maintenance_of_common_property']),
+                cold_water_usage_price=to_price(calculation['cold_water_usage_price']),
+                hot_water_usage_price=to_price(calculation['hot_water_usage_price']),
+            ))
+        if len(charges) >= 2000:
+            MonthlyCharge.objects.bulk_create(charges)
+            charges = []
+
+    MonthlyCharge.objects.bulk_create(charges)
+
+
+def move_charges_to_calculations(apps, schema_editor):
+    Flat = apps.get_model('counter', 'Flat')
+    MonthlyCharge = apps.get_model('counter', 'MonthlyCharge')
+
+    calculations = {}
+    for charge in MonthlyCharge.objects.order_by('flat_id', 'year_month').iterator(chunk_size=2000):
+        calculations.setdefault(charge.flat_id, {})[charge.year_month] = {
+            'maintenance_of_common_property': float(charge.maintenance_of_common_property),
+            'cold_water_usage_price': float(charge.cold_water_usage_price),
+            'hot_water_usage_price': float(charge.hot_water_usage_price),
+        }
+
+    flats = list(Flat.objects.filter(id__in=calculations.keys()))
+    for flat in flats:
+        flat.calculations = calculations[flat.id]
+    Flat.objects.bulk_update(flats, ['calculations'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0005_monthlycharge'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_calculations_to_charges, move_charges_to_calculations),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0006_move_calculations_to_monthlycharge'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='flat',
+            name='calculations',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:36
+
+import datetime
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0007_remove_flat_calculations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tariff',
+            name='valid_from',
+            field=models.DateField(default=datetime.date(2000, 1, 1), verbose_name='Действует с'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='tariff',
+            name='valid_to',
+            field=models.DateField(blank=True, null=True, verbose_name='Действует по'),
+        ),
+        migrations.AddConstraint(
+            model_name='tariff',
+            constraint=models.UniqueConstraint(fields=('tariff_type', 'valid_from'), name='unique_tariff_type_from_date'),
+        ),
+    ]
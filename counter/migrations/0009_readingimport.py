@@ -0,0 +1,33 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0008_tariff_validity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadingImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_path', models.CharField(max_length=512, verbose_name='Файл показаний')),
+                ('file_format', models.CharField(choices=[('csv', 'CSV'), ('xlsx', 'XLSX')], max_length=8, verbose_name='Формат файла')),
+                ('status', models.CharField(choices=[('pending', 'ожидает'), ('running', 'выполняется'), ('done', 'завершен'), ('failed', 'ошибка')], default='pending', max_length=16, verbose_name='Статус')),
+                ('offset', models.PositiveIntegerField(default=0, verbose_name='Обработано строк')),
+                ('saved', models.PositiveIntegerField(default=0, verbose_name='Записано показаний')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='Строк с ошибками')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='Ошибки в строках')),
+                ('error_message', models.TextField(blank=True, verbose_name='Ошибка загрузки')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлена')),
+            ],
+            options={
+                'verbose_name': 'Загрузка показаний',
+                'verbose_name_plural': 'Загрузки показаний',
+            },
+        ),
+    ]
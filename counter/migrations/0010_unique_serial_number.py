@@ -0,0 +1,54 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:42
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_serial_number_conflicts(apps, schema_editor):
+    """
+    Перед созданием уникального индекса проверяется, что серийные номера не повторяются.
+    Повторяющиеся номера нужно исправить вручную, миграция выводит их вместе со счетчиками и квартирами
+    """
+    WaterCounter = apps.get_model('counter', 'WaterCounter')
+
+    duplicated = (
+        WaterCounter.objects.values('serial_number')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .values_list('serial_number', flat=True)
+    )
+    conflicts = {}
+    counters = (
+        WaterCounter.objects.filter(serial_number__in=duplicated)
+        .order_by('serial_number', 'id')
+        .values_list('serial_number', 'id', 'flat_id')
+    )
+    for serial_number, counter_id, flat_id in counters:
+        conflicts.setdefault(serial_number, []).append(f'счетчик {counter_id} (квартира {flat_id})')
+
+    if conflicts:
+        lines = [f'{serial_number}: {", ".join(counters)}' for serial_number, counters in conflicts.items()]
+        raise RuntimeError(
+            'Серийные номера счетчиков повторяются, исправьте их перед применением миграции:\n' + '\n'.join(lines)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0009_readingimport'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_serial_number_conflicts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='watercounter',
+            name='serial_number',
+            field=models.CharField(error_messages={'unique': 'Счетчик с таким серийным номером уже существует.'}, max_length=10, unique=True, verbose_name='Серийный номер счетчика'),
+        ),
+        # составное ограничение перекрывается уникальностью серийного номера
+        migrations.RemoveConstraint(
+            model_name='watercounter',
+            name='unique_water_counter_in_flat',
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0010_unique_serial_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlycharge',
+            name='stale_since',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Требует перерасчета с'),
+        ),
+        migrations.AddIndex(
+            model_name='monthlycharge',
+            index=models.Index(condition=models.Q(('stale_since__isnull', False)), fields=['year_month', 'flat'], name='stale_charge_idx'),
+        ),
+    ]
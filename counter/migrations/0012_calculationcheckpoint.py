@@ -0,0 +1,37 @@
+# Generated by Django 5.0.8 on 2026-10-17 19:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0011_monthlycharge_stale_since'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalculationCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64, verbose_name='Задание расчета')),
+                ('year_month', models.CharField(max_length=7, verbose_name='Расчетный месяц')),
+                ('status', models.CharField(choices=[('running', 'выполняется'), ('done', 'завершен'), ('failed', 'ошибка')], default='running', max_length=16, verbose_name='Статус')),
+                ('last_flat_id', models.BigIntegerField(default=0, verbose_name='Последняя рассчитанная квартира')),
+                ('calculated', models.PositiveIntegerField(default=0, verbose_name='Рассчитано квартир')),
+                ('error_message', models.TextField(blank=True, verbose_name='Ошибка расчета')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создан')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлен')),
+                ('apartment_building', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calculation_checkpoints', to='counter.apartmentbuilding', verbose_name='Дом')),
+            ],
+            options={
+                'verbose_name': 'Контрольная точка расчета',
+                'verbose_name_plural': 'Контрольные точки расчета',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='calculationcheckpoint',
+            constraint=models.UniqueConstraint(fields=('job_id', 'apartment_building'), name='unique_checkpoint_for_building_in_job'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.8 on 2026-10-17 20:00
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0012_calculationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalculationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('year_month', models.CharField(max_length=7, verbose_name='Расчетный месяц')),
+                ('status', models.CharField(choices=[('pending', 'в очереди'), ('running', 'выполняется'), ('done', 'завершен'), ('failed', 'ошибка')], default='pending', max_length=16, verbose_name='Статус')),
+                ('total_flats', models.PositiveIntegerField(blank=True, null=True, verbose_name='Квартир в доме')),
+                ('calculated', models.PositiveIntegerField(default=0, verbose_name='Рассчитано квартир')),
+                ('error_message', models.TextField(blank=True, verbose_name='Ошибка расчета')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создан')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начало расчета')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Окончание расчета')),
+                ('apartment_building', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calculation_jobs', to='counter.apartmentbuilding', verbose_name='Дом')),
+            ],
+            options={
+                'verbose_name': 'Задание расчета',
+                'verbose_name_plural': 'Задания расчета',
+                'indexes': [models.Index(fields=['apartment_building', 'created_at'], name='calculation_job_building_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='calculationjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ('pending', 'running'))), fields=('apartment_building', 'year_month'), name='unique_active_calculation_job'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.0.8 on 2026-10-17 20:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_summaries(apps, schema_editor):
+    MonthlyCharge = apps.get_model('counter', 'MonthlyCharge')
+    BuildingMonthlySummary = apps.get_model('counter', 'BuildingMonthlySummary')
+
+    # способ расчета ранее записанных начислений неизвестен, они учитываются как рассчитанные по счетчикам
+    totals = (
+        MonthlyCharge.objects.values('flat__apartment_building_id', 'year_month')
+        .annotate(
+            maintenance=Sum('maintenance_of_common_property'),
+            cold=Sum('cold_water_usage_price'),
+            hot=Sum('hot_water_usage_price'),
+            flats=Count('id'),
+        )
+        .order_by()
+    )
+    BuildingMonthlySummary.objects.bulk_create([
+        BuildingMonthlySummary(
+            apartment_building_id=row['flat__apartment_building_id'],
+            year_month=row['year_month'],
+            maintenance_of_common_property=row['maintenance'],
+            cold_water_usage_price=row['cold'],
+            hot_water_usage_price=row['hot'],
+            flats_billed=row['flats'],
+        )
+        for row in totals
+    ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0013_calculationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlycharge',
+            name='billed_by_norm',
+            field=models.BooleanField(default=False, verbose_name='Рассчитано по нормативу'),
+        ),
+        migrations.CreateModel(
+            name='BuildingMonthlySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year_month', models.CharField(max_length=7, verbose_name='Расчетный месяц')),
+                ('maintenance_of_common_property', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Содержание общего имущества')),
+                ('cold_water_usage_price', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Холодное водоснабжение')),
+                ('hot_water_usage_price', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Горячее водоснабжение')),
+                ('flats_billed', models.IntegerField(default=0, verbose_name='Квартир с начислениями')),
+                ('flats_billed_by_norm', models.IntegerField(default=0, verbose_name='Квартир, рассчитанных по нормативу')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлена')),
+                ('apartment_building', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_summaries', to='counter.apartmentbuilding', verbose_name='Дом')),
+            ],
+            options={
+                'verbose_name': 'Итоги начислений дома',
+                'verbose_name_plural': 'Итоги начислений домов',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='buildingmonthlysummary',
+            constraint=models.UniqueConstraint(fields=('apartment_building', 'year_month'), name='unique_summary_for_building_in_month'),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.8 on 2026-10-17 20:20
+
+import datetime
+
+from django.db import migrations, models
+
+
+def fill_expiration_dates(apps, schema_editor):
+    WaterCounter = apps.get_model('counter', 'WaterCounter')
+
+    counters = []
+    for counter in WaterCounter.objects.only('id', 'verification_date', 'type_water_counter').iterator(chunk_size=2000):
+        days = 6 * 365 if counter.type_water_counter == 'cold' else 4 * 365
+        counter.expiration_date = counter.verification_date + datetime.timedelta(days=days)
+        counters.append(counter)
+        if len(counters) >= 2000:
+            WaterCounter.objects.bulk_update(counters, ['expiration_date'])
+            counters = []
+
+    WaterCounter.objects.bulk_update(counters, ['expiration_date'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0014_buildingmonthlysummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watercounter',
+            name='expiration_date',
+            field=models.DateField(editable=False, null=True, verbose_name='Поверка действует до'),
+        ),
+        migrations.RunPython(fill_expiration_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='watercounter',
+            name='expiration_date',
+            field=models.DateField(editable=False, verbose_name='Поверка действует до'),
+        ),
+        migrations.AddIndex(
+            model_name='watercounter',
+            index=models.Index(fields=['expiration_date', 'id'], name='counter_expiration_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.8 on 2026-10-17 20:40
+
+import counter.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counter', '0015_watercounter_expiration_date'),
+    ]
+
+    # обычный столбец нельзя преобразовать в вычисляемый, он пересоздается вместе с индексом;
+    # значения вычисляются бд из даты поверки и типа счетчика
+    operations = [
+        migrations.RemoveIndex(
+            model_name='watercounter',
+            name='counter_expiration_idx',
+        ),
+        migrations.RemoveField(
+            model_name='watercounter',
+            name='expiration_date',
+        ),
+        migrations.AddField(
+            model_name='watercounter',
+            name='expiration_date',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(then=counter.models.AddDays(models.F('verification_date'), 2190), type_water_counter='cold'), default=counter.models.AddDays(models.F('verification_date'), 1460)), output_field=models.DateField(), verbose_name='Поверка действует до'),
+        ),
+        migrations.AddIndex(
+            model_name='watercounter',
+            index=models.Index(fields=['expiration_date', 'id'], name='counter_expiration_idx'),
+        ),
+    ]
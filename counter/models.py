@@ -1,4 +1,15 @@
+import calendar
+import datetime
+import uuid
+
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Case, F, Q, When, Window
+from django.db.models.functions import RowNumber
+
+# срок поверки счетчиков холодной и горячей воды, в днях
+COLD_WATER_VERIFICATION_DAYS = 6 * 365
+HOT_WATER_VERIFICATION_DAYS = 4 * 365
 
 
 class ApartmentBuilding(models.Model):
@@ -27,7 +38,6 @@ class Flat(models.Model):
     number_of_registered = models.PositiveIntegerField(default=1, verbose_name="Количество зарегистрированных лиц")
     area = models.DecimalField(max_digits=6, decimal_places=2, verbose_name='Площадь квартиры')
     apartment_building = models.ForeignKey(to=ApartmentBuilding, on_delete=models.CASCADE, verbose_name='Дом, где расположена квартира', related_name='flats')
-    calculations = models.JSONField(default=dict, blank=True, verbose_name="Расчеты")
     
     def __str__(self) -> str:
         return f'Квартира № {self.number}, по адресу: {self.apartment_building.address}'
@@ -53,15 +63,45 @@ class Tariff(models.Model):
     )
     tariff_type = models.CharField(max_length=124, choices=TYPE_TARIFF, verbose_name='Тип тарифа водоснабжения')
     price = models.DecimalField(max_digits=6, decimal_places=2, verbose_name='Стоимость одного кубического метра')
+    valid_from = models.DateField(verbose_name='Действует с')
+    # пустая дата окончания - тариф действует до начала действия следующего тарифа того же типа,
+    # цены на дату определяются по истории тарифов в tariffs.resolve_prices
+    valid_to = models.DateField(null=True, blank=True, verbose_name='Действует по')
 
     def __str__(self) -> str:
-        return f'Тип тарифа: {self.get_tariff_type_display()}. Стоимость одного кубического метра {self.price}'
+        return f'Тип тарифа: {self.get_tariff_type_display()}. Стоимость одного кубического метра {self.price}. Действует с {self.valid_from}'
+
+    def clean(self):
+        if self.valid_to and self.valid_to < self.valid_from:
+            raise ValidationError({'valid_to': 'Дата окончания действия тарифа раньше даты начала.'})
 
     class Meta():
+        constraints = [
+            models.UniqueConstraint(fields=['tariff_type', 'valid_from'], name='unique_tariff_type_from_date')
+        ]
+
         verbose_name = 'Тариф'
         verbose_name_plural = 'Тарифы'
 
 
+class AddDays(models.Func):
+    """
+    Дата плюс постоянное количество дней. Выражение допустимо в вычисляемом столбце: на PostgreSQL
+    date + integer дает дату, на SQLite - встроенная функция date
+    """
+    output_field = models.DateField()
+
+    def __init__(self, expression, days: int):
+        super().__init__(expression)
+        self.days = int(days)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template=f'(%(expressions)s + {self.days})', **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template=f"date(%(expressions)s, '+{self.days} days')", **extra_context)
+
+
 class WaterCounter(models.Model):
     """
     Class describing the fields of the "WaterCouner" object 
@@ -71,28 +111,317 @@ class WaterCounter(models.Model):
         ('cold', 'холодное'),
         ('hot', 'горячее'),
     )
-    serial_number = models.CharField(max_length=10, verbose_name='Серийный номер счетчика')
+    # серийный номер однозначно определяет счетчик, по нему принимаются показания
+    serial_number = models.CharField(max_length=10, unique=True, verbose_name='Серийный номер счетчика', error_messages={
+        'unique': 'Счетчик с таким серийным номером уже существует.',
+    })
     verification_date = models.DateField(verbose_name='Дата поверки')
     type_water_counter = models.CharField(max_length=8, choices=TYPE_COUNTER, verbose_name='Тип водоснабжения')
-    meters = models.JSONField(default=list, null=True, blank=True, verbose_name='Показания счетчика')
     flat = models.ForeignKey(to=Flat, on_delete=models.CASCADE, verbose_name='Квартира', related_name='water_counters')
+    # окончание срока поверки вычисляет бд при любой записи, в том числе bulk_create и update
+    expiration_date = models.GeneratedField(
+        expression=Case(
+            When(type_water_counter='cold', then=AddDays(F('verification_date'), COLD_WATER_VERIFICATION_DAYS)),
+            default=AddDays(F('verification_date'), HOT_WATER_VERIFICATION_DAYS),
+        ),
+        output_field=models.DateField(),
+        db_persist=True,
+        verbose_name='Поверка действует до',
+    )
 
-    MAX_METERS = 12 
+    def save(self, *args, **kwargs):
+        updating = not self._state.adding
+        super().save(*args, **kwargs)
+        if updating:
+            # бд возвращает вычисленный срок только при создании, после изменения он перечитывается при обращении
+            self.__dict__.pop('expiration_date', None)
 
-    def add_meters(self,  meter_reading_date: str, meter_reading_value: int, max_meters: int = MAX_METERS):
-        new_reading = {'meter_reading_date':  meter_reading_date, 'meter_reading_value': meter_reading_value}
-        self.meters.append(new_reading)
-        if len(self.meters) >  max_meters:
-            self.meters.pop(0)
-        self.save()
+    def add_meters(self,  meter_reading_date: str, meter_reading_value: int):
+        # повторная передача показаний в тот же день заменяет ранее переданное значение
+        MeterReading.objects.update_or_create(
+            counter=self,
+            reading_date=meter_reading_date,
+            defaults={'value': meter_reading_value},
+        )
 
     def __str__(self) -> str:
         return f'Счетчик воды № {self.serial_number}. Тип водоснабжения: {self.get_type_water_counter_display()}'
     
     class Meta():
-        constraints = [
-            models.UniqueConstraint(fields=['serial_number', 'flat'], name='unique_water_counter_in_flat')
+        indexes = [
+            # отчет об истекающей поверке читает диапазон индекса по всем счетчикам в порядке даты
+            models.Index(fields=['expiration_date', 'id'], name='counter_expiration_idx'),
         ]
 
         verbose_name = 'Счетчик'
         verbose_name_plural = 'Счетчики'
+
+
+def verification_expiration_date(type_water_counter: str, verification_date) -> datetime.date:
+    """
+    То же, что WaterCounter.expiration_date, для счетчиков, не записанных в бд
+    """
+    days = COLD_WATER_VERIFICATION_DAYS if type_water_counter == 'cold' else HOT_WATER_VERIFICATION_DAYS
+    return verification_date + datetime.timedelta(days=days)
+
+
+def first_day_of_next_month(year, month) -> datetime.date:
+    year, month = int(year), int(month)
+    last_day = calendar.monthrange(year, month)[1]
+    return datetime.date(year, month, last_day) + datetime.timedelta(days=1)
+
+
+class MeterReadingQuerySet(models.QuerySet):
+
+    def up_to_month(self, year, month):
+        """
+        Показания, переданные не позднее указанного месяца
+        """
+        return self.filter(reading_date__lt=first_day_of_next_month(year, month))
+
+    def last_per_counter(self, count: int):
+        """
+        Последние count показаний каждого счетчика одним запросом, в порядке даты передачи
+        """
+        return self.annotate(
+            position=Window(
+                expression=RowNumber(),
+                partition_by=[F('counter_id')],
+                order_by=F('reading_date').desc(),
+            )
+        ).filter(position__lte=count).order_by('counter_id', 'reading_date')
+
+    def last_up_to_month(self, year, month, count: int = 2):
+        """
+        Последние count показаний каждого счетчика на указанный месяц одним запросом, начиная с последнего.
+        Для ограничения выборки счетчиками используйте filter(counter__in=...) до вызова
+        """
+        return self.up_to_month(year, month).last_per_counter(count).order_by('counter_id', '-reading_date')
+
+
+class MeterReading(models.Model):
+    """
+    Class describing the fields of the "MeterReading" object 
+    in the database
+    """
+    counter = models.ForeignKey(to=WaterCounter, on_delete=models.CASCADE, verbose_name='Счетчик', related_name='readings')
+    reading_date = models.DateField(verbose_name='Дата передачи показаний')
+    value = models.IntegerField(verbose_name='Показания счетчика')
+
+    objects = MeterReadingQuerySet.as_manager()
+
+    def __str__(self) -> str:
+        return f'Показания {self.value} от {self.reading_date}'
+
+    class Meta():
+        constraints = [
+            models.UniqueConstraint(fields=['counter', 'reading_date'], name='unique_meter_reading_in_day')
+        ]
+        ordering = ['reading_date']
+
+        verbose_name = 'Показания счетчика'
+        verbose_name_plural = 'Показания счетчиков'
+
+
+class MonthlyCharge(models.Model):
+    """
+    Class describing the fields of the "MonthlyCharge" object 
+    in the database
+    """
+    flat = models.ForeignKey(to=Flat, on_delete=models.CASCADE, verbose_name='Квартира', related_name='charges')
+    # расчетный месяц в формате YYYY-MM
+    year_month = models.CharField(max_length=7, verbose_name='Расчетный месяц')
+    maintenance_of_common_property = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Содержание общего имущества')
+    cold_water_usage_price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Холодное водоснабжение')
+    hot_water_usage_price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Горячее водоснабжение')
+    # хотя бы один вид воды рассчитан по нормативу: нет счетчика, истек срок поверки или нет показаний за месяц
+    billed_by_norm = models.BooleanField(default=False, verbose_name='Рассчитано по нормативу')
+    # время последнего изменения показаний или данных квартиры и счетчиков, после которого начисление нужно пересчитать
+    stale_since = models.DateTimeField(null=True, blank=True, verbose_name='Требует перерасчета с')
+
+    def __str__(self) -> str:
+        return f'Начисления за {self.year_month}'
+
+    class Meta():
+        constraints = [
+            models.UniqueConstraint(fields=['flat', 'year_month'], name='unique_charge_for_flat_in_month')
+        ]
+        indexes = [
+            # частичный индекс только по устаревшим начислениям, их немного по сравнению со всеми начислениями
+            models.Index(fields=['year_month', 'flat'], condition=Q(stale_since__isnull=False), name='stale_charge_idx'),
+        ]
+
+        verbose_name = 'Начисление'
+        verbose_name_plural = 'Начисления'
+
+
+class BuildingMonthlySummary(models.Model):
+    """
+    Class describing the fields of the "BuildingMonthlySummary" object 
+    in the database
+    """
+    apartment_building = models.ForeignKey(
+        to=ApartmentBuilding, on_delete=models.CASCADE, verbose_name='Дом', related_name='monthly_summaries'
+    )
+    # расчетный месяц в формате YYYY-MM
+    year_month = models.CharField(max_length=7, verbose_name='Расчетный месяц')
+    maintenance_of_common_property = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Содержание общего имущества')
+    cold_water_usage_price = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Холодное водоснабжение')
+    hot_water_usage_price = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name='Горячее водоснабжение')
+    flats_billed = models.IntegerField(default=0, verbose_name='Квартир с начислениями')
+    flats_billed_by_norm = models.IntegerField(default=0, verbose_name='Квартир, рассчитанных по нормативу')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлена')
+
+    def __str__(self) -> str:
+        return f'Начисления дома за {self.year_month}'
+
+    @property
+    def flats_billed_by_meter(self):
+        return self.flats_billed - self.flats_billed_by_norm
+
+    @property
+    def total(self):
+        return self.maintenance_of_common_property + self.cold_water_usage_price + self.hot_water_usage_price
+
+    class Meta():
+        constraints = [
+            models.UniqueConstraint(fields=['apartment_building', 'year_month'], name='unique_summary_for_building_in_month')
+        ]
+
+        verbose_name = 'Итоги начислений дома'
+        verbose_name_plural = 'Итоги начислений домов'
+
+
+class ReadingImport(models.Model):
+    """
+    Class describing the fields of the "ReadingImport" object 
+    in the database
+    """
+    FORMAT = (
+        ('csv', 'CSV'),
+        ('xlsx', 'XLSX'),
+    )
+    STATUS = (
+        ('pending', 'ожидает'),
+        ('running', 'выполняется'),
+        ('done', 'завершен'),
+        ('failed', 'ошибка'),
+    )
+    file_path = models.CharField(max_length=512, verbose_name='Файл показаний')
+    file_format = models.CharField(max_length=8, choices=FORMAT, verbose_name='Формат файла')
+    status = models.CharField(max_length=16, choices=STATUS, default='pending', verbose_name='Статус')
+    # количество обработанных строк файла, зафиксированных в бд вместе с показаниями
+    offset = models.PositiveIntegerField(default=0, verbose_name='Обработано строк')
+    saved = models.PositiveIntegerField(default=0, verbose_name='Записано показаний')
+    failed = models.PositiveIntegerField(default=0, verbose_name='Строк с ошибками')
+    errors = models.JSONField(default=list, blank=True, verbose_name='Ошибки в строках')
+    error_message = models.TextField(blank=True, verbose_name='Ошибка загрузки')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлена')
+
+    def __str__(self) -> str:
+        return f'Загрузка показаний {self.file_path}: {self.get_status_display()}'
+
+    class Meta():
+        verbose_name = 'Загрузка показаний'
+        verbose_name_plural = 'Загрузки показаний'
+
+
+class CalculationCheckpoint(models.Model):
+    """
+    Class describing the fields of the "CalculationCheckpoint" object 
+    in the database
+    """
+    STATUS = (
+        ('running', 'выполняется'),
+        ('done', 'завершен'),
+        ('failed', 'ошибка'),
+    )
+    job_id = models.CharField(max_length=64, verbose_name='Задание расчета')
+    apartment_building = models.ForeignKey(
+        to=ApartmentBuilding, on_delete=models.CASCADE, verbose_name='Дом', related_name='calculation_checkpoints'
+    )
+    # расчетный месяц в формате YYYY-MM
+    year_month = models.CharField(max_length=7, verbose_name='Расчетный месяц')
+    status = models.CharField(max_length=16, choices=STATUS, default='running', verbose_name='Статус')
+    # квартиры рассчитываются по возрастанию ID, ID последней квартиры фиксируется в бд вместе с ее пакетом начислений
+    last_flat_id = models.BigIntegerField(default=0, verbose_name='Последняя рассчитанная квартира')
+    calculated = models.PositiveIntegerField(default=0, verbose_name='Рассчитано квартир')
+    error_message = models.TextField(blank=True, verbose_name='Ошибка расчета')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлен')
+
+    def __str__(self) -> str:
+        return f'Расчет {self.job_id} за {self.year_month}: {self.get_status_display()}'
+
+    class Meta():
+        constraints = [
+            # в пакетном расчете одно задание рассчитывает несколько домов
+            models.UniqueConstraint(fields=['job_id', 'apartment_building'], name='unique_checkpoint_for_building_in_job')
+        ]
+        verbose_name = 'Контрольная точка расчета'
+        verbose_name_plural = 'Контрольные точки расчета'
+
+
+class CalculationJob(models.Model):
+    """
+    Class describing the fields of the "CalculationJob" object 
+    in the database
+    """
+    STATUS = (
+        ('pending', 'в очереди'),
+        ('running', 'выполняется'),
+        ('done', 'завершен'),
+        ('failed', 'ошибка'),
+    )
+    ACTIVE_STATUSES = ('pending', 'running')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    apartment_building = models.ForeignKey(
+        to=ApartmentBuilding, on_delete=models.CASCADE, verbose_name='Дом', related_name='calculation_jobs'
+    )
+    # расчетный месяц в формате YYYY-MM
+    year_month = models.CharField(max_length=7, verbose_name='Расчетный месяц')
+    status = models.CharField(max_length=16, choices=STATUS, default='pending', verbose_name='Статус')
+    total_flats = models.PositiveIntegerField(null=True, blank=True, verbose_name='Квартир в доме')
+    calculated = models.PositiveIntegerField(default=0, verbose_name='Рассчитано квартир')
+    error_message = models.TextField(blank=True, verbose_name='Ошибка расчета')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создан')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Начало расчета')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Окончание расчета')
+
+    def __str__(self) -> str:
+        return f'Расчет {self.id} за {self.year_month}: {self.get_status_display()}'
+
+    @property
+    def queue_seconds(self):
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.created_at).total_seconds()
+
+    @property
+    def duration_seconds(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
+
+    @property
+    def flats_per_second(self):
+        if not self.duration_seconds:
+            return None
+        return round(self.calculated / self.duration_seconds, 2)
+
+    class Meta():
+        constraints = [
+            # для дома и месяца одновременно выполняется не больше одного расчета
+            models.UniqueConstraint(
+                fields=['apartment_building', 'year_month'],
+                condition=Q(status__in=('pending', 'running')),
+                name='unique_active_calculation_job',
+            )
+        ]
+        indexes = [
+            models.Index(fields=['apartment_building', 'created_at'], name='calculation_job_building_idx'),
+        ]
+        verbose_name = 'Задание расчета'
+        verbose_name_plural = 'Задания расчета'
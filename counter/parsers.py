@@ -0,0 +1,29 @@
+import json
+
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Разбор потока NDJSON: по одному объекту JSON в строке. Строки читаются по мере обработки,
+    поэтому тело запроса не загружается в память целиком. Строка с некорректным JSON
+    передается дальше как исключение ValueError, чтобы ошибка попала в отчет по этой строке
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', 'utf-8')
+        if stream is None:
+            return iter(())
+        return self.iter_lines(stream, encoding)
+
+    def iter_lines(self, stream, encoding):
+        for line in stream:
+            line = line.decode(encoding).strip() if isinstance(line, bytes) else line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield ValueError(f'Некорректный JSON: {e}')
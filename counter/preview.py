@@ -0,0 +1,101 @@
+import datetime
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .calculator import calculate_flat_payment, get_tariffs, to_price, with_water_counters
+from .models import Flat, WaterCounter
+from .tariffs import tariff_provider
+
+
+"""
+Предварительный расчет начислений дома за месяц без записи в бд. Результат кешируется по ключу
+calculation_preview:{apartment_building_id}:{year_month}:{версия тарифов}:{версия данных дома}:{дата расчета}.
+Версия данных дома (building_data_version:{apartment_building_id}) меняется при изменении показаний,
+счетчиков и квартир дома, поэтому устаревшие результаты не используются и удаляются по истечении
+CALCULATION_PREVIEW_TTL. Дата расчета входит в ключ, так как поверка счетчиков проверяется на дату расчета
+"""
+def data_version_key(apartment_building_id: int):
+    return f"building_data_version:{apartment_building_id}"
+
+
+def get_data_version(apartment_building_id: int) -> str:
+    cache_key = data_version_key(apartment_building_id)
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(cache_key)
+    return version
+
+
+def bump_data_version(*apartment_building_ids):
+    cache.set_many({data_version_key(building_id): uuid.uuid4().hex for building_id in apartment_building_ids}, timeout=None)
+
+
+def bump_data_version_on_commit(*apartment_building_ids):
+    # версия меняется после фиксации транзакции, иначе предварительный расчет может закешировать старые данные под новой версией
+    apartment_building_ids = set(apartment_building_ids) - {None}
+    if apartment_building_ids:
+        transaction.on_commit(lambda: bump_data_version(*apartment_building_ids))
+
+
+def bump_counters_data_version(counter_ids):
+    apartment_building_ids = (
+        WaterCounter.objects.filter(id__in=counter_ids).values_list('flat__apartment_building_id', flat=True).distinct()
+    )
+    bump_data_version_on_commit(*apartment_building_ids)
+
+
+def bump_flats_data_version(flat_ids):
+    bump_data_version_on_commit(*Flat.objects.filter(id__in=flat_ids).values_list('apartment_building_id', flat=True).distinct())
+
+
+def preview_payment(apartment_building_id: int, year: str, month: str) -> dict:
+    current_date = datetime.date.today()
+    year_month_key = f"{year}-{month.zfill(2)}"
+    cache_key = ':'.join([
+        'calculation_preview',
+        str(apartment_building_id),
+        year_month_key,
+        tariff_provider.get_version(),
+        get_data_version(apartment_building_id),
+        current_date.isoformat(),
+    ])
+
+    preview = cache.get(cache_key)
+    if preview is not None:
+        return {**preview, 'cached': True}
+
+    preview = calculate_preview(apartment_building_id, year, month, current_date)
+    cache.set(cache_key, preview, timeout=settings.CALCULATION_PREVIEW_TTL)
+    return {**preview, 'cached': False}
+
+
+def calculate_preview(apartment_building_id: int, year: str, month: str, current_date: datetime.date) -> dict:
+    """
+    Расчет по тем же правилам, что и calculator_payment, для всех квартир дома, включая уже рассчитанные
+    """
+    tariffs = get_tariffs(year, month)
+    flats = with_water_counters(Flat.objects.filter(apartment_building_id=apartment_building_id).order_by('number'), year, month)
+
+    charges = []
+    for flat in flats:
+        prices = [to_price(price) for price in calculate_flat_payment(flat, tariffs, current_date, year, month)]
+        charges.append({
+            'flat_id': flat.id,
+            'flat_number': flat.number,
+            'maintenance_of_common_property': prices[0],
+            'cold_water_usage_price': prices[1],
+            'hot_water_usage_price': prices[2],
+        })
+
+    fields = ('maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price')
+    return {
+        'apartment_building_id': apartment_building_id,
+        'year_month': f"{year}-{month.zfill(2)}",
+        'flats': charges,
+        'total': {field: sum((charge[field] for charge in charges), Decimal('0.00')) for field in fields},
+    }
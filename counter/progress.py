@@ -0,0 +1,221 @@
+import json
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+
+"""
+Прогресс расчета хранится в кеше по ключам задания расчета и дома:
+- calculation_progress:{job_id}:{apartment_building_id} - количество квартир, время начала и окончания расчета
+- calculation_progress:{job_id}:{apartment_building_id}:completed - счетчик рассчитанных квартир,
+  увеличивается атомарно (INCRBY) один раз на пакет квартир
+- calculation_progress:{apartment_building_id}:current_job - последнее задание расчета дома
+Ключи живут CALCULATION_PROGRESS_TTL, после окончания расчета - CALCULATION_PROGRESS_FINISHED_TTL.
+При каждом изменении прогресса в Redis публикуется сообщение с job_id и ID дома в каналы
+calculation_progress:events:{apartment_building_id} и calculation_job:events:{job_id}, на них подписывается
+поток событий прогресса (streams.py). Само состояние в сообщении не передается и читается из кеша.
+"""
+def progress_key(job_id: str, apartment_building_id: int):
+    return f"calculation_progress:{job_id}:{apartment_building_id}"
+
+
+def current_job_key(apartment_building_id: int):
+    return f"calculation_progress:{apartment_building_id}:current_job"
+
+
+def job_key(job_id: str):
+    return f"calculation_job:{job_id}"
+
+
+def building_channel(apartment_building_id: int):
+    return f"calculation_progress:events:{apartment_building_id}"
+
+
+def job_channel(job_id: str):
+    return f"calculation_job:events:{job_id}"
+
+
+def publish_progress(job_id: str, apartment_building_id: int = None):
+    """
+    Сообщение об изменении прогресса дома (или пакетного задания без apartment_building_id)
+    """
+    try:
+        client = get_redis_connection('default')
+    except NotImplementedError:
+        # кеш без Redis (локальный запуск, тесты) - подписчиков нет
+        return
+    message = json.dumps({'job_id': str(job_id), 'apartment_building_id': apartment_building_id})
+    pipeline = client.pipeline(transaction=False)
+    if apartment_building_id is not None:
+        pipeline.publish(building_channel(apartment_building_id), message)
+    pipeline.publish(job_channel(job_id), message)
+    pipeline.execute()
+
+
+def initialize_progress(job_id: str, apartment_building_id: int, total_flats: int, completed: int = 0):
+    cache_key = progress_key(job_id, apartment_building_id)
+    cache.set_many({
+        cache_key: {
+            'total': total_flats,
+            'initial_completed': completed,
+            'started_at': time.time(),
+            'finished_at': None,
+        },
+        f"{cache_key}:completed": completed,
+        current_job_key(apartment_building_id): job_id,
+    }, timeout=settings.CALCULATION_PROGRESS_TTL)
+    publish_progress(job_id, apartment_building_id)
+
+
+def update_progress(job_id: str, apartment_building_id: int, completed: int = 1):
+    if not completed:
+        return
+    # атомарное увеличение счетчика, квартиры одного дома могут рассчитываться в нескольких процессах
+    try:
+        cache.incr(f"{progress_key(job_id, apartment_building_id)}:completed", completed)
+    except ValueError:
+        return
+    publish_progress(job_id, apartment_building_id)
+
+
+def finish_progress(job_id: str, apartment_building_id: int):
+    cache_key = progress_key(job_id, apartment_building_id)
+    progress = cache.get(cache_key)
+    if progress is None:
+        return
+    progress['finished_at'] = time.time()
+    cache.set(cache_key, progress, timeout=settings.CALCULATION_PROGRESS_FINISHED_TTL)
+    cache.touch(f"{cache_key}:completed", timeout=settings.CALCULATION_PROGRESS_FINISHED_TTL)
+    publish_progress(job_id, apartment_building_id)
+
+
+def get_calculation_progress(apartment_building_id: int, job_id: str = None):
+    if job_id is None:
+        job_id = cache.get(current_job_key(apartment_building_id))
+    if job_id is None:
+        return {"status": "error", "message": "No progress found."}
+
+    cache_key = progress_key(job_id, apartment_building_id)
+    progress = cache.get_many([cache_key, f"{cache_key}:completed"])
+    if cache_key not in progress:
+        return {"status": "error", "message": "No progress found."}
+
+    return format_progress(job_id, progress[cache_key], progress.get(f"{cache_key}:completed", 0))
+
+
+async def aget_calculation_progress(apartment_building_id: int, job_id: str = None):
+    """
+    То же, что get_calculation_progress, для асинхронных представлений
+    """
+    if job_id is None:
+        job_id = await cache.aget(current_job_key(apartment_building_id))
+    if job_id is None:
+        return {"status": "error", "message": "No progress found."}
+
+    cache_key = progress_key(job_id, apartment_building_id)
+    progress = await cache.aget_many([cache_key, f"{cache_key}:completed"])
+    if cache_key not in progress:
+        return {"status": "error", "message": "No progress found."}
+
+    return format_progress(job_id, progress[cache_key], progress.get(f"{cache_key}:completed", 0))
+
+
+def format_progress(job_id: str, progress: dict, completed: int):
+    total = progress['total']
+    # повторно запущенная часть дома может учесть уже рассчитанные квартиры еще раз
+    completed = min(completed, total)
+    finished_at = progress['finished_at']
+    elapsed = max((finished_at or time.time()) - progress['started_at'], 0.001)
+    rate = (completed - progress['initial_completed']) / elapsed
+
+    if completed >= total:
+        eta = 0
+    elif rate > 0:
+        eta = round((total - completed) / rate, 1)
+    else:
+        eta = None
+
+    return {
+        'job_id': job_id,
+        'total': total,
+        'completed': completed,
+        'started_at': to_isoformat(progress['started_at']),
+        'finished_at': to_isoformat(finished_at),
+        'rate': round(rate, 2),
+        'eta_seconds': eta,
+    }
+
+
+def to_isoformat(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+def initialize_job_progress(job_id: str, building_jobs: dict, year_month_key: str, skipped: dict = None):
+    """
+    building_jobs - дома пакета и ID их заданий расчета, по которым ведется прогресс домов.
+    skipped - дома, пропущенные пакетом, и ID заданий, которыми они уже рассчитываются
+    """
+    cache_key = job_key(job_id)
+    cache.set_many({
+        cache_key: {
+            'apartment_building_ids': list(building_jobs),
+            'building_jobs': building_jobs,
+            'skipped': skipped or {},
+            'year_month': year_month_key,
+            'started_at': time.time(),
+        },
+        f"{cache_key}:completed_buildings": 0,
+        f"{cache_key}:failed_buildings": 0,
+        f"{cache_key}:calculated_flats": 0,
+    }, timeout=settings.CALCULATION_PROGRESS_TTL)
+
+
+def update_job_progress(job_id: str, result: dict):
+    cache_key = job_key(job_id)
+    cache.incr(f"{cache_key}:completed_buildings")
+    if result['status'] == 'error':
+        cache.incr(f"{cache_key}:failed_buildings")
+    else:
+        cache.incr(f"{cache_key}:calculated_flats", result['calculated'])
+    publish_progress(job_id)
+
+
+def get_job_progress(job_id: str, buildings: bool = True):
+    cache_key = job_key(job_id)
+    counters = [f"{cache_key}:completed_buildings", f"{cache_key}:failed_buildings", f"{cache_key}:calculated_flats"]
+    progress = cache.get_many([cache_key, *counters])
+    if cache_key not in progress:
+        return {"status": "error", "message": "No progress found."}
+
+    job = progress[cache_key]
+    completed_buildings, failed_buildings, calculated_flats = (progress.get(key, 0) for key in counters)
+    elapsed = max(time.time() - job['started_at'], 0.001)
+
+    result = {
+        'job_id': job_id,
+        'year_month': job['year_month'],
+        'total_buildings': len(job['apartment_building_ids']),
+        'skipped_buildings': job.get('skipped', {}),
+        'completed_buildings': completed_buildings,
+        'failed_buildings': failed_buildings,
+        'calculated_flats': calculated_flats,
+        'started_at': to_isoformat(job['started_at']),
+        'elapsed_seconds': round(elapsed, 3),
+        'flats_per_second': round(calculated_flats / elapsed, 2),
+    }
+    if not buildings:
+        return result
+
+    building_jobs = job['building_jobs']
+    building_keys = {progress_key(building_job_id, building_id): building_id for building_id, building_job_id in building_jobs.items()}
+    buildings_progress = cache.get_many([*building_keys, *(f"{key}:completed" for key in building_keys)])
+    result['buildings'] = {
+        building_id: format_progress(building_jobs[building_id], buildings_progress[key], buildings_progress.get(f"{key}:completed", 0))
+        for key, building_id in building_keys.items() if key in buildings_progress
+    }
+    return result
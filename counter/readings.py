@@ -0,0 +1,126 @@
+import datetime
+
+from django.db import transaction
+
+from .models import MeterReading, WaterCounter
+from .preview import bump_counters_data_version
+from .serials import resolve_serial_numbers
+from .stale import mark_readings_stale
+
+
+# количество показаний, которые проверяются и записываются в бд одним пакетом
+READINGS_BATCH_SIZE = 5000
+
+
+def ingest_readings(items, batch_size: int = READINGS_BATCH_SIZE):
+    """
+    Пакетная запись показаний. items - последовательность словарей с полями serial_number,
+    meter_reading_value и необязательным meter_reading_date (по умолчанию - сегодня).
+    Серийные номера каждого пакета разрешаются одним запросом, показания записываются одним запросом
+    с заменой ранее переданных в тот же день. Возвращает результат по каждому элементу
+    """
+    results = []
+    batch = []
+    for index, item in enumerate(items):
+        batch.append((index, item))
+        if len(batch) >= batch_size:
+            results.extend(save_readings_batch(batch))
+            batch = []
+    if batch:
+        results.extend(save_readings_batch(batch))
+    return results
+
+
+def save_readings_batch(batch, counters: dict = None):
+    """
+    Проверка и запись пакета показаний. counters - заранее построенный индекс серийных номеров,
+    без него номера пакета разрешаются одним запросом
+    """
+    today = datetime.date.today()
+    results = {}
+    validated = []
+    for index, item in batch:
+        reading, errors = validate_reading(item, today)
+        if errors:
+            results[index] = {'index': index, 'status': 'error', 'errors': errors}
+        else:
+            validated.append((index, reading))
+
+    if counters is None:
+        counters = resolve_counters({reading['serial_number'] for _, reading in validated})
+
+    # повторные показания одного счетчика за один день в пакете: записывается последнее
+    readings = {}
+    for index, reading in validated:
+        counter_id = counters.get(reading['serial_number'])
+        if counter_id is None:
+            results[index] = {'index': index, 'status': 'error', 'errors': ['Счетчик с указанным серийным номером не существует.']}
+            continue
+        readings[(counter_id, reading['meter_reading_date'])] = MeterReading(
+            counter_id=counter_id,
+            reading_date=reading['meter_reading_date'],
+            value=reading['meter_reading_value'],
+        )
+        results[index] = {'index': index, 'status': 'success', 'serial_number': reading['serial_number']}
+
+    with transaction.atomic():
+        write_readings(readings.values())
+
+    return [results[index] for index, _ in batch]
+
+
+def write_readings(readings):
+    readings = list(readings)
+    MeterReading.objects.bulk_create(
+        readings,
+        update_conflicts=True,
+        unique_fields=['counter', 'reading_date'],
+        update_fields=['value'],
+    )
+    # уже рассчитанные начисления за месяцы показаний и последующие отмечаются для перерасчета
+    mark_readings_stale((reading.counter_id, reading.reading_date) for reading in readings)
+    if readings:
+        bump_counters_data_version({reading.counter_id for reading in readings})
+
+
+def validate_reading(item, today: datetime.date):
+    if isinstance(item, Exception):
+        return None, [str(item)]
+    if not isinstance(item, dict):
+        return None, ['Ожидается объект с полями serial_number и meter_reading_value.']
+
+    errors = []
+    serial_number = item.get('serial_number')
+    if not isinstance(serial_number, str) or not serial_number or len(serial_number) > 10:
+        errors.append('serial_number: ожидается строка длиной от 1 до 10 символов.')
+
+    value = item.get('meter_reading_value')
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        errors.append('meter_reading_value: ожидается неотрицательное целое число.')
+
+    reading_date = item.get('meter_reading_date')
+    if reading_date is None:
+        reading_date = today
+    else:
+        try:
+            reading_date = datetime.date.fromisoformat(reading_date)
+        except (TypeError, ValueError):
+            errors.append("meter_reading_date: ожидается дата в формате 'YYYY-MM-DD'.")
+        else:
+            if reading_date > today:
+                errors.append('meter_reading_date: дата показаний не может быть в будущем.')
+
+    if errors:
+        return None, errors
+    return {'serial_number': serial_number, 'meter_reading_value': value, 'meter_reading_date': reading_date}, []
+
+
+def resolve_counters(serial_numbers) -> dict:
+    return {serial_number: counter['id'] for serial_number, counter in resolve_serial_numbers(serial_numbers).items()}
+
+
+def build_counter_index() -> dict:
+    """
+    Индекс серийный номер -> ID счетчика по всем счетчикам, строится одним запросом
+    """
+    return dict(WaterCounter.objects.values_list('serial_number', 'id').iterator(chunk_size=10000))
@@ -1,22 +1,59 @@
 import datetime
 import re
 
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema_field
 from rest_framework import serializers
-from .models import ApartmentBuilding, Flat, WaterCounter
+from .export import EXPORT_FORMATS
+from .imports import ImportFormatError, detect_format
+from .progress import get_calculation_progress
+from .readings import write_readings
+from .serials import get_counter_by_serial
+from .models import ApartmentBuilding, BuildingMonthlySummary, CalculationJob, Flat, MeterReading, MonthlyCharge, ReadingImport, WaterCounter
+
+
+class MeterReadingDataSerializer(serializers.ModelSerializer):
+    meter_reading_date = serializers.DateField(source='reading_date')
+    meter_reading_value = serializers.IntegerField(source='value')
+
+    class Meta:
+        model = MeterReading
+        fields = ['meter_reading_date', 'meter_reading_value']
 
 
 class WaterCounterSerializer(serializers.ModelSerializer):
+    meters = MeterReadingDataSerializer(source='readings', many=True, read_only=True)
+
     class Meta:
         model = WaterCounter
         fields = ['serial_number', 'verification_date', 'type_water_counter', 'meters']
 
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.context.get('include_meters', True):
+            fields.pop('meters')
+        return fields
+
+
+class MonthlyChargeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MonthlyCharge
+        fields = ['year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price']
+
 
 class FlatSerializer(serializers.ModelSerializer):
     water_counters = WaterCounterSerializer(many=True)
+    charges = MonthlyChargeSerializer(many=True, read_only=True)
 
     class Meta:
         model = Flat
-        fields = ['number', 'number_of_registered', 'area', 'water_counters']
+        fields = ['number', 'number_of_registered', 'area', 'water_counters', 'charges']
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.context.get('include_charges', False):
+            fields.pop('charges')
+        return fields
 
 
 class ApartmentBuildingSerializer(serializers.ModelSerializer):
@@ -26,6 +63,12 @@ class ApartmentBuildingSerializer(serializers.ModelSerializer):
         model = ApartmentBuilding
         fields = ['total_area', 'address', 'flats']
 
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.context.get('include_flats', True):
+            fields.pop('flats')
+        return fields
+
 
 class ApartmentBuildingCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -89,33 +132,44 @@ class MeterReadingSerializer(serializers.Serializer):
     meter_reading_value = serializers.IntegerField()
 
     def validate(self, data):
-        serial_number = data.get('serial_number')
-        try:
-            water_counter = WaterCounter.objects.get(serial_number=serial_number)
-            data['water_counter'] = water_counter
-        except WaterCounter.DoesNotExist:
+        water_counter = get_counter_by_serial(data.get('serial_number'))
+        if water_counter is None:
             raise serializers.ValidationError("Water counter with the specified serial number does not exist.")
+        data['water_counter_id'] = water_counter['id']
         return data
 
     def create(self, validated_data):
-        water_counter = validated_data['water_counter']
         meter_reading_value = validated_data['meter_reading_value']
-        meter_reading_date = datetime.date.today().strftime('%Y-%m-%d')  # Use today's date as meter reading date
+        # та же запись с заменой показаний за день, что и при пакетной передаче
+        write_readings([MeterReading(
+            counter_id=validated_data['water_counter_id'],
+            reading_date=datetime.date.today(),
+            value=meter_reading_value,
+        )])
+        return {'serial_number': validated_data['serial_number'], 'meter_reading_value': meter_reading_value}
 
-        water_counter.add_meters(meter_reading_date, meter_reading_value)
-        return {'serial_number': water_counter.serial_number, 'meter_reading_value': meter_reading_value}
 
+class ReadingImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ReadingImport
+        fields = ['id', 'file_format', 'status', 'offset', 'saved', 'failed', 'errors', 'error_message', 'created_at', 'updated_at']
 
-class CalculatorPaymentSerializer(serializers.Serializer):
-    apartment_building_id = serializers.IntegerField()
-    year = serializers.CharField(max_length=4)
-    month = serializers.CharField(max_length=2)
 
-    def validate_apartment_building_id(self, value):
-        if not ApartmentBuilding.objects.filter(id=value).exists():
-            raise serializers.ValidationError("Дом с указанным ID не существует.")
+class ReadingImportCreateSerializer(serializers.Serializer):
+    file = serializers.FileField()
+
+    def validate_file(self, value):
+        try:
+            detect_format(value.name)
+        except ImportFormatError as e:
+            raise serializers.ValidationError(str(e))
         return value
 
+
+class CalculationPeriodSerializer(serializers.Serializer):
+    year = serializers.CharField(max_length=4)
+    month = serializers.CharField(max_length=2)
+
     def validate_year(self, value):
         if not re.match(r'^\d{4}$', value):
             raise serializers.ValidationError("Год должен быть в формате 'YYYY'.")
@@ -127,3 +181,100 @@ class CalculatorPaymentSerializer(serializers.Serializer):
         if not re.match(r'^(0[1-9]|1[0-2])$', value):
             raise serializers.ValidationError("Месяц должен быть в формате 'MM' (01-12).")
         return value
+
+
+class CalculatorPaymentSerializer(CalculationPeriodSerializer):
+    apartment_building_id = serializers.IntegerField()
+
+    def validate_apartment_building_id(self, value):
+        if not ApartmentBuilding.objects.filter(id=value).exists():
+            raise serializers.ValidationError("Дом с указанным ID не существует.")
+        return value
+
+
+class CalculationJobSerializer(serializers.ModelSerializer):
+    apartment_building_id = serializers.IntegerField(read_only=True)
+    queue_seconds = serializers.FloatField(read_only=True, help_text='Время ожидания в очереди')
+    duration_seconds = serializers.FloatField(read_only=True, help_text='Время расчета')
+    flats_per_second = serializers.FloatField(read_only=True)
+    progress = serializers.SerializerMethodField(help_text='Прогресс выполняющегося расчета')
+
+    class Meta:
+        model = CalculationJob
+        fields = ['id', 'apartment_building_id', 'year_month', 'status', 'total_flats', 'calculated', 'error_message',
+                  'created_at', 'started_at', 'finished_at', 'queue_seconds', 'duration_seconds', 'flats_per_second', 'progress']
+
+    @extend_schema_field(OpenApiTypes.OBJECT)
+    def get_progress(self, obj):
+        if obj.status != 'running':
+            return None
+        progress = get_calculation_progress(obj.apartment_building_id, str(obj.id))
+        return None if progress.get('status') == 'error' else progress
+
+
+class ExpiringWaterCounterSerializer(serializers.ModelSerializer):
+    flat_number = serializers.IntegerField(source='flat.number', read_only=True)
+    apartment_building_id = serializers.IntegerField(source='flat.apartment_building_id', read_only=True)
+    address = serializers.CharField(source='flat.apartment_building.address', read_only=True)
+    expired = serializers.SerializerMethodField(help_text='Срок поверки уже истек')
+
+    class Meta:
+        model = WaterCounter
+        fields = ['id', 'serial_number', 'type_water_counter', 'verification_date', 'expiration_date', 'expired',
+                  'flat_number', 'apartment_building_id', 'address']
+
+    def get_expired(self, obj) -> bool:
+        return obj.expiration_date < datetime.date.today()
+
+
+class BuildingMonthlySummarySerializer(serializers.ModelSerializer):
+    apartment_building_id = serializers.IntegerField(read_only=True)
+    flats_billed_by_meter = serializers.IntegerField(read_only=True, help_text='Квартир, рассчитанных по счетчикам')
+    total = serializers.DecimalField(max_digits=16, decimal_places=2, read_only=True, help_text='Всего начислено')
+
+    class Meta:
+        model = BuildingMonthlySummary
+        fields = ['apartment_building_id', 'year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price',
+                  'total', 'flats_billed', 'flats_billed_by_norm', 'flats_billed_by_meter', 'updated_at']
+
+
+class CalculatorBatchPaymentSerializer(CalculationPeriodSerializer):
+    apartment_building_ids = serializers.JSONField(help_text='Список ID домов или "all" для расчета всех домов')
+
+    def validate_apartment_building_ids(self, value):
+        if value == 'all':
+            return value
+        if not isinstance(value, list) or not value or not all(isinstance(item, int) for item in value):
+            raise serializers.ValidationError("Передайте непустой список ID домов или \"all\".")
+
+        apartment_building_ids = list(dict.fromkeys(value))
+        existing = set(ApartmentBuilding.objects.filter(id__in=apartment_building_ids).values_list('id', flat=True))
+        missing = [item for item in apartment_building_ids if item not in existing]
+        if missing:
+            raise serializers.ValidationError(f"Дома с ID {', '.join(map(str, missing))} не существуют.")
+        return apartment_building_ids
+
+
+class ChargeExportSerializer(serializers.Serializer):
+    apartment_building_id = serializers.ListField(child=serializers.IntegerField(), required=False,
+                                                  help_text='ID домов, без указания - все дома')
+    month_from = serializers.CharField(required=False, help_text='Первый месяц в формате YYYY-MM')
+    month_to = serializers.CharField(required=False, help_text='Последний месяц в формате YYYY-MM')
+    # параметр format занят DRF для выбора формата ответа
+    file_format = serializers.ChoiceField(choices=list(EXPORT_FORMATS), default='csv')
+
+    def validate_month_from(self, value):
+        return self.validate_year_month(value)
+
+    def validate_month_to(self, value):
+        return self.validate_year_month(value)
+
+    def validate_year_month(self, value):
+        if not re.match(r'^\d{4}-(0[1-9]|1[0-2])$', value):
+            raise serializers.ValidationError("Месяц должен быть в формате 'YYYY-MM'.")
+        return value
+
+    def validate(self, data):
+        if data.get('month_from') and data.get('month_to') and data['month_from'] > data['month_to']:
+            raise serializers.ValidationError("Первый месяц периода позже последнего.")
+        return data
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import WaterCounter
+
+
+"""
+Определение счетчика по серийному номеру. Данные счетчика (ID, квартира, тип водоснабжения, дата поверки)
+кешируются по ключу water_counter_serial:{serial_number} на SERIAL_NUMBER_CACHE_TTL и сбрасываются
+сигналами при изменении или удалении счетчика. Изменения через QuerySet.update() сигналов не вызывают,
+после них ключи нужно сбросить через invalidate_serial_numbers
+"""
+COUNTER_FIELDS = ('id', 'flat_id', 'type_water_counter', 'verification_date')
+
+
+def serial_key(serial_number: str):
+    return f"water_counter_serial:{serial_number}"
+
+
+def resolve_serial_numbers(serial_numbers) -> dict:
+    """
+    Серийный номер -> данные счетчика. Номера, которых нет в кеше, читаются из бд одним запросом,
+    несуществующие номера в результат не попадают
+    """
+    keys = {serial_key(serial_number): serial_number for serial_number in serial_numbers}
+    cached = cache.get_many(keys)
+    counters = {keys[key]: counter for key, counter in cached.items()}
+
+    missing = [serial_number for key, serial_number in keys.items() if key not in cached]
+    if missing:
+        found = {
+            counter.pop('serial_number'): counter
+            for counter in WaterCounter.objects.filter(serial_number__in=missing).values('serial_number', *COUNTER_FIELDS)
+        }
+        cache.set_many({serial_key(serial_number): counter for serial_number, counter in found.items()},
+                       timeout=settings.SERIAL_NUMBER_CACHE_TTL)
+        counters.update(found)
+
+    return counters
+
+
+def get_counter_by_serial(serial_number: str):
+    return resolve_serial_numbers([serial_number]).get(serial_number)
+
+
+def invalidate_serial_numbers(*serial_numbers):
+    cache.delete_many([serial_key(serial_number) for serial_number in serial_numbers if serial_number])
@@ -0,0 +1,109 @@
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import ApartmentBuilding, Flat, MeterReading, Tariff, WaterCounter
+from .preview import bump_counters_data_version, bump_data_version_on_commit, bump_flats_data_version
+from .serials import invalidate_serial_numbers
+from .stale import mark_flats_stale, mark_readings_stale
+from .summary import subtract_flat_charges
+from .tariffs import bump_tariffs_version
+
+
+# поля счетчика и квартиры, от которых зависит расчет начислений
+COUNTER_CALCULATION_FIELDS = ('verification_date', 'type_water_counter', 'flat_id')
+FLAT_CALCULATION_FIELDS = ('number_of_registered', 'area')
+
+
+@receiver([post_save, post_delete], sender=Tariff)
+def invalidate_tariffs(sender, **kwargs):
+    # версия меняется после фиксации транзакции, чтобы воркеры не перечитали старые тарифы
+    transaction.on_commit(bump_tariffs_version)
+
+
+@receiver(pre_save, sender=WaterCounter)
+def remember_water_counter(sender, instance, raw=False, **kwargs):
+    # прежние значения нужны для сброса ключа прежнего серийного номера и отметки начислений
+    instance._previous = None
+    if instance.pk and not raw:
+        instance._previous = (
+            WaterCounter.objects.filter(pk=instance.pk).values('serial_number', *COUNTER_CALCULATION_FIELDS).first()
+        )
+
+
+@receiver([post_save, post_delete], sender=WaterCounter)
+def invalidate_water_counter(sender, instance, created=False, raw=False, **kwargs):
+    previous = getattr(instance, '_previous', None) or {}
+    serial_numbers = {instance.serial_number, previous.get('serial_number')}
+    # ключ сбрасывается сразу и повторно после фиксации транзакции,
+    # чтобы параллельный запрос не вернул в кеш данные, прочитанные до фиксации
+    invalidate_serial_numbers(*serial_numbers)
+    transaction.on_commit(lambda: invalidate_serial_numbers(*serial_numbers))
+
+    if raw:
+        return
+    if created or not previous or any(previous[field] != getattr(instance, field) for field in COUNTER_CALCULATION_FIELDS):
+        flat_ids = {instance.flat_id, previous.get('flat_id')} - {None}
+        mark_flats_stale(flat_ids)
+        bump_flats_data_version(flat_ids)
+
+
+@receiver(pre_save, sender=MeterReading)
+def remember_meter_reading(sender, instance, raw=False, update_fields=None, **kwargs):
+    # при переносе показаний на другую дату или счетчик отмечаются и начисления прежнего месяца
+    instance._previous = None
+    if instance.pk and not raw and (update_fields is None or {'counter', 'counter_id', 'reading_date'} & set(update_fields)):
+        instance._previous = MeterReading.objects.filter(pk=instance.pk).values_list('counter_id', 'reading_date').first()
+
+
+@receiver(post_save, sender=MeterReading)
+def mark_reading_charges_stale(sender, instance, raw=False, **kwargs):
+    # пакетная запись показаний отмечает начисления сама, bulk_create сигналов не вызывает
+    if not raw:
+        readings = [(instance.counter_id, instance.reading_date)]
+        previous = getattr(instance, '_previous', None)
+        if previous:
+            readings.append(previous)
+        # отмечаются начисления с более раннего из прежнего и нового месяца
+        mark_readings_stale(readings)
+        bump_counters_data_version({counter_id for counter_id, _ in readings})
+
+
+@receiver(post_delete, sender=MeterReading)
+def mark_deleted_reading_charges_stale(sender, instance, origin=None, **kwargs):
+    # при удалении счетчика, квартиры или дома начисления отмечает удаление счетчика
+    if isinstance(origin, MeterReading) or (isinstance(origin, QuerySet) and origin.model is MeterReading):
+        mark_readings_stale([(instance.counter_id, instance.reading_date)])
+        bump_counters_data_version([instance.counter_id])
+
+
+@receiver(pre_save, sender=Flat)
+def remember_flat(sender, instance, raw=False, **kwargs):
+    instance._previous = None
+    if instance.pk and not raw:
+        instance._previous = Flat.objects.filter(pk=instance.pk).values(*FLAT_CALCULATION_FIELDS).first()
+
+
+@receiver(post_save, sender=Flat)
+def mark_flat_charges_stale(sender, instance, created=False, raw=False, **kwargs):
+    previous = getattr(instance, '_previous', None)
+    if raw or created or not previous:
+        return
+    if any(previous[field] != getattr(instance, field) for field in FLAT_CALCULATION_FIELDS):
+        mark_flats_stale([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Flat)
+def invalidate_flat_preview(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump_data_version_on_commit(instance.apartment_building_id)
+
+
+@receiver(pre_delete, sender=Flat)
+def subtract_deleted_flat_charges(sender, instance, origin=None, **kwargs):
+    # итоги удаляемого дома удаляются каскадом. Обработчика удаления начислений нет,
+    # чтобы начисления удалялись вместе с квартирой одним запросом, а не по одному
+    if isinstance(origin, ApartmentBuilding) or (isinstance(origin, QuerySet) and origin.model is ApartmentBuilding):
+        return
+    subtract_flat_charges(instance)
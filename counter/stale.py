@@ -0,0 +1,45 @@
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import MonthlyCharge
+
+
+"""
+Отметка начислений, которые нужно пересчитать:
+- новое или исправленное показание за месяц M - начисления квартиры за M и последующие месяцы,
+  показание участвует в расчете своего месяца и следующего месяца с показаниями
+- изменение даты поверки, типа или квартиры счетчика, количества зарегистрированных или площади квартиры -
+  начисления квартиры с текущего месяца, поверка проверяется на дату расчета
+Отметка выполняется в той же транзакции, что и изменение данных.
+"""
+def month_key(date) -> str:
+    # дата показаний может быть передана строкой 'YYYY-MM-DD'
+    return str(date)[:7]
+
+
+def mark_readings_stale(readings):
+    """
+    readings - пары (ID счетчика, дата показаний). Начисления отмечаются одним запросом
+    """
+    first_months = {}
+    for counter_id, reading_date in readings:
+        year_month = month_key(reading_date)
+        if counter_id not in first_months or year_month < first_months[counter_id]:
+            first_months[counter_id] = year_month
+
+    counters_by_month = {}
+    for counter_id, year_month in first_months.items():
+        counters_by_month.setdefault(year_month, []).append(counter_id)
+
+    condition = Q()
+    for year_month, counter_ids in counters_by_month.items():
+        condition |= Q(flat__water_counters__in=counter_ids, year_month__gte=year_month)
+    if condition:
+        MonthlyCharge.objects.filter(condition).update(stale_since=timezone.now())
+
+
+def mark_flats_stale(flat_ids, since: str = None):
+    since = since or month_key(datetime.date.today())
+    MonthlyCharge.objects.filter(flat_id__in=flat_ids, year_month__gte=since).update(stale_since=timezone.now())
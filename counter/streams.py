@@ -0,0 +1,164 @@
+import json
+import time
+
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .progress import building_channel, get_calculation_progress, get_job_progress, job_channel
+
+
+"""
+Поток событий прогресса расчета (server-sent events) вместо опроса calculate-progress.
+Одно соединение подписывается на каналы Redis нескольких домов и (или) пакетного задания, которые
+публикует progress.publish_progress. Сразу после подписки клиент получает текущий прогресс, затем событие
+отправляется только при его изменении:
+- event: progress - прогресс дома, как в calculate-progress, с apartment_building_id
+- event: job - итог пакетного задания, как в calculate-progress/batch, без прогресса домов
+- event: end - расчет всех отслеживаемых домов и задания завершен, соединение закрывается
+Без сообщений раз в CALCULATION_PROGRESS_STREAM_KEEPALIVE секунд отправляется комментарий, чтобы соединение
+не закрыли прокси. Через CALCULATION_PROGRESS_STREAM_TIMEOUT секунд сервер закрывает поток, EventSource
+переподключается сам. В режиме WSGI поток занимает поток сервера, в режиме ASGI ожидание не занимает потоков
+"""
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ProgressStream:
+    """
+    Состояние потока: отслеживаемые дома и задание, последний отправленный прогресс и завершенные расчеты
+    """
+    def __init__(self, apartment_building_ids: list, job_id: str = None):
+        self.apartment_building_ids = apartment_building_ids
+        self.job_id = job_id
+        self.sent = {}
+        self.finished = set()
+
+    def channels(self) -> list:
+        channels = [building_channel(apartment_building_id) for apartment_building_id in self.apartment_building_ids]
+        if self.job_id:
+            channels.append(job_channel(self.job_id))
+        return channels
+
+    def initial_targets(self) -> list:
+        # текущее задание дома неизвестно до чтения прогресса
+        targets = [('progress', apartment_building_id, None) for apartment_building_id in self.apartment_building_ids]
+        if self.job_id:
+            targets.append(('job', None, self.job_id))
+        return targets
+
+    def message_targets(self, message: dict) -> list:
+        data = json.loads(message['data'])
+        apartment_building_id = data['apartment_building_id']
+        if apartment_building_id is None:
+            return [('job', None, data['job_id'])] if data['job_id'] == self.job_id else []
+        return [('progress', apartment_building_id, data['job_id'])]
+
+    def read(self, target: tuple) -> dict:
+        event, apartment_building_id, job_id = target
+        if event == 'job':
+            return get_job_progress(job_id, buildings=False)
+        return get_calculation_progress(apartment_building_id, job_id)
+
+    def event(self, target: tuple, progress: dict):
+        """
+        Событие с прогрессом или None, если прогресса нет или он не изменился с последней отправки
+        """
+        event, apartment_building_id, _ = target
+        if progress.get('status') == 'error':
+            return None
+        key = (event, apartment_building_id)
+        # скорость и оставшееся время меняются при каждом чтении, сравниваются только счетчики
+        if event == 'job':
+            state = (progress['completed_buildings'], progress['failed_buildings'], progress['calculated_flats'])
+        else:
+            state = (progress['job_id'], progress['completed'], progress['finished_at'])
+        if self.sent.get(key) == state:
+            return None
+        self.sent[key] = state
+
+        if event == 'job':
+            if progress['completed_buildings'] >= progress['total_buildings']:
+                self.finished.add(key)
+            return format_event(event, progress)
+
+        if progress['finished_at'] is not None:
+            self.finished.add(key)
+        else:
+            # дом рассчитывается заново новым заданием
+            self.finished.discard(key)
+        return format_event(event, {'apartment_building_id': apartment_building_id, **progress})
+
+    @property
+    def done(self) -> bool:
+        watched = {('progress', apartment_building_id) for apartment_building_id in self.apartment_building_ids}
+        if self.job_id:
+            watched.add(('job', None))
+        return watched <= self.finished
+
+
+def stream_progress(stream: ProgressStream, pubsub=None):
+    if pubsub is None:
+        pubsub = get_redis_connection('default').pubsub()
+    # подписка до чтения текущего прогресса, чтобы не пропустить изменения между ними
+    pubsub.subscribe(*stream.channels())
+    try:
+        for target in stream.initial_targets():
+            event = stream.event(target, stream.read(target))
+            if event:
+                yield event
+
+        started = last_sent = time.monotonic()
+        while not stream.done and time.monotonic() - started < settings.CALCULATION_PROGRESS_STREAM_TIMEOUT:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+            if message is not None:
+                for target in stream.message_targets(message):
+                    event = stream.event(target, stream.read(target))
+                    if event:
+                        last_sent = time.monotonic()
+                        yield event
+            if time.monotonic() - last_sent >= settings.CALCULATION_PROGRESS_STREAM_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ': keepalive\n\n'
+        if stream.done:
+            yield format_event('end', {})
+    finally:
+        pubsub.close()
+
+
+async def astream_progress(stream: ProgressStream, pubsub=None):
+    """
+    То же, что stream_progress, для асинхронных представлений: ожидание сообщений через redis.asyncio,
+    прогресс читается из кеша в потоке
+    """
+    client = None
+    if pubsub is None:
+        client = redis.asyncio.Redis.from_url(settings.CACHES['default']['LOCATION'])
+        pubsub = client.pubsub()
+    read = sync_to_async(stream.read)
+    await pubsub.subscribe(*stream.channels())
+    try:
+        for target in stream.initial_targets():
+            event = stream.event(target, await read(target))
+            if event:
+                yield event
+
+        started = last_sent = time.monotonic()
+        while not stream.done and time.monotonic() - started < settings.CALCULATION_PROGRESS_STREAM_TIMEOUT:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+            if message is not None:
+                for target in stream.message_targets(message):
+                    event = stream.event(target, await read(target))
+                    if event:
+                        last_sent = time.monotonic()
+                        yield event
+            if time.monotonic() - last_sent >= settings.CALCULATION_PROGRESS_STREAM_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ': keepalive\n\n'
+        if stream.done:
+            yield format_event('end', {})
+    finally:
+        await pubsub.aclose()
+        if client is not None:
+            await client.aclose()
@@ -0,0 +1,88 @@
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import BuildingMonthlySummary, Flat, MonthlyCharge
+
+# суммы начислений, которые переносятся в итоги дома
+SUMMARY_FIELDS = ('maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price')
+
+
+"""
+Итоги начислений дома за месяц (BuildingMonthlySummary): суммы по видам начислений и количество квартир,
+рассчитанных по нормативу и по счетчикам. Отчеты читают одну строку итогов вместо начислений всех квартир.
+Расчет обновляет итоги в той же транзакции, что и пакет начислений. Сначала строки итогов месяцев пакета
+блокируются (SELECT FOR UPDATE), затем одним запросом читаются прежние значения начислений пакета, и итоги
+увеличиваются на разницу с записанными. Пакеты одного дома за месяц записываются по очереди, поэтому повторно
+доставленная часть дома или параллельный расчет того же дома видят уже зафиксированные начисления и не учитывают
+их дважды. Начисления удаленной квартиры вычитаются из итогов одним запросом на месяц, итоги удаленного дома
+удаляются вместе с ним. Итоги начислений, записанных до появления таблицы, заполнены миграцией
+"""
+def summary_deltas(charges: list, overwrite: bool = False) -> dict:
+    """
+    Изменение итогов по месяцам от записи пакета начислений. Без overwrite существующие начисления
+    не перезаписываются и в итогах не учитываются
+    """
+    previous = {
+        (flat_id, year_month): values
+        for flat_id, year_month, *values in MonthlyCharge.objects.filter(
+            flat_id__in=[charge.flat_id for charge in charges],
+            year_month__in={charge.year_month for charge in charges},
+        ).values_list('flat_id', 'year_month', *SUMMARY_FIELDS, 'billed_by_norm')
+    }
+
+    deltas = {}
+    for charge in charges:
+        old = previous.get((charge.flat_id, charge.year_month))
+        if old is not None and not overwrite:
+            continue
+        delta = deltas.setdefault(charge.year_month, dict.fromkeys((*SUMMARY_FIELDS, 'flats_billed', 'flats_billed_by_norm'), 0))
+        for index, field in enumerate(SUMMARY_FIELDS):
+            delta[field] += getattr(charge, field) - (old[index] if old else 0)
+        delta['flats_billed'] += 0 if old else 1
+        delta['flats_billed_by_norm'] += int(charge.billed_by_norm) - (int(old[-1]) if old else 0)
+    return deltas
+
+
+def lock_summaries(apartment_building_id: int, year_months):
+    """
+    Блокировка строк итогов до конца транзакции. Строки создаются без перезаписи существующих
+    и блокируются в порядке месяцев, чтобы пакеты с несколькими месяцами не попадали во взаимную блокировку
+    """
+    BuildingMonthlySummary.objects.bulk_create([
+        BuildingMonthlySummary(apartment_building_id=apartment_building_id, year_month=year_month) for year_month in sorted(year_months)
+    ], ignore_conflicts=True)
+    list(
+        BuildingMonthlySummary.objects.select_for_update()
+        .filter(apartment_building_id=apartment_building_id, year_month__in=year_months)
+        .order_by('year_month').values_list('id', flat=True)
+    )
+
+
+def apply_summary_deltas(apartment_building_id: int, deltas: dict):
+    for year_month, delta in sorted(deltas.items()):
+        if any(delta.values()):
+            update_summary(apartment_building_id, year_month, delta)
+
+
+def update_summary(apartment_building_id: int, year_month: str, delta: dict):
+    BuildingMonthlySummary.objects.filter(apartment_building_id=apartment_building_id, year_month=year_month).update(
+        updated_at=timezone.now(), **{field: F(field) + value for field, value in delta.items()},
+    )
+
+
+def subtract_flat_charges(flat: Flat):
+    """
+    Вычитание начислений квартиры из итогов дома перед ее удалением: суммы по месяцам читаются одним запросом
+    """
+    totals = (
+        MonthlyCharge.objects.filter(flat=flat).values('year_month')
+        .annotate(
+            **{field: Sum(field) for field in SUMMARY_FIELDS},
+            flats_billed=Count('id'),
+            flats_billed_by_norm=Count('id', filter=Q(billed_by_norm=True)),
+        )
+        .order_by('year_month')
+    )
+    for row in totals:
+        year_month = row.pop('year_month')
+        update_summary(flat.apartment_building_id, year_month, {field: -value for field, value in row.items()})
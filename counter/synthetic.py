@@ -0,0 +1,175 @@
+import datetime
+import random
+from decimal import Decimal
+
+from django.db.models import Max
+
+from .models import ApartmentBuilding, Flat, MeterReading, Tariff, WaterCounter, first_day_of_next_month, verification_expiration_date
+
+
+# количество объектов в одном запросе при записи синтетических данных
+SYNTHETIC_BATCH_SIZE = 5000
+
+# доли квартир и счетчиков для каждого случая из описания расчета в calculator.py
+NO_COUNTERS_SHARE = 0.1
+EXPIRED_SHARE = 0.1
+NEW_COUNTER_SHARE = 0.05
+NO_CURRENT_READING_SHARE = 0.1
+LATE_READING_SHARE = 0.05
+DECREASING_SHARE = 0.02
+
+SYNTHETIC_TARIFFS = {
+    'maintenance_of_common_property': Decimal('35.19'),
+    'cold_water_for_flat': Decimal('49.34'),
+    'hot_water_for_flat': Decimal('234.56'),
+}
+
+
+"""
+Синтетические квартиры, счетчики и показания для проверки и замеров расчета.
+Данные повторяются при одинаковом seed и покрывают все ветви расчета: квартиры без счетчиков,
+несколько счетчиков одного типа, просроченную поверку, отсутствие показаний за месяц,
+единственное показание, показания после месяца расчета и уменьшение показаний
+"""
+def generate_rows(flats: int, year: str, month: str, seed: int = 0):
+    rng = random.Random(seed)
+    month_start = datetime.date(int(year), int(month), 1)
+
+    flat_rows, counter_rows, reading_rows = [], [], []
+    counter_id = 0
+    for flat_id in range(1, flats + 1):
+        flat_rows.append((flat_id, Decimal(rng.randint(1500, 15000)) / 100, rng.randint(1, 6)))
+
+        for type_water_counter in ('cold', 'hot'):
+            for _ in range(rng.choice((0, 1, 1, 1, 2))):
+                counter_id += 1
+                verification_date = month_start - datetime.timedelta(days=rng.randint(0, 8 * 365))
+                counter_rows.append((counter_id, flat_id, type_water_counter, verification_expiration_date(type_water_counter, verification_date)))
+
+                if rng.random() < 0.8:
+                    last_date = month_start + datetime.timedelta(days=rng.randint(0, 27))
+                else:
+                    last_date = month_start - datetime.timedelta(days=rng.randint(1, 400))
+                value = rng.randint(0, 100000)
+                for position in range(rng.choice((0, 1, 2, 2, 2))):
+                    reading_rows.append((counter_id, last_date - datetime.timedelta(days=31 * position), value))
+                    value = max(value - rng.randint(-20, 60), 0)
+
+    return flat_rows, counter_rows, reading_rows
+
+
+def build_flats(flat_rows, counter_rows, reading_rows) -> list:
+    """
+    Квартиры со счетчиками и последними показаниями в том же виде, что и после with_water_counters
+    """
+    flats = {}
+    for flat_id, area, number_of_registered in flat_rows:
+        flat = Flat(id=flat_id, number=flat_id, area=area, number_of_registered=number_of_registered, apartment_building_id=1)
+        flat._prefetched_objects_cache = {'water_counters': []}
+        flats[flat_id] = flat
+
+    counters = {}
+    for counter_id, flat_id, type_water_counter, expiration_date in counter_rows:
+        # расчет использует только окончание срока поверки
+        counter = WaterCounter(
+            id=counter_id, flat_id=flat_id, serial_number=str(counter_id),
+            type_water_counter=type_water_counter, expiration_date=expiration_date,
+        )
+        counter.last_readings = []
+        flats[flat_id]._prefetched_objects_cache['water_counters'].append(counter)
+        counters[counter_id] = counter
+
+    for counter_id, reading_date, value in reading_rows:
+        counters[counter_id].last_readings.append(MeterReading(counter_id=counter_id, reading_date=reading_date, value=value))
+
+    return list(flats.values())
+
+
+def create_dataset(buildings: int, flats: int, months: int, year: str, month: str, seed: int = 0) -> dict:
+    """
+    Запись в бд синтетических домов с квартирами, счетчиками и показаниями за months месяцев,
+    последний из которых - месяц расчета year-month. Возвращает ID созданных домов и количество объектов
+    """
+    rng = random.Random(seed)
+    year, month = int(year), int(month)
+    month_starts = []
+    for offset in range(months - 1, -1, -1):
+        index = year * 12 + month - 1 - offset
+        month_starts.append(datetime.date(index // 12, index % 12 + 1, 1))
+    billing_month_start = month_starts[-1]
+    next_month_start = first_day_of_next_month(year, month)
+
+    ensure_tariffs()
+    # адреса и серийные номера не должны совпадать с уже существующими
+    address_offset = (ApartmentBuilding.objects.aggregate(last_id=Max('id'))['last_id'] or 0) + 1
+    serial_offset = (WaterCounter.objects.aggregate(last_id=Max('id'))['last_id'] or 0) + 1
+
+    created = ApartmentBuilding.objects.bulk_create([
+        ApartmentBuilding(address=f'Синтетический дом № {address_offset + index}', total_area=Decimal('10000.00'))
+        for index in range(buildings)
+    ])
+
+    flat_objects = [
+        Flat(
+            apartment_building=building,
+            number=number,
+            area=Decimal(rng.randint(2000, 15000)) / 100,
+            number_of_registered=rng.randint(1, 5),
+        )
+        for building in created for number in range(1, flats + 1)
+    ]
+    Flat.objects.bulk_create(flat_objects, batch_size=SYNTHETIC_BATCH_SIZE)
+
+    counters = []
+    for flat in flat_objects:
+        if rng.random() < NO_COUNTERS_SHARE:
+            continue
+        for type_water_counter in ('cold', 'hot'):
+            # у части квартир два счетчика одного типа
+            for _ in range(2 if rng.random() < 0.1 else 1):
+                expired = rng.random() < EXPIRED_SHARE
+                verification_date = billing_month_start - datetime.timedelta(
+                    days=rng.randint(7 * 365, 9 * 365) if expired else rng.randint(0, 3 * 365)
+                )
+                counters.append(WaterCounter(
+                    flat=flat,
+                    serial_number=f'S{serial_offset + len(counters):09d}',
+                    verification_date=verification_date,
+                    type_water_counter=type_water_counter,
+                ))
+    WaterCounter.objects.bulk_create(counters, batch_size=SYNTHETIC_BATCH_SIZE)
+
+    readings = []
+    for counter in counters:
+        case = rng.random()
+        if case < NEW_COUNTER_SHARE:
+            reading_months = month_starts[-1:]
+        elif case < NEW_COUNTER_SHARE + NO_CURRENT_READING_SHARE:
+            reading_months = month_starts[:-1]
+        else:
+            reading_months = month_starts
+
+        value = rng.randint(0, 50000)
+        for month_start in reading_months:
+            value += rng.randint(0, 20)
+            if rng.random() < DECREASING_SHARE:
+                value = max(value - rng.randint(30, 100), 0)
+            readings.append(MeterReading(
+                counter=counter, reading_date=month_start + datetime.timedelta(days=rng.randint(0, 27)), value=value,
+            ))
+        if rng.random() < LATE_READING_SHARE:
+            readings.append(MeterReading(counter=counter, reading_date=next_month_start, value=value + rng.randint(0, 20)))
+    MeterReading.objects.bulk_create(readings, batch_size=SYNTHETIC_BATCH_SIZE)
+
+    return {
+        'apartment_building_ids': [building.id for building in created],
+        'flats': len(flat_objects),
+        'water_counters': len(counters),
+        'meter_readings': len(readings),
+    }
+
+
+def ensure_tariffs():
+    for tariff_type, price in SYNTHETIC_TARIFFS.items():
+        if not Tariff.objects.filter(tariff_type=tariff_type).exists():
+            Tariff.objects.create(tariff_type=tariff_type, price=price, valid_from=datetime.date(2000, 1, 1))
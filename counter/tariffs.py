@@ -0,0 +1,87 @@
+import datetime
+import threading
+import uuid
+
+from django.core.cache import cache
+
+from .models import Tariff
+
+
+TARIFFS_VERSION_KEY = 'tariffs_version'
+
+
+class TariffProvider:
+    """
+    Тарифы, закешированные в памяти процесса. Тарифы меняются несколько раз в год,
+    поэтому при каждом обращении сверяется только версия тарифов в кеше, а сама история тарифов
+    читается из бд одним запросом после изменения версии. Цены на дату вычисляются в памяти
+    и запоминаются до следующего изменения версии
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._history = None
+        self._prices = {}
+
+    def get_tariffs(self, date: datetime.date = None) -> dict:
+        date = date or datetime.date.today()
+        version = get_tariffs_version()
+        with self._lock:
+            if self._history is None or self._version != version:
+                self._history = load_tariff_history()
+                self._version = version
+                self._prices = {}
+            if date not in self._prices:
+                self._prices[date] = resolve_prices(self._history, date)
+            return dict(self._prices[date])
+
+    def get_tariffs_for_month(self, year, month) -> dict:
+        # расчет за месяц ведется по тарифам, действующим на первое число месяца
+        return self.get_tariffs(datetime.date(int(year), int(month), 1))
+
+    def get_version(self) -> str:
+        return get_tariffs_version()
+
+
+def load_tariff_history() -> dict:
+    history = {}
+    tariffs = Tariff.objects.order_by('tariff_type', 'valid_from').values_list('tariff_type', 'valid_from', 'valid_to', 'price')
+    for tariff_type, valid_from, valid_to, price in tariffs:
+        history.setdefault(tariff_type, []).append((valid_from, valid_to, price))
+    return history
+
+
+def resolve_prices(history: dict, date: datetime.date) -> dict:
+    prices = {}
+    missing = []
+    for tariff_type, _ in Tariff.TYPE_TARIFF:
+        # при нескольких действующих тарифах применяется начавший действовать последним
+        valid = [
+            price for valid_from, valid_to, price in history.get(tariff_type, [])
+            if valid_from <= date and (valid_to is None or valid_to >= date)
+        ]
+        if valid:
+            prices[tariff_type] = valid[-1]
+        else:
+            missing.append(tariff_type)
+
+    if missing:
+        raise Tariff.DoesNotExist(f'На {date} не заданы тарифы: {", ".join(missing)}.')
+    return prices
+
+
+def get_tariffs_version() -> str:
+    version = cache.get(TARIFFS_VERSION_KEY)
+    if version is None:
+        # версия могла быть вытеснена из кеша, в этом случае все процессы перечитают тарифы
+        cache.add(TARIFFS_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(TARIFFS_VERSION_KEY)
+    return version
+
+
+def bump_tariffs_version():
+    cache.set(TARIFFS_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+tariff_provider = TariffProvider()
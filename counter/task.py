@@ -1,6 +1,175 @@
-from celery import shared_task
-from .calculator import calculator_payment
+from decimal import Decimal
+import uuid
+
+from celery import chord, group, shared_task
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+
+from .calculator import (calculator_payment, 
+                         calculator_payment_chunk, 
+                         get_tariffs,
+                         recalculator_payment,
+                         recalculate_stale_charges,
+                         split_calculation)
+from .imports import run_import
+from .jobs import claim_job, fail_job, finish_job, submit_calculation_job
+from .models import ApartmentBuilding, ReadingImport
+from .progress import finish_progress, initialize_job_progress, update_job_progress
+
+# пауза перед повтором расчета после разрыва соединения с бд, в секундах
+DATABASE_RETRY_COUNTDOWN = 10
+
+
+# при падении воркера задача возвращается в очередь с тем же job_id и расчет продолжается с контрольной точки,
+# при разрыве соединения с бд задача повторяется с тем же job_id и тоже продолжается с контрольной точки
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=3)
+def calculate_payment_task(self, apartment_building_id, year, month, fan_out=None, job_id=None):
+    if fan_out is None:
+        fan_out = settings.CALCULATION_FAN_OUT
+    if job_id is None:
+        job_id = uuid.uuid4().hex
+    elif not claim_job(job_id, apartment_building_id, redelivered=True):
+        # задание прервано по CALCULATION_JOB_TIMEOUT или уже завершено, его дом рассчитывается новым заданием
+        return {"status": "error", "message": "Задание расчета дома прервано до начала расчета."}
+    if not fan_out:
+        try:
+            result = calculator_payment(apartment_building_id, year, month, job_id=job_id)
+        except (InterfaceError, OperationalError) as e:
+            retry_on_database_error(self, e, fan_out=fan_out, job_id=job_id)
+            fail_job(job_id, str(e))
+            raise
+        except Exception as e:
+            fail_job(job_id, str(e))
+            raise
+        finish_job(job_id, result['calculated'])
+        return result
+
+    chunks = split_calculation(apartment_building_id, year, month, settings.CALCULATION_CHUNK_SIZE, job_id)
+    if not chunks:
+        finish_progress(job_id, apartment_building_id)
+        finish_job(job_id, 0)
+        return
+
+    # части дома рассчитываются параллельно свободными воркерами, итог собирает finish_payment_task
+    chord(
+        calculate_payment_chunk_task.s(apartment_building_id, year, month, flat_ids, job_id) for flat_ids in chunks
+    )(finish_payment_task.s(apartment_building_id, year, month, job_id))
+
+
+def retry_on_database_error(task, error, **kwargs):
+    """
+    Повтор задачи после разрыва соединения с бд, пока не исчерпаны попытки. kwargs задачи заменяются
+    переданными, чтобы повтор продолжил то же задание расчета
+    """
+    if task.request.retries < task.max_retries:
+        raise task.retry(exc=error, countdown=DATABASE_RETRY_COUNTDOWN, kwargs=kwargs or None)
+
+
+# часть дома идемпотентна: при повторе уже рассчитанные квартиры пропускаются.
+# Ошибка части записывается в задание расчета, chord завершается с ошибкой и finish_payment_task не вызывается
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=3)
+def calculate_payment_chunk_task(self, apartment_building_id, year, month, flat_ids, job_id):
+    try:
+        return calculator_payment_chunk(apartment_building_id, year, month, flat_ids, job_id)
+    except (InterfaceError, OperationalError) as e:
+        retry_on_database_error(self, e)
+        fail_job(job_id, str(e))
+        raise
+    except Exception as e:
+        fail_job(job_id, str(e))
+        raise
+
+
+@shared_task
+def finish_payment_task(results, apartment_building_id, year, month, job_id):
+    finish_progress(job_id, apartment_building_id)
+    calculated = sum(result['calculated'] for result in results)
+    finish_job(job_id, calculated)
+    return {"status": "success", "calculated": calculated}
+
+
+@shared_task
+def calculate_batch_payment_task(job_id, apartment_building_ids, year, month):
+    year_month_key = f"{year}-{month.zfill(2)}"
+    if apartment_building_ids == 'all':
+        apartment_building_ids = list(ApartmentBuilding.objects.order_by('id').values_list('id', flat=True))
+
+    # на каждый дом создается задание расчета, как при расчете одного дома: дом, который уже рассчитывается
+    # другим заданием, пропускается и попадает в skipped_buildings прогресса пакета
+    building_jobs, skipped = [], {}
+    for apartment_building_id in apartment_building_ids:
+        building_job, created = submit_calculation_job(apartment_building_id, year_month_key)
+        if created:
+            building_jobs.append((apartment_building_id, str(building_job.id)))
+        else:
+            skipped[apartment_building_id] = str(building_job.id)
+
+    initialize_job_progress(job_id, dict(building_jobs), year_month_key, skipped)
+    if not building_jobs:
+        return
+
+    # тарифы читаются один раз на весь пакет и передаются в расчет каждого дома
+    tariffs = {tariff_type: str(price) for tariff_type, price in get_tariffs(year, month).items()}
+
+    # дома распределяются по очередям, каждая очередь рассчитывается одной задачей последовательно,
+    # поэтому одновременно рассчитывается не больше CALCULATION_BATCH_CONCURRENCY домов
+    concurrency = max(settings.CALCULATION_BATCH_CONCURRENCY, 1)
+    lanes = [building_jobs[lane::concurrency] for lane in range(concurrency)]
+    group(
+        calculate_batch_lane_task.s(job_id, lane, year, month, tariffs) for lane in lanes if lane
+    ).apply_async()
+
 
 @shared_task
-def calculate_payment_task(apartment_building_id, year, month):
-    return calculator_payment(apartment_building_id, year, month)
+def calculate_batch_lane_task(job_id, building_jobs, year, month, tariffs):
+    """
+    building_jobs - пары (ID дома, ID задания расчета дома). Прогресс, контрольная точка и статус расчета дома
+    ведутся по его заданию, итог пакета - по заданию пакета
+    """
+    tariffs = {tariff_type: Decimal(price) for tariff_type, price in tariffs.items()}
+    results = {}
+    for apartment_building_id, building_job_id in building_jobs:
+        if not claim_job(building_job_id, apartment_building_id):
+            result = {"status": "error", "message": "Задание расчета дома прервано до начала расчета."}
+        else:
+            try:
+                result = calculator_payment(apartment_building_id, year, month, tariffs, job_id=building_job_id)
+            except Exception as e:
+                # ошибка записана в контрольную точку и задание расчета дома, остальные дома очереди рассчитываются
+                fail_job(building_job_id, str(e))
+                result = {"status": "error", "message": str(e)}
+            else:
+                finish_job(building_job_id, result['calculated'])
+        update_job_progress(job_id, result)
+        results[apartment_building_id] = result
+    return results
+
+
+# ошибка перерасчета записывается в контрольную точку, при разрыве соединения с бд перерасчет повторяется с тем же job_id
+@shared_task(bind=True, max_retries=3)
+def recalculate_payment_task(self, apartment_building_id, year_months, job_id=None):
+    job_id = job_id or uuid.uuid4().hex
+    try:
+        return recalculator_payment(apartment_building_id, year_months, job_id=job_id)
+    except (InterfaceError, OperationalError) as e:
+        retry_on_database_error(self, e, job_id=job_id)
+        raise
+
+
+@shared_task(bind=True, max_retries=3)
+def recalculate_stale_task(self, apartment_building_id, job_id=None):
+    job_id = job_id or uuid.uuid4().hex
+    try:
+        return recalculate_stale_charges(apartment_building_id, job_id=job_id)
+    except (InterfaceError, OperationalError) as e:
+        retry_on_database_error(self, e, job_id=job_id)
+        raise
+
+
+# при падении воркера задача возвращается в очередь и загрузка продолжается с последней зафиксированной строки
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def import_readings_task(reading_import_id):
+    reading_import = ReadingImport.objects.get(id=reading_import_id)
+    if reading_import.status == 'done':
+        return
+    run_import(reading_import)
@@ -1,14 +1,54 @@
+import csv
+import io
 import json
-from decimal import Decimal
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from unittest import mock, skipUnless
+from decimal import Decimal, ROUND_HALF_UP
 
-from django.test import TestCase
-from django.urls import reverse
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import JsonResponse
+from django.urls import resolve, reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 
 
-from .models import ApartmentBuilding, Flat, WaterCounter
+from .models import ApartmentBuilding, BuildingMonthlySummary, CalculationCheckpoint, CalculationJob, Flat, MeterReading, MonthlyCharge, ReadingImport, Tariff, WaterCounter
 from .serializers import FlatCreateSerializer
+from .calculator import (calculator_payment, 
+                         calculator_payment_chunk,
+                         recalculator_payment,
+                         recalculate_stale_charges,
+                         calculate_maintenance_cost, 
+                         calculate_water_usage, 
+                         calculate_flat_payment,
+                         get_tariffs,
+                         split_calculation,
+                         to_price)
+from . import calculator, kernel
+from .export import aexport_charges, export_charges
+from .jobs import submit_calculation_job
+from .views import AsyncAddMeterReadingView, AsyncCalculationProgressView, AsyncChargeExportView
+from .metrics import InstrumentedRedisClient, MetricsMiddleware, collect, phase, registry
+from .readings import ingest_readings
+from .progress import finish_progress, get_calculation_progress, initialize_job_progress, initialize_progress, publish_progress, update_progress
+from .serials import get_counter_by_serial, resolve_serial_numbers
+from .streams import ProgressStream, astream_progress, stream_progress
+from .synthetic import build_flats, create_dataset, generate_rows
+from .tariffs import TariffProvider, bump_tariffs_version
+from .task import calculate_batch_lane_task, calculate_payment_task, import_readings_task
 
 
 
@@ -27,21 +67,18 @@ class ApartmentBuildingDetailViewTests(TestCase):
             number='101',
             area = 56.12,
             number_of_registered = 1,
-            calculations = {}
         )
         self.flat_with_counter = Flat.objects.create(
             apartment_building=self.apartment_building,
             number='102',
             area = 56.12,
             number_of_registered = 1,
-            calculations = {}
         )
         WaterCounter.objects.create(
             flat=self.flat_with_counter,
             verification_date = '2024-12-20',
             serial_number = '12345678',
             type_water_counter = 'cold',
-            meters = []
         )
     
     def test_get_apartment_building_details(self):
@@ -62,6 +99,49 @@ class ApartmentBuildingDetailViewTests(TestCase):
         self.assertEqual(len(flats), 1)
         self.assertEqual(flats[0]['number'], 101)
 
+    def test_flats_are_paginated_by_number(self):
+        for number in range(103, 115):
+            Flat.objects.create(apartment_building=self.apartment_building, number=number, area=40)
+        url = reverse('counter:apartment_building_detail', args=[self.apartment_building.id])
+
+        response = self.client.get(url, {'page_size': 5, 'ordering': '-number'})
+        self.assertEqual([flat['number'] for flat in response.data['flats']], [114, 113, 112, 111, 110])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([flat['number'] for flat in response.data['flats']], [109, 108, 107, 106, 105])
+        self.assertEqual(response.data['address'], self.apartment_building.address)
+
+    def test_query_count_does_not_depend_on_number_of_flats(self):
+        url = reverse('counter:apartment_building_detail', args=[self.apartment_building.id])
+        for number in range(103, 110):
+            flat = Flat.objects.create(apartment_building=self.apartment_building, number=number, area=40)
+            WaterCounter.objects.create(flat=flat, verification_date='2024-12-20', serial_number=str(number), type_water_counter='hot')
+
+        # дом, квартиры, счетчики, показания, начисления
+        with self.assertNumQueries(5):
+            response = self.client.get(url, {'include_charges': 'true'})
+        self.assertEqual(len(response.data['flats']), 9)
+
+    @override_settings(METER_READINGS_RETENTION=3)
+    def test_only_last_readings_are_returned(self):
+        counter = self.flat_with_counter.water_counters.get()
+        for month in range(1, 7):
+            MeterReading.objects.create(counter=counter, reading_date=date(2024, month, 20), value=month * 10)
+        url = reverse('counter:apartment_building_detail', args=[self.apartment_building.id])
+
+        response = self.client.get(url)
+        flat = next(flat for flat in response.data['flats'] if flat['number'] == 102)
+        self.assertEqual([reading['meter_reading_value'] for reading in flat['water_counters'][0]['meters']], [40, 50, 60])
+
+    def test_meters_can_be_omitted(self):
+        url = reverse('counter:apartment_building_detail', args=[self.apartment_building.id])
+        response = self.client.get(url, {'include_meters': 'false'})
+
+        flat = next(flat for flat in response.data['flats'] if flat['number'] == 102)
+        self.assertNotIn('meters', flat['water_counters'][0])
+        self.assertNotIn('charges', flat)
+
     def test_get_apartment_building_details_not_exist(self):
         url = reverse('counter:apartment_building_detail', args=[2])
         response = self.client.get(url)
@@ -81,7 +161,6 @@ class FlatCreateSerializerTests(TestCase):
             number='102',
             area = 56.12,
             number_of_registered = 1,
-            calculations = {}
         )
 
     def test_valid_flat_data(self):
@@ -122,3 +201,1360 @@ class FlatCreateSerializerTests(TestCase):
         serializer = FlatCreateSerializer(data=data)
         self.assertFalse(serializer.is_valid())
         self.assertIn('non_field_errors', serializer.errors)
+
+
+class CalculatorPaymentTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def calculate_per_flat(self, apartment_building_id, year, month):
+        """
+        Расчет по квартирам по одной, без пакетной загрузки, для сравнения с результатом calculator_payment
+        """
+        tariffs = get_tariffs()
+        current_date = datetime.now().date()
+        expected = {}
+        for flat in Flat.objects.filter(apartment_building_id=apartment_building_id):
+            maintenance_cost = calculate_maintenance_cost(flat, tariffs['maintenance_of_common_property'])
+            cold_water_usage, hot_water_usage = calculate_water_usage(flat, current_date, year, month)
+            expected[flat.id] = (
+                maintenance_cost.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+                (cold_water_usage * tariffs['cold_water_for_flat']).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+                (hot_water_usage * tariffs['hot_water_for_flat']).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+            )
+        return expected
+
+    def test_bulk_calculation_matches_per_flat_calculation(self):
+        for apartment_building in ApartmentBuilding.objects.all():
+            expected = self.calculate_per_flat(apartment_building.id, '2024', '07')
+
+            self.assertEqual(
+                calculator_payment(apartment_building.id, '2024', '07'),
+                {'status': 'success', 'calculated': len(expected)},
+            )
+
+            charges = MonthlyCharge.objects.filter(flat__apartment_building=apartment_building, year_month='2024-07')
+            self.assertEqual(len(charges), len(expected))
+            for charge in charges:
+                self.assertEqual(
+                    (charge.maintenance_of_common_property, charge.cold_water_usage_price, charge.hot_water_usage_price),
+                    expected[charge.flat_id],
+                )
+
+    def test_query_count_does_not_depend_on_number_of_flats(self):
+        bump_tariffs_version()
+        # количество квартир, выборка квартир, счетчиков, показаний, тарифов, одна пакетная запись;
+        # создание контрольной точки, ее обновление в транзакции пакета (точка сохранения) и завершение расчета;
+        # создание и блокировка итогов дома, прежние начисления пакета, обновление итогов
+        with self.assertNumQueries(15):
+            calculator_payment(1, '2024', '07')
+
+    def test_calculated_flats_are_skipped(self):
+        calculator_payment(1, '2024', '07')
+        MonthlyCharge.objects.filter(flat_id=2).update(maintenance_of_common_property=0)
+
+        calculator_payment(1, '2024', '07')
+
+        charge = MonthlyCharge.objects.get(flat_id=2, year_month='2024-07')
+        self.assertEqual(charge.maintenance_of_common_property, Decimal('0'))
+        self.assertEqual(MonthlyCharge.objects.filter(flat__apartment_building_id=1).count(), 5)
+
+    @override_settings(CALCULATION_BATCH_SIZE=2)
+    def test_failed_calculation_resumes_from_checkpoint(self):
+        save_monthly_charges = calculator.save_monthly_charges
+        calls = []
+
+        def fail_on_second_batch(charges, overwrite=False):
+            calls.append([charge.flat_id for charge in charges])
+            if len(calls) == 2:
+                raise RuntimeError('database is unavailable')
+            save_monthly_charges(charges, overwrite)
+
+        with mock.patch('counter.calculator.save_monthly_charges', fail_on_second_batch):
+            with self.assertRaisesMessage(RuntimeError, 'database is unavailable'):
+                calculator_payment(1, '2024', '07', job_id='resumable')
+
+        checkpoint = CalculationCheckpoint.objects.get(job_id='resumable', apartment_building_id=1)
+        self.assertEqual((checkpoint.status, checkpoint.error_message), ('failed', 'database is unavailable'))
+        self.assertEqual((checkpoint.last_flat_id, checkpoint.calculated), (calls[0][-1], 2))
+        # второй пакет откатан вместе с контрольной точкой
+        self.assertEqual(MonthlyCharge.objects.filter(year_month='2024-07').count(), 2)
+
+        result = calculator_payment(1, '2024', '07', job_id='resumable')
+
+        self.assertEqual(result, {'status': 'success', 'calculated': 3})
+        checkpoint.refresh_from_db()
+        self.assertEqual((checkpoint.status, checkpoint.calculated), ('done', 5))
+        self.assertEqual(MonthlyCharge.objects.filter(flat__apartment_building_id=1, year_month='2024-07').count(), 5)
+
+    def test_readings_after_calculation_month_are_ignored(self):
+        WaterCounter.objects.get(pk=6).add_meters('2024-08-20', 130)
+
+        calculator_payment(1, '2024', '07')
+
+        # по счетчику 6 квартиры 9 расход за июль: 105 - 100 = 5 кубометров
+        charge = MonthlyCharge.objects.get(flat_id=9, year_month='2024-07')
+        self.assertEqual(charge.cold_water_usage_price, Decimal('182.70'))
+
+
+class ChunkedCalculationTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        self.app_conf = calculate_payment_task.app.conf
+        self.always_eager = self.app_conf.task_always_eager
+        self.app_conf.task_always_eager = True
+
+    def tearDown(self):
+        self.app_conf.task_always_eager = self.always_eager
+
+    def test_chunked_calculation_matches_single_task(self):
+        calculator_payment(1, '2024', '07')
+        expected = list(MonthlyCharge.objects.order_by('flat_id').values_list(
+            'flat_id', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price'))
+        MonthlyCharge.objects.all().delete()
+
+        with self.settings(CALCULATION_CHUNK_SIZE=2):
+            calculate_payment_task.apply(args=(1, '2024', '07'), kwargs={'fan_out': True, 'job_id': 'chunked'})
+
+        self.assertEqual(
+            list(MonthlyCharge.objects.order_by('flat_id').values_list(
+                'flat_id', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price')),
+            expected,
+        )
+        progress = get_calculation_progress(1, 'chunked')
+        self.assertEqual((progress['total'], progress['completed'], progress['eta_seconds']), (5, 5, 0))
+        self.assertIsNotNone(progress['finished_at'])
+
+    def test_repeated_chunk_is_idempotent(self):
+        chunks = split_calculation(1, '2024', '07', 2, 'chunked')
+        self.assertEqual(chunks, [[2, 3], [4, 7], [9]])
+
+        for flat_ids in chunks + chunks[:1]:
+            self.assertEqual(calculator_payment_chunk(1, '2024', '07', flat_ids, 'chunked')['status'], 'success')
+
+        self.assertEqual(MonthlyCharge.objects.count(), 5)
+        self.assertEqual(calculator_payment_chunk(1, '2024', '07', chunks[0], 'chunked'), {'status': 'success', 'calculated': 0})
+        self.assertEqual(get_calculation_progress(1, 'chunked')['completed'], 5)
+
+    def test_failed_chunk_fails_job(self):
+        job = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07')
+        with self.settings(CALCULATION_CHUNK_SIZE=2), \
+                mock.patch.object(calculator, 'calculate_flats', side_effect=RuntimeError('chunk failed')):
+            result = calculate_payment_task.apply(args=(1, '2024', '07'), kwargs={'fan_out': True, 'job_id': str(job.id)})
+
+        self.assertIsInstance(result.result, RuntimeError)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error_message), ('failed', 'chunk failed'))
+
+
+class CalculationJobTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('counter:calculate_payment')
+        self.data = {'apartment_building_id': 1, 'year': '2024', 'month': '07'}
+
+    def test_duplicate_submission_returns_running_job(self):
+        with mock.patch('counter.views.calculate_payment_task.delay') as delay:
+            first = self.client.post(self.url, self.data, format='json')
+            second = self.client.post(self.url, self.data, format='json')
+
+        self.assertEqual(first.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data['job_id'], first.data['job_id'])
+        delay.assert_called_once_with(1, '2024', '07', job_id=first.data['job_id'])
+
+        # после завершения задания расчет запускается заново
+        CalculationJob.objects.filter(id=first.data['job_id']).update(status='done')
+        with mock.patch('counter.views.calculate_payment_task.delay') as delay:
+            third = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(third.status_code, status.HTTP_202_ACCEPTED)
+        self.assertNotEqual(third.data['job_id'], first.data['job_id'])
+
+    def test_expired_job_does_not_block_submission(self):
+        job = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07')
+        CalculationJob.objects.filter(id=job.id).update(created_at=timezone.now() - timedelta(hours=2))
+
+        with mock.patch('counter.views.calculate_payment_task.delay'):
+            response = self.client.post(self.url, self.data, format='json')
+
+        self.assertNotEqual(response.data['job_id'], str(job.id))
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+
+    def test_job_status_is_served_from_record(self):
+        with mock.patch('counter.views.calculate_payment_task.delay'):
+            job_id = self.client.post(self.url, self.data, format='json').data['job_id']
+        calculate_payment_task(1, '2024', '07', fan_out=False, job_id=job_id)
+
+        response = self.client.get(reverse('counter:calculation_job_detail', args=[job_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['status'], response.data['total_flats'], response.data['calculated']), ('done', 5, 5))
+        self.assertGreaterEqual(response.data['duration_seconds'], 0)
+
+        response = self.client.get(reverse('counter:calculation_job_list'), {'apartment_building': 1, 'status': 'done'})
+        self.assertEqual([job['id'] for job in response.data['results']], [job_id])
+
+    def test_failed_calculation_is_recorded(self):
+        job = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07')
+        with mock.patch('counter.task.calculator_payment', side_effect=RuntimeError('database is unavailable')):
+            with self.assertRaises(RuntimeError):
+                calculate_payment_task(1, '2024', '07', fan_out=False, job_id=str(job.id))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error_message), ('failed', 'database is unavailable'))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_connection_error_retries_job(self):
+        job = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07')
+        with mock.patch('counter.task.calculator_payment', side_effect=OperationalError('connection lost')), \
+                mock.patch.object(calculate_payment_task, 'retry', side_effect=RuntimeError('retry')) as retry:
+            with self.assertRaises(RuntimeError):
+                calculate_payment_task(1, '2024', '07', fan_out=False, job_id=str(job.id))
+
+        # повтор получает тот же job_id и продолжает расчет с контрольной точки, задание остается в работе
+        self.assertEqual(retry.call_args.kwargs['kwargs'], {'fan_out': False, 'job_id': str(job.id)})
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+
+    def test_expired_job_is_not_calculated(self):
+        expired = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07')
+        CalculationJob.objects.filter(id=expired.id).update(created_at=timezone.now() - timedelta(hours=2))
+        job, created = submit_calculation_job(1, '2024-07')
+        self.assertTrue(created)
+
+        # задача прерванного задания доставлена позже нового задания того же дома
+        result = calculate_payment_task(1, '2024', '07', fan_out=False, job_id=str(expired.id))
+        self.assertEqual(result['status'], 'error')
+        self.assertFalse(MonthlyCharge.objects.exists())
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, 'failed')
+
+        # без нового задания прерванное задание тоже не возвращается в работу
+        CalculationJob.objects.filter(id=job.id).delete()
+        self.assertEqual(calculate_payment_task(1, '2024', '07', fan_out=False, job_id=str(expired.id))['status'], 'error')
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, 'failed')
+
+    def test_redelivered_running_job_is_continued(self):
+        job = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07', status='running')
+        self.assertEqual(calculate_payment_task(1, '2024', '07', fan_out=False, job_id=str(job.id))['calculated'], 5)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'done')
+
+
+class BuildingMonthlySummaryTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def assert_summary_matches_charges(self, apartment_building_id, year_month):
+        charges = MonthlyCharge.objects.filter(flat__apartment_building_id=apartment_building_id, year_month=year_month)
+        summary = BuildingMonthlySummary.objects.get(apartment_building_id=apartment_building_id, year_month=year_month)
+        self.assertEqual(
+            (summary.maintenance_of_common_property, summary.cold_water_usage_price, summary.hot_water_usage_price,
+             summary.flats_billed, summary.flats_billed_by_norm),
+            (sum(charge.maintenance_of_common_property for charge in charges), sum(charge.cold_water_usage_price for charge in charges),
+             sum(charge.hot_water_usage_price for charge in charges), len(charges), sum(charge.billed_by_norm for charge in charges)),
+        )
+
+    def test_summary_is_maintained_by_calculation(self):
+        calculator_payment(1, '2024', '07')
+        self.assert_summary_matches_charges(1, '2024-07')
+        # в доме 1 по счетчикам рассчитывается только квартира 9
+        self.assertEqual(
+            set(MonthlyCharge.objects.filter(billed_by_norm=False).values_list('flat_id', flat=True)), {9},
+        )
+
+        # перерасчет прибавляет к итогам только разницу с прежними начислениями
+        Tariff.objects.filter(tariff_type='cold_water_for_flat').update(price='40.00')
+        bump_tariffs_version()
+        recalculator_payment(1, ['2024-07'])
+        self.assert_summary_matches_charges(1, '2024-07')
+        self.assertEqual(BuildingMonthlySummary.objects.get(apartment_building_id=1, year_month='2024-07').flats_billed, 5)
+
+        Flat.objects.get(pk=9).delete()
+        self.assert_summary_matches_charges(1, '2024-07')
+
+    def test_repeated_batch_is_counted_once(self):
+        calculator_payment(1, '2024', '07')
+        charges = list(MonthlyCharge.objects.filter(flat__apartment_building_id=1))
+        for charge in charges:
+            charge.pk = None
+
+        # повторно доставленная часть дома и повторный перерасчет того же пакета
+        calculator.save_charges_batch(1, charges)
+        calculator.save_charges_batch(1, charges, overwrite=True)
+        calculator.save_charges_batch(1, charges, overwrite=True)
+        self.assert_summary_matches_charges(1, '2024-07')
+        self.assertEqual(BuildingMonthlySummary.objects.get(apartment_building_id=1, year_month='2024-07').flats_billed, 5)
+
+    def test_previous_charges_are_read_after_locking_summaries(self):
+        calls = mock.Mock()
+        with mock.patch.object(calculator, 'lock_summaries', wraps=calculator.lock_summaries) as lock_summaries, \
+                mock.patch.object(calculator, 'summary_deltas', wraps=calculator.summary_deltas) as summary_deltas:
+            calls.attach_mock(lock_summaries, 'lock_summaries')
+            calls.attach_mock(summary_deltas, 'summary_deltas')
+            calculator_payment(1, '2024', '07')
+
+        self.assertEqual([call[0] for call in calls.mock_calls], ['lock_summaries', 'summary_deltas'])
+
+    def test_building_charges_are_deleted_in_bulk(self):
+        calculator_payment(1, '2024', '06')
+        calculator_payment(1, '2024', '07')
+
+        with CaptureQueriesContext(connection) as queries:
+            ApartmentBuilding.objects.get(pk=1).delete()
+        # начисления не читаются перед удалением и удаляются одним запросом
+        charge_queries = [query['sql'] for query in queries if query['sql'].startswith(('SELECT', 'DELETE'))
+                          and 'FROM "counter_monthlycharge"' in query['sql']]
+        self.assertEqual(len(charge_queries), 1)
+        self.assertTrue(charge_queries[0].startswith('DELETE'))
+        self.assertFalse(BuildingMonthlySummary.objects.exists())
+
+    def test_summary_endpoint(self):
+        with override_settings(CALCULATION_BATCH_SIZE=2):
+            calculator_payment(1, '2024', '07')
+
+        response = APIClient().get(reverse('counter:billing_summary'), {'apartment_building': 1, 'year_month': '2024-07'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        summary = response.data['results'][0]
+        self.assertEqual((summary['flats_billed'], summary['flats_billed_by_norm'], summary['flats_billed_by_meter']), (5, 4, 1))
+        self.assertEqual(
+            Decimal(summary['total']),
+            sum(sum(values) for values in MonthlyCharge.objects.values_list(
+                'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price')),
+        )
+
+
+@skipUnless(connection.features.has_select_for_update, 'Блокировка строк итогов требует SELECT FOR UPDATE')
+class ConcurrentSummaryTests(TransactionTestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def test_overlapping_writers_count_charges_once(self):
+        charges = [
+            MonthlyCharge(flat_id=flat_id, year_month='2024-07', maintenance_of_common_property=Decimal('10.00'),
+                          cold_water_usage_price=Decimal('1.00'), hot_water_usage_price=Decimal('2.00'))
+            for flat_id in Flat.objects.filter(apartment_building_id=1).values_list('id', flat=True)
+        ]
+        save_monthly_charges = calculator.save_monthly_charges
+
+        def slow_save(*args, **kwargs):
+            # второй расчет начинается, пока пакет первого не зафиксирован
+            save_monthly_charges(*args, **kwargs)
+            time.sleep(0.5)
+
+        def write():
+            try:
+                calculator.save_charges_batch(1, charges)
+            finally:
+                connections.close_all()
+
+        with mock.patch.object(calculator, 'save_monthly_charges', side_effect=slow_save):
+            threads = [threading.Thread(target=write) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.1)
+            for thread in threads:
+                thread.join()
+
+        summary = BuildingMonthlySummary.objects.get(apartment_building_id=1, year_month='2024-07')
+        self.assertEqual((summary.flats_billed, summary.maintenance_of_common_property), (5, Decimal('50.00')))
+
+
+class CalculateBatchPaymentViewTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.app_conf = calculate_payment_task.app.conf
+        self.always_eager = self.app_conf.task_always_eager
+        self.app_conf.task_always_eager = True
+
+    def tearDown(self):
+        self.app_conf.task_always_eager = self.always_eager
+
+    def test_batch_calculation_for_all_buildings(self):
+        with self.settings(CALCULATION_BATCH_CONCURRENCY=2):
+            response = self.client.post(
+                reverse('counter:calculate_batch_payment'),
+                {'apartment_building_ids': 'all', 'year': '2024', 'month': '07'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(MonthlyCharge.objects.filter(year_month='2024-07').count(), Flat.objects.count())
+
+        response = self.client.get(reverse('counter:calculate_batch_progress', args=[response.data['job_id']]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_buildings'], 3)
+        self.assertEqual(response.data['completed_buildings'], 3)
+        self.assertEqual(response.data['failed_buildings'], 0)
+        self.assertEqual(response.data['calculated_flats'], 7)
+        self.assertEqual(response.data['buildings'][1]['total'], 5)
+        self.assertEqual(response.data['buildings'][1]['completed'], 5)
+
+    def test_buildings_with_active_job_are_skipped(self):
+        active_job = CalculationJob.objects.create(apartment_building_id=1, year_month='2024-07')
+        response = self.client.post(
+            reverse('counter:calculate_batch_payment'),
+            {'apartment_building_ids': [1, 2], 'year': '2024', 'month': '07'},
+            format='json',
+        )
+
+        progress = self.client.get(reverse('counter:calculate_batch_progress', args=[response.data['job_id']])).data
+        self.assertEqual(progress['skipped_buildings'], {1: str(active_job.id)})
+        self.assertEqual((progress['total_buildings'], progress['completed_buildings']), (1, 1))
+        self.assertFalse(MonthlyCharge.objects.filter(flat__apartment_building_id=1).exists())
+
+        # дом пакета рассчитан своим заданием расчета, прогресс дома ведется по этому заданию
+        job = CalculationJob.objects.get(apartment_building_id=2)
+        self.assertEqual((job.status, job.calculated), ('done', 2))
+        self.assertEqual(progress['buildings'][2]['job_id'], str(job.id))
+        CalculationJob.objects.filter(id=job.id).update(status='running')
+        response = self.client.get(reverse('counter:calculation_job_detail', args=[job.id]))
+        self.assertEqual((response.data['progress']['total'], response.data['progress']['completed']), (2, 2))
+
+    def test_expired_building_job_is_not_calculated(self):
+        job = CalculationJob.objects.create(apartment_building_id=2, year_month='2024-07', status='failed')
+        initialize_job_progress('batch', {2: str(job.id)}, '2024-07')
+        result = calculate_batch_lane_task('batch', [(2, str(job.id))], '2024', '07', {})
+        self.assertEqual(result[2]['status'], 'error')
+        self.assertFalse(MonthlyCharge.objects.exists())
+
+    def test_tariffs_are_read_once_per_job(self):
+        with mock.patch('counter.task.get_tariffs', wraps=get_tariffs) as job_tariffs, \
+                mock.patch('counter.calculator.get_tariffs', wraps=get_tariffs) as building_tariffs:
+            self.client.post(
+                reverse('counter:calculate_batch_payment'),
+                {'apartment_building_ids': [1, 2], 'year': '2024', 'month': '07'},
+                format='json',
+            )
+
+        self.assertEqual(job_tariffs.call_count, 1)
+        self.assertEqual(building_tariffs.call_count, 0)
+
+    def test_unknown_building_is_rejected(self):
+        response = self.client.post(
+            reverse('counter:calculate_batch_payment'),
+            {'apartment_building_ids': [1, 100], 'year': '2024', 'month': '07'},
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('apartment_building_ids', response.data)
+
+    def test_unknown_job_progress(self):
+        response = self.client.get(reverse('counter:calculate_batch_progress', args=['unknown']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CalculationProgressViewTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_progress_of_last_job_for_building(self):
+        calculator_payment(1, '2024', '07', job_id='first')
+        initialize_progress('second', 1, total_flats=5, completed=1)
+        update_progress('second', 1, 2)
+
+        response = self.client.get(reverse('counter:calculate_progress', args=[1]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['job_id'], 'second')
+        self.assertEqual((response.data['total'], response.data['completed']), (5, 3))
+        self.assertIsNone(response.data['finished_at'])
+        self.assertGreater(response.data['rate'], 0)
+        self.assertIsNotNone(response.data['eta_seconds'])
+
+        response = self.client.get(reverse('counter:calculate_progress', args=[1]), {'job_id': 'first'})
+        self.assertEqual((response.data['total'], response.data['completed']), (5, 5))
+        self.assertIsNotNone(response.data['finished_at'])
+
+    def test_progress_is_updated_once_per_batch(self):
+        with mock.patch('counter.progress.cache.incr') as incr, override_settings(CALCULATION_BATCH_SIZE=2):
+            calculator_payment(1, '2024', '07', job_id='batched')
+
+        self.assertEqual(incr.call_count, 3)
+
+    def test_unknown_job(self):
+        response = self.client.get(reverse('counter:calculate_progress', args=[1]), {'job_id': 'unknown'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TariffProviderTests(TestCase):
+    fixtures = ['tariffs.json']
+
+    def test_tariffs_are_loaded_once_until_changed(self):
+        provider = TariffProvider()
+        with self.assertNumQueries(1):
+            tariffs = provider.get_tariffs()
+            self.assertEqual(provider.get_tariffs(), tariffs)
+
+        self.assertEqual(tariffs['cold_water_for_flat'], Decimal('36.54'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Tariff.objects.filter(tariff_type='cold_water_for_flat').get().delete()
+            Tariff.objects.create(tariff_type='cold_water_for_flat', price='40.00', valid_from='2000-01-01')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(provider.get_tariffs()['cold_water_for_flat'], Decimal('40.00'))
+
+    def test_missing_tariff(self):
+        bump_tariffs_version()
+        Tariff.objects.filter(tariff_type='hot_water_for_flat').delete()
+
+        with self.assertRaises(Tariff.DoesNotExist):
+            TariffProvider().get_tariffs()
+
+
+class TariffHistoryTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        Tariff.objects.filter(tariff_type='cold_water_for_flat').update(valid_to='2024-06-30')
+        Tariff.objects.create(tariff_type='cold_water_for_flat', price='40.00', valid_from='2024-07-01')
+        bump_tariffs_version()
+
+    def test_price_at_date(self):
+        provider = TariffProvider()
+        self.assertEqual(provider.get_tariffs(date(2024, 6, 30))['cold_water_for_flat'], Decimal('36.54'))
+        self.assertEqual(provider.get_tariffs(date(2024, 7, 1))['cold_water_for_flat'], Decimal('40.00'))
+        self.assertEqual(provider.get_tariffs_for_month('2024', '07')['cold_water_for_flat'], Decimal('40.00'))
+        with self.assertRaises(Tariff.DoesNotExist):
+            provider.get_tariffs(date(1999, 12, 31))
+
+    def test_months_are_recalculated_with_their_tariffs_in_one_pass(self):
+        calculator_payment(1, '2024', '06')
+        MonthlyCharge.objects.update(cold_water_usage_price=0)
+        bump_tariffs_version()
+
+        # контрольная точка, квартиры, счетчики, показания, история тарифов, на каждый месяц транзакция
+        # (точка сохранения) с созданием и блокировкой итогов дома, прежними начислениями, пакетной записью
+        # и обновлением итогов, статус контрольной точки
+        with self.assertNumQueries(20):
+            result = recalculator_payment(1, ['2024-07', '2024-06'])
+        self.assertEqual(result, {'status': 'success', 'calculated': 10})
+
+        # квартира 9: в июне 100 - 90 = 10 кубометров, в июле 105 - 100 = 5 кубометров
+        charges = dict(MonthlyCharge.objects.filter(flat_id=9).values_list('year_month', 'cold_water_usage_price'))
+        self.assertEqual(charges, {'2024-06': Decimal('365.40'), '2024-07': Decimal('200.00')})
+
+    def test_failed_recalculation_is_recorded_and_reported(self):
+        with mock.patch.object(calculator, 'calculate_flats', side_effect=RuntimeError('recalculation failed')):
+            with self.assertRaises(RuntimeError):
+                recalculator_payment(1, ['2024-06', '2024-07'], job_id='recalculation')
+
+            stderr = io.StringIO()
+            call_command('recalculate_payments', '1', '--from', '2024-06', '--to', '2024-07', stdout=io.StringIO(), stderr=stderr)
+
+        checkpoint = CalculationCheckpoint.objects.get(job_id='recalculation')
+        self.assertEqual((checkpoint.status, checkpoint.year_month, checkpoint.error_message), ('failed', '2024-06', 'recalculation failed'))
+        self.assertEqual(stderr.getvalue().strip(), 'Дом 1: recalculation failed')
+
+    def test_recalculation_matches_monthly_calculation(self):
+        recalculator_payment(1, ['2024-06', '2024-07'])
+        recalculated = set(MonthlyCharge.objects.values_list(
+            'flat_id', 'year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price'))
+        MonthlyCharge.objects.all().delete()
+
+        calculator_payment(1, '2024', '06')
+        calculator_payment(1, '2024', '07')
+
+        self.assertEqual(recalculated, set(MonthlyCharge.objects.values_list(
+            'flat_id', 'year_month', 'maintenance_of_common_property', 'cold_water_usage_price', 'hot_water_usage_price')))
+
+
+class BulkMeterReadingViewTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.url = reverse('counter:add_meter_reading_bulk')
+
+    def test_json_array(self):
+        response = self.client.post(self.url, [
+            {'serial_number': '12345678', 'meter_reading_value': 110, 'meter_reading_date': '2024-08-20'},
+            {'serial_number': '87654321', 'meter_reading_value': 95, 'meter_reading_date': '2024-07-20'},
+            {'serial_number': '0000000000', 'meter_reading_value': 1},
+            {'serial_number': '12345679', 'meter_reading_value': -1},
+        ], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['saved'], response.data['failed']), (2, 2))
+        self.assertEqual([result['status'] for result in response.data['results']], ['success', 'success', 'error', 'error'])
+        self.assertEqual(WaterCounter.objects.get(pk=6).readings.last().value, 110)
+        self.assertEqual(WaterCounter.objects.get(pk=8).readings.get(reading_date='2024-07-20').value, 95)
+
+    def test_ndjson_stream(self):
+        body = '\n'.join([
+            json.dumps({'serial_number': '12345678', 'meter_reading_value': 110, 'meter_reading_date': '2024-08-20'}),
+            '{not json',
+            json.dumps({'serial_number': '12345678', 'meter_reading_value': 120, 'meter_reading_date': '2024-08-20'}),
+            '',
+        ])
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['status'] for result in response.data['results']], ['success', 'error', 'success'])
+        self.assertEqual(WaterCounter.objects.get(pk=6).readings.get(reading_date='2024-08-20').value, 120)
+
+    def test_serial_numbers_are_resolved_once_per_batch(self):
+        items = [
+            {'serial_number': serial_number, 'meter_reading_value': 200 + day, 'meter_reading_date': f'2024-08-{day:02d}'}
+            for day in range(1, 29) for serial_number in ('12345678', '87654321', '12345679')
+        ]
+        # счетчики, запись показаний, отметка устаревших начислений, дома счетчиков для смены версии данных
+        # и точка сохранения транзакции
+        with self.assertNumQueries(6):
+            response = self.client.post(self.url, items, format='json')
+
+        self.assertEqual(response.data['saved'], len(items))
+        self.assertEqual(MeterReading.objects.filter(reading_date__month=8).count(), len(items))
+
+    def test_object_instead_of_array(self):
+        response = self.client.post(self.url, {'serial_number': '12345678', 'meter_reading_value': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CounterExpirationTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json']
+
+    def setUp(self):
+        self.url = reverse('counter:expiring_water_counters')
+
+    def ids(self, response):
+        return [counter['id'] for counter in response.data['results']]
+
+    def test_expiration_date_is_maintained_on_save(self):
+        counter = WaterCounter.objects.get(pk=6)
+        self.assertEqual(counter.expiration_date, date(2024, 3, 14) + timedelta(days=6 * 365))
+
+        counter.verification_date = '2025-01-01'
+        counter.save(update_fields=['verification_date'])
+        self.assertEqual(WaterCounter.objects.get(pk=6).expiration_date, date(2025, 1, 1) + timedelta(days=6 * 365))
+
+        counter.type_water_counter = 'hot'
+        counter.save()
+        self.assertEqual(counter.expiration_date, date(2025, 1, 1) + timedelta(days=4 * 365))
+
+    def test_expiration_date_is_maintained_on_bulk_writes(self):
+        counter, = WaterCounter.objects.bulk_create([
+            WaterCounter(flat_id=2, serial_number='BULK000001', verification_date=date(2024, 1, 1), type_water_counter='hot'),
+        ])
+        self.assertEqual(WaterCounter.objects.get(pk=counter.pk).expiration_date, date(2024, 1, 1) + timedelta(days=4 * 365))
+
+        WaterCounter.objects.filter(pk=counter.pk).update(verification_date=date(2024, 6, 1), type_water_counter='cold')
+        self.assertEqual(WaterCounter.objects.get(pk=counter.pk).expiration_date, date(2024, 6, 1) + timedelta(days=6 * 365))
+
+    def test_expiring_counters_report(self):
+        # без границ - истекшие и истекающие в ближайшие 30 дней, в порядке окончания поверки
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(self.ids(response), list(
+            WaterCounter.objects.filter(expiration_date__lte=date.today() + timedelta(days=30))
+            .order_by('expiration_date', 'id').values_list('id', flat=True)
+        ))
+
+        response = self.client.get(self.url, {'expires_after': '2028-03-01', 'expires_before': '2028-03-31'})
+        self.assertEqual(self.ids(response), [8])
+        self.assertEqual(response.data['results'][0]['flat_number'], 1)
+
+        response = self.client.get(self.url, {'expires_before': '2022-12-31', 'type_water_counter': 'cold', 'page_size': 1})
+        self.assertEqual(self.ids(response), [3])
+        self.assertTrue(response.data['results'][0]['expired'])
+        self.assertEqual(self.ids(self.client.get(response.data['next'])), [4])
+
+
+class SerialNumberLookupTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_lookup_is_cached(self):
+        with self.assertNumQueries(1):
+            counters = resolve_serial_numbers(['12345678', '87654321', '0000000000'])
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_serial_numbers(['12345678', '87654321']), counters)
+
+        self.assertEqual(set(counters), {'12345678', '87654321'})
+        self.assertEqual(counters['87654321']['flat_id'], 9)
+        self.assertEqual(counters['87654321']['type_water_counter'], 'hot')
+
+    def test_cache_is_invalidated_on_change(self):
+        get_counter_by_serial('12345678')
+        counter = WaterCounter.objects.get(pk=6)
+        counter.serial_number = '12345670'
+        with self.captureOnCommitCallbacks(execute=True):
+            counter.save()
+
+        self.assertIsNone(get_counter_by_serial('12345678'))
+        self.assertEqual(get_counter_by_serial('12345670')['id'], 6)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            counter.delete()
+        self.assertIsNone(get_counter_by_serial('12345670'))
+
+    def test_serial_number_is_unique_across_flats(self):
+        response = APIClient().post(reverse('counter:water_counter_create'), {
+            'serial_number': '12345678', 'verification_date': '2024-01-01', 'type_water_counter': 'cold',
+            'apartment_building_id': 1, 'flat_number': 3,
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('serial_number', response.data)
+
+    def test_add_meter_reading(self):
+        url = reverse('counter:add_meter_reading')
+        response = APIClient().post(url, {'serial_number': '12345678', 'meter_reading_value': 150}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(WaterCounter.objects.get(pk=6).readings.last().value, 150)
+
+        response = APIClient().post(url, {'serial_number': '0000000000', 'meter_reading_value': 150}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncViewTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json']
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def add_reading_async(self, data):
+        request = self.factory.post('/api/v1/add-meter-reading/', json.dumps(data), content_type='application/json')
+        return async_to_sync(AsyncAddMeterReadingView.as_view())(request)
+
+    def test_reading_submission_matches_sync_view(self):
+        response = self.add_reading_async({'serial_number': '12345679', 'meter_reading_value': 130})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(response.content), {'serial_number': '12345679', 'meter_reading_value': 130})
+        self.assertTrue(MeterReading.objects.filter(counter_id=9, reading_date=date.today(), value=130).exists())
+
+        invalid = {'serial_number': 'unknown', 'meter_reading_value': 130}
+        expected = APIClient().post(reverse('counter:add_meter_reading'), invalid, format='json')
+        response = self.add_reading_async(invalid)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(json.loads(response.content), json.loads(expected.content))
+
+    def test_progress_matches_sync_view(self):
+        initialize_progress('async', 1, 5, completed=2)
+        view = AsyncCalculationProgressView.as_view()
+
+        response = async_to_sync(view)(self.factory.get('/'), apartment_building_id=1)
+        expected = APIClient().get(reverse('counter:calculate_progress', args=[1]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            {key: value for key, value in json.loads(response.content).items() if key not in ('rate', 'eta_seconds')},
+            {key: value for key, value in expected.data.items() if key not in ('rate', 'eta_seconds')},
+        )
+
+        response = async_to_sync(view)(self.factory.get('/'), apartment_building_id=999)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class FakePubSub:
+    """
+    Подписка Redis: каждое сообщение меняет прогресс в кеше перед тем, как быть полученным
+    """
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.channels = []
+        self.closed = False
+
+    def subscribe(self, *channels):
+        self.channels.extend(channels)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        if not self.steps:
+            return None
+        action, message = self.steps.pop(0)
+        action()
+        return {'type': 'message', 'data': json.dumps(message)}
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncFakePubSub(FakePubSub):
+    async def subscribe(self, *channels):
+        super().subscribe(*channels)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        return await sync_to_async(super().get_message)(ignore_subscribe_messages, timeout)
+
+    async def aclose(self):
+        self.close()
+
+
+@override_settings(CALCULATION_PROGRESS_STREAM_TIMEOUT=5, CALCULATION_PROGRESS_STREAM_KEEPALIVE=60)
+class ProgressStreamTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json']
+
+    def setUp(self):
+        cache.clear()
+        initialize_progress('stream', 1, 5, completed=2)
+
+    def steps(self):
+        def finish_first():
+            update_progress('stream', 1, 3)
+            finish_progress('stream', 1)
+
+        def finish_second():
+            initialize_progress('stream', 2, 4, completed=4)
+            finish_progress('stream', 2)
+
+        return [
+            (finish_first, {'job_id': 'stream', 'apartment_building_id': 1}),
+            # повторное сообщение без изменения прогресса не отправляется клиенту
+            (lambda: None, {'job_id': 'stream', 'apartment_building_id': 1}),
+            (finish_second, {'job_id': 'stream', 'apartment_building_id': 2}),
+        ]
+
+    def parse(self, events):
+        parsed = []
+        for event in events:
+            name, data = event.strip().split('\n')
+            parsed.append((name.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+        return parsed
+
+    def assert_progress_events(self, events):
+        self.assertEqual([event for event, _ in events], ['progress', 'progress', 'progress', 'end'])
+        self.assertEqual(
+            [(data['apartment_building_id'], data['completed'], data['finished_at'] is None) for _, data in events[:3]],
+            [(1, 2, True), (1, 5, False), (2, 4, False)],
+        )
+
+    def test_stream_sends_changes_until_buildings_are_finished(self):
+        pubsub = FakePubSub(self.steps())
+        events = self.parse(stream_progress(ProgressStream([1, 2]), pubsub))
+
+        self.assertEqual(pubsub.channels, ['calculation_progress:events:1', 'calculation_progress:events:2'])
+        self.assert_progress_events(events)
+        self.assertTrue(pubsub.closed)
+
+    def test_async_stream_matches_sync_stream(self):
+        async def collect_events(pubsub):
+            return [event async for event in astream_progress(ProgressStream([1, 2]), pubsub)]
+
+        pubsub = AsyncFakePubSub(self.steps())
+        self.assert_progress_events(self.parse(async_to_sync(collect_events)(pubsub)))
+        self.assertTrue(pubsub.closed)
+
+    def test_progress_changes_are_published(self):
+        with mock.patch('counter.progress.get_redis_connection') as get_redis_connection:
+            publish_progress('stream', 1)
+            publish_progress('stream')
+
+        pipeline = get_redis_connection.return_value.pipeline.return_value
+        message = json.dumps({'job_id': 'stream', 'apartment_building_id': 1})
+        self.assertEqual(pipeline.publish.call_args_list, [
+            mock.call('calculation_progress:events:1', message),
+            mock.call('calculation_job:events:stream', message),
+            mock.call('calculation_job:events:stream', json.dumps({'job_id': 'stream', 'apartment_building_id': None})),
+        ])
+
+    def test_stream_request_is_validated(self):
+        url = reverse('counter:calculate_progress_stream')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'apartment_building_ids': '1,a'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'apartment_building_ids': '1,100'}).status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(url, {'apartment_building_ids': '1,2', 'job_id': 'stream'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+
+class ReadingImportTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json']
+
+    CSV = (
+        'serial_number;meter_reading_value;meter_reading_date\n'
+        '12345678;110;2024-08-20\n'
+        '87654321;-5;2024-08-20\n'
+        '\n'
+        '0000000000;1;2024-08-20\n'
+        '12345679;130;2024-08-20\n'
+    )
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, 'readings.csv')
+        with open(self.file_path, 'w', encoding='utf-8') as file:
+            file.write(self.CSV)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_import_command(self):
+        call_command('import_readings', self.file_path, batch_size=2, stdout=io.StringIO())
+
+        reading_import = ReadingImport.objects.get()
+        self.assertEqual(reading_import.status, 'done')
+        self.assertEqual((reading_import.offset, reading_import.saved, reading_import.failed), (5, 2, 2))
+        self.assertEqual([error['row'] for error in reading_import.errors], [3, 5])
+        self.assertEqual(WaterCounter.objects.get(pk=6).readings.get(reading_date='2024-08-20').value, 110)
+        self.assertEqual(WaterCounter.objects.get(pk=9).readings.get(reading_date='2024-08-20').value, 130)
+
+    def test_interrupted_import_resumes_from_committed_offset(self):
+        reading_import = ReadingImport.objects.create(
+            file_path=self.file_path, file_format='csv', status='failed', offset=3, saved=1, failed=1,
+        )
+
+        call_command('import_readings', self.file_path, stdout=io.StringIO())
+
+        reading_import.refresh_from_db()
+        self.assertEqual(reading_import.status, 'done')
+        self.assertEqual((reading_import.saved, reading_import.failed), (2, 2))
+        # строки до offset повторно не загружаются
+        self.assertFalse(MeterReading.objects.filter(reading_date='2024-08-20', counter_id=6).exists())
+        self.assertTrue(MeterReading.objects.filter(reading_date='2024-08-20', counter_id=9).exists())
+
+    def test_upload_endpoint(self):
+        import_readings_task.app.conf.task_always_eager = True
+        self.addCleanup(setattr, import_readings_task.app.conf, 'task_always_eager', False)
+        upload = SimpleUploadedFile('readings.csv', self.CSV.encode(), content_type='text/csv')
+
+        with override_settings(READING_IMPORTS_DIR=self.directory.name):
+            response = APIClient().post(reverse('counter:reading_import_create'), {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = APIClient().get(reverse('counter:reading_import_detail', args=[response.data['id']]))
+        self.assertEqual(response.data['status'], 'done')
+        self.assertEqual((response.data['saved'], response.data['failed']), (2, 2))
+
+    def test_upload_rejects_unknown_format(self):
+        upload = SimpleUploadedFile('readings.txt', b'serial_number', content_type='text/plain')
+        response = APIClient().post(reverse('counter:reading_import_create'), {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ReadingImport.objects.exists())
+
+
+class StaleChargeTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        for year_month in ('2024-06', '2024-07', '2024-08'):
+            year, month = year_month.split('-')
+            calculator_payment(1, year, month)
+            calculator_payment(2, year, month)
+
+    def stale(self):
+        return set(MonthlyCharge.objects.filter(stale_since__isnull=False).values_list('flat_id', 'year_month'))
+
+    def test_late_reading_marks_month_and_following_months(self):
+        WaterCounter.objects.get(pk=6).add_meters('2024-07-25', 130)
+        self.assertEqual(self.stale(), {(9, '2024-07'), (9, '2024-08')})
+
+    def test_moved_and_deleted_readings_mark_charges(self):
+        reading = MeterReading.objects.create(counter_id=6, reading_date=date(2024, 7, 25), value=130)
+        MonthlyCharge.objects.update(stale_since=None)
+
+        # показания перенесены на следующий месяц: отмечается и прежний месяц
+        reading.reading_date = date(2024, 8, 25)
+        reading.save()
+        self.assertEqual(self.stale(), {(9, '2024-07'), (9, '2024-08')})
+
+        MonthlyCharge.objects.update(stale_since=None)
+        reading.delete()
+        self.assertEqual(self.stale(), {(9, '2024-08')})
+
+        MonthlyCharge.objects.update(stale_since=None)
+        MeterReading.objects.filter(counter_id=9).delete()
+        self.assertEqual(self.stale(), {(7, '2024-07'), (7, '2024-08')})
+
+    def test_bulk_readings_mark_charges(self):
+        ingest_readings([
+            {'serial_number': '12345678', 'meter_reading_value': 130, 'meter_reading_date': '2024-08-25'},
+            {'serial_number': '12345679', 'meter_reading_value': 10, 'meter_reading_date': '2024-06-25'},
+        ])
+        self.assertEqual(self.stale(), {(9, '2024-08'), (7, '2024-06'), (7, '2024-07'), (7, '2024-08')})
+
+    def test_flat_and_counter_changes_mark_current_month_onward(self):
+        MonthlyCharge.objects.filter(year_month='2024-08').update(year_month='2099-01')
+
+        flat = Flat.objects.get(pk=2)
+        flat.number_of_registered = 3
+        flat.save()
+        counter = WaterCounter.objects.get(pk=6)
+        counter.verification_date = '2018-01-01'
+        counter.save()
+        Flat.objects.get(pk=3).save()
+
+        self.assertEqual(self.stale(), {(2, '2099-01'), (9, '2099-01')})
+
+    def test_recalculation_of_stale_charges_only(self):
+        MonthlyCharge.objects.exclude(flat_id=9).update(hot_water_usage_price=Decimal('1.00'))
+        WaterCounter.objects.get(pk=6).add_meters('2024-07-25', 130)
+
+        call_command('recalculate_payments', '--stale', stdout=io.StringIO())
+
+        charge = MonthlyCharge.objects.get(flat_id=9, year_month='2024-07')
+        expected = (Decimal(25) * Tariff.objects.get(tariff_type='cold_water_for_flat').price).quantize(Decimal('0.01'))
+        self.assertEqual(charge.cold_water_usage_price, expected)
+        self.assertEqual(self.stale(), set())
+        # остальные начисления не пересчитывались
+        self.assertFalse(MonthlyCharge.objects.exclude(flat_id=9).exclude(hot_water_usage_price=Decimal('1.00')).exists())
+
+    def test_charges_marked_during_recalculation_stay_stale(self):
+        WaterCounter.objects.get(pk=6).add_meters('2024-07-25', 130)
+        calculate_flats = calculator.calculate_flats
+
+        def mark_during_calculation(*args, **kwargs):
+            # отметка транзакции, начатой до перерасчета и зафиксированной после чтения устаревших начислений
+            MonthlyCharge.objects.filter(flat_id=9, stale_since__isnull=False).update(stale_since=timezone.now() - timedelta(minutes=1))
+            return calculate_flats(*args, **kwargs)
+
+        with mock.patch.object(calculator, 'calculate_flats', side_effect=mark_during_calculation):
+            recalculate_stale_charges(1)
+        self.assertEqual(self.stale(), {(9, '2024-07'), (9, '2024-08')})
+
+
+class CalculationPreviewTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.url = reverse('counter:calculate_payment_preview')
+        self.data = {'apartment_building_id': 1, 'year': '2024', 'month': '07'}
+
+    def test_preview_matches_calculation_without_saving(self):
+        response = self.client.post(self.url, self.data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['cached'])
+        self.assertFalse(MonthlyCharge.objects.exists())
+
+        calculator_payment(1, '2024', '07')
+        expected = {
+            charge.flat_id: (charge.maintenance_of_common_property, charge.cold_water_usage_price, charge.hot_water_usage_price)
+            for charge in MonthlyCharge.objects.all()
+        }
+        self.assertEqual({
+            flat['flat_id']: (flat['maintenance_of_common_property'], flat['cold_water_usage_price'], flat['hot_water_usage_price'])
+            for flat in response.data['flats']
+        }, expected)
+
+    def test_repeated_preview_is_cached(self):
+        self.client.post(self.url, self.data, format='json')
+        # только проверка существования дома в сериализаторе
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, self.data, format='json')
+        self.assertTrue(response.data['cached'])
+
+    def test_cache_is_invalidated_by_readings_and_tariffs(self):
+        self.client.post(self.url, self.data, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest_readings([{'serial_number': '12345678', 'meter_reading_value': 130, 'meter_reading_date': '2024-07-25'}])
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertFalse(response.data['cached'])
+        flat = next(flat for flat in response.data['flats'] if flat['flat_id'] == 9)
+        price = Tariff.objects.get(tariff_type='cold_water_for_flat').price
+        self.assertEqual(flat['cold_water_usage_price'], (Decimal(25) * price).quantize(Decimal('0.01')))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Tariff.objects.filter(tariff_type='cold_water_for_flat').first().save()
+        self.assertFalse(self.client.post(self.url, self.data, format='json').data['cached'])
+
+
+@skipUnless(kernel.kernel_available(), 'numpy не установлен')
+class CalculationKernelTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def test_kernel_matches_decimal_calculation(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            tariffs = {
+                tariff_type: Decimal(rng.randint(1, 99999)) / 100
+                for tariff_type in ('maintenance_of_common_property', 'cold_water_for_flat', 'hot_water_for_flat')
+            }
+            current_date = date(2024, 7, 1) + timedelta(days=rng.randint(0, 60))
+            rows = generate_rows(300, '2024', '07', seed)
+
+            expected = [
+                (
+                    flat.id,
+                    *(to_price(price) for price in calculate_flat_payment(flat, tariffs, current_date, '2024', '07')),
+                    calculator.flat_billed_by_norm(flat, current_date, '2024', '07'),
+                )
+                for flat in build_flats(*rows)
+            ]
+            columns = kernel.build_columns(*rows, '2024', '07')
+            self.assertEqual(kernel.charges_to_decimal(kernel.compute_charges(columns, tariffs, current_date)), expected, seed)
+
+    def test_calculator_uses_kernel(self):
+        expected = {}
+        for apartment_building in ApartmentBuilding.objects.all():
+            calculator_payment(apartment_building.id, '2024', '07')
+        for charge in MonthlyCharge.objects.all():
+            expected[charge.flat_id] = (
+                charge.maintenance_of_common_property, charge.cold_water_usage_price, charge.hot_water_usage_price, charge.billed_by_norm,
+            )
+        MonthlyCharge.objects.all().delete()
+
+        with override_settings(CALCULATION_KERNEL='numpy'), mock.patch('counter.calculator.calculate_flats') as calculate_flats:
+            for apartment_building in ApartmentBuilding.objects.all():
+                calculator_payment(apartment_building.id, '2024', '07')
+
+        calculate_flats.assert_not_called()
+        self.assertEqual({
+            charge.flat_id: (
+                charge.maintenance_of_common_property, charge.cold_water_usage_price, charge.hot_water_usage_price, charge.billed_by_norm,
+            )
+            for charge in MonthlyCharge.objects.all()
+        }, expected)
+
+
+class BenchmarkTests(TestCase):
+
+    def test_synthetic_dataset_covers_calculation_cases(self):
+        dataset = create_dataset(buildings=2, flats=100, months=3, year='2024', month='07', seed=1)
+
+        self.assertEqual(Flat.objects.count(), dataset['flats'])
+        self.assertEqual(MeterReading.objects.count(), dataset['meter_readings'])
+        self.assertTrue(Flat.objects.filter(water_counters__isnull=True).exists())
+        self.assertTrue(WaterCounter.objects.filter(verification_date__lt='2018-01-01').exists())
+        self.assertTrue(MeterReading.objects.filter(reading_date__gte='2024-08-01').exists())
+        self.assertTrue(WaterCounter.objects.exclude(readings__reading_date__month=7).exists())
+
+    def test_benchmarks_leave_database_unchanged(self):
+        output = io.StringIO()
+        call_command('benchmark_pipeline', flats=20, months=2, repeat=1, polls=2, stdout=output)
+
+        results = json.loads(output.getvalue())
+        self.assertEqual(
+            set(results['results']) - {'calculator_payment_numpy'},
+            {'calculator_payment', 'detail_view', 'reading_ingestion', 'progress_polling'},
+        )
+        self.assertGreater(results['results']['calculator_payment']['queries'], 0)
+        self.assertFalse(ApartmentBuilding.objects.exists())
+        self.assertFalse(MeterReading.objects.exists())
+
+
+class ConnectionBenchmarkTests(TransactionTestCase):
+
+    def test_connection_benchmark_removes_its_data(self):
+        output = io.StringIO()
+        call_command('benchmark_connections', requests=3, counters=2, stdout=output)
+
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual(set(results), {'no_reuse', 'persistent', 'persistent_health_checks'})
+        self.assertEqual(results['persistent']['requests'], 3)
+        self.assertFalse(ApartmentBuilding.objects.exists())
+        self.assertFalse(MeterReading.objects.exists())
+
+
+class ChargeExportTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json']
+
+    def setUp(self):
+        for year_month in ('2024-06', '2024-07', '2024-08'):
+            for flat in Flat.objects.all():
+                MonthlyCharge.objects.create(
+                    flat=flat, year_month=year_month, maintenance_of_common_property=Decimal('100.50'),
+                    cold_water_usage_price=Decimal('10.00'), hot_water_usage_price=Decimal('0.00'),
+                )
+        self.url = reverse('counter:charges_export')
+
+    def test_csv_export_is_streamed(self):
+        response = APIClient().get(self.url, {'apartment_building_id': 1, 'month_from': '2024-07', 'month_to': '2024-08'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        expected = MonthlyCharge.objects.filter(flat__apartment_building_id=1, year_month__in=['2024-07', '2024-08']).count()
+        self.assertEqual(rows[0][:4], ['apartment_building_id', 'flat_id', 'flat_number', 'year_month'])
+        self.assertEqual(len(rows) - 1, expected)
+        self.assertEqual({row[0] for row in rows[1:]}, {'1'})
+        self.assertEqual(rows[1][4:], ['100.50', '10.00', '0.00'])
+
+    def test_ndjson_export_reads_charges_in_chunks(self):
+        with mock.patch('counter.export.EXPORT_BUFFER_ROWS', 2):
+            chunks = list(export_charges(file_format='ndjson', chunk_size=3))
+
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(len(lines), MonthlyCharge.objects.count())
+        self.assertEqual(json.loads(lines[0])['maintenance_of_common_property'], '100.50')
+        self.assertGreater(len(chunks), 1)
+
+    def test_invalid_period(self):
+        response = APIClient().get(self.url, {'month_from': '2024-08', 'month_to': '2024-07'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_async_export_streams_chunks(self):
+        async def read(response):
+            return [chunk async for chunk in response.streaming_content]
+
+        request = RequestFactory().get('/', {'apartment_building_id': 1, 'month_from': '2024-07'})
+        with mock.patch('counter.export.EXPORT_BUFFER_ROWS', 2):
+            response = async_to_sync(AsyncChargeExportView.as_view())(request)
+            self.assertTrue(response.is_async)
+            chunks = async_to_sync(read)(response)
+
+        rows = list(csv.reader(io.StringIO(b''.join(chunks).decode())))
+        self.assertEqual(rows[0][:4], ['apartment_building_id', 'flat_id', 'flat_number', 'year_month'])
+        self.assertEqual(len(rows) - 1, MonthlyCharge.objects.filter(flat__apartment_building_id=1, year_month__gte='2024-07').count())
+        self.assertGreater(len(chunks), 2)
+
+        async def export():
+            return [chunk async for chunk in aexport_charges(file_format='ndjson', chunk_size=3)]
+        self.assertEqual(''.join(async_to_sync(export)()), ''.join(export_charges(file_format='ndjson')))
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'charges.csv')
+            call_command('export_charges', '1', '--from', '2024-08', '--output', output, stdout=io.StringIO())
+            with open(output, encoding='utf-8') as file:
+                rows = list(csv.reader(file))
+
+        self.assertEqual(len(rows) - 1, MonthlyCharge.objects.filter(flat__apartment_building_id=1, year_month='2024-08').count())
+
+
+class MeterReadingTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json']
+
+    def test_add_meters_keeps_history(self):
+        counter = WaterCounter.objects.get(pk=6)
+        for month in range(1, 13):
+            counter.add_meters(f'2025-{month:02d}-20', 200 + month)
+
+        self.assertEqual(counter.readings.count(), 15)
+
+    def test_add_meters_replaces_reading_of_same_day(self):
+        counter = WaterCounter.objects.get(pk=6)
+        counter.add_meters('2024-07-20', 110)
+
+        self.assertEqual(counter.readings.count(), 3)
+        self.assertEqual(counter.readings.get(reading_date='2024-07-20').value, 110)
+
+    def test_last_readings_up_to_month_in_one_query(self):
+        with self.assertNumQueries(1):
+            readings = list(MeterReading.objects.last_up_to_month('2024', '06'))
+
+        by_counter = {}
+        for reading in readings:
+            by_counter.setdefault(reading.counter_id, []).append(reading.value)
+
+        self.assertEqual(by_counter, {2: [105, 100], 6: [100, 90], 8: [80, 75]})
+
+    def test_prune_meter_readings_keeps_last_readings(self):
+        call_command('prune_meter_readings', keep=2, stdout=io.StringIO())
+
+        self.assertEqual(
+            list(WaterCounter.objects.get(pk=6).readings.values_list('value', flat=True)),
+            [100, 105],
+        )
+        self.assertEqual(MeterReading.objects.count(), 8)
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTests(TestCase):
+    fixtures = ['apartmentbuildings.json', 'flats.json', 'watercounters.json', 'meterreadings.json', 'tariffs.json']
+
+    def setUp(self):
+        registry.reset()
+        cache.clear()
+
+    def counter_value(self, name, **labels):
+        return collect()['counters'].get((name, tuple(sorted(labels.items()))), 0)
+
+    def test_request_metrics(self):
+        with self.assertLogs('counter.metrics', level='INFO') as logs:
+            response = self.client.get(reverse('counter:apartment_building_detail', args=[1]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(
+            self.counter_value('counter_http_requests_total', view='apartment_building_detail', method='GET', status='200'), 1
+        )
+        self.assertGreater(self.counter_value('counter_http_db_queries_total', view='apartment_building_detail'), 0)
+        event = json.loads(logs.records[0].getMessage())
+        self.assertEqual(event['view'], 'apartment_building_detail')
+        self.assertGreater(event['db_queries'], 0)
+
+    def test_calculation_phases(self):
+        with self.assertLogs('counter.metrics', level='INFO') as logs:
+            calculator_payment(1, '2024', '07')
+
+        event = json.loads(logs.records[0].getMessage())
+        self.assertEqual(event['status'], 'success')
+        self.assertEqual(set(event['phases']), {'load', 'compute', 'save', 'progress'})
+        self.assertEqual(
+            self.counter_value('counter_calculation_flats_total', operation='calculator_payment'), event['calculated']
+        )
+
+    def test_metrics_endpoint(self):
+        with self.assertLogs('counter.metrics', level='INFO'):
+            self.client.get(reverse('counter:apartment_building_detail', args=[1]))
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE counter_http_request_duration_seconds histogram', body)
+        self.assertIn('counter_http_request_duration_seconds_bucket{view="apartment_building_detail",le="+Inf"} 1', body)
+
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(METRICS_ALLOWED_IPS=['127.0.0.1', '172.16.0.0/12'], METRICS_TOKEN='secret')
+    def test_metrics_access(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='172.18.0.1').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.1').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(
+            self.client.get(url, REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret').status_code, status.HTTP_200_OK
+        )
+        self.assertEqual(
+            self.client.get(url, REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer wrong').status_code, status.HTTP_403_FORBIDDEN
+        )
+
+    def test_processes_are_registered_in_redis_set(self):
+        client = mock.Mock()
+        client.smembers.return_value = {b'metrics:process:a:1', b'metrics:process:b:2'}
+        cache.set('metrics:process:b:2', {'counters': {('counter_calculation_flats_total', ()): 5}, 'histograms': {}})
+        with mock.patch('counter.metrics.get_redis_connection', return_value=client):
+            registry.flush()
+            metrics = collect()
+
+        self.assertTrue(client.sadd.call_args.args[1].startswith('metrics:process:'))
+        self.assertEqual(metrics['counters'][('counter_calculation_flats_total', ())], 5)
+        # процесс без значений в кеше удаляется из множества одной командой
+        client.srem.assert_called_once_with('metrics:processes', 'metrics:process:a:1')
+
+    def test_async_requests_are_recorded(self):
+        async def get_response(request):
+            return JsonResponse({}, status=status.HTTP_200_OK)
+
+        middleware = MetricsMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        request = RequestFactory().get(reverse('counter:calculate_progress', args=[1]))
+        request.resolver_match = resolve(request.path)
+        with self.assertLogs('counter.metrics', level='INFO'):
+            async_to_sync(middleware)(request)
+
+        self.assertEqual(
+            self.counter_value('counter_http_requests_total', view='calculate_progress', method='GET', status='200'), 1
+        )
+
+    def test_cache_calls_are_counted(self):
+        stats = mock.Mock(cache_calls=0)
+        with mock.patch('counter.metrics.current_stats') as current_stats, \
+                mock.patch('django_redis.client.DefaultClient.get_client') as get_client:
+            current_stats.get.return_value = stats
+            InstrumentedRedisClient.get_client(mock.Mock(spec=InstrumentedRedisClient), write=False)
+        self.assertEqual(stats.cache_calls, 1)
+        get_client.assert_called_once_with(write=False)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            MetricsMiddleware(lambda request: None)
+        with phase('load'):
+            calculator_payment(1, '2024', '07')
+
+        self.assertEqual(registry.snapshot(), {'counters': {}, 'histograms': {}})
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
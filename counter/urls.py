@@ -1,20 +1,56 @@
+from django.conf import settings
 from django.urls import path
 from .views import (ApartmentBuildingDetailView, 
                     ApartmentBuildingCreateView, 
                     FlatCreateView,
                     WaterCounterCreateView,
                     AddMeterReadingView,
+                    AsyncAddMeterReadingView,
+                    BulkMeterReadingView,
+                    ReadingImportCreateView,
+                    ReadingImportDetailView,
+                    ChargeExportView,
+                    AsyncChargeExportView,
                     CalculatePaymentView,
-                    CalculationProgressView,)
+                    CalculatePaymentPreviewView,
+                    CalculationProgressView,
+                    AsyncCalculationProgressView,
+                    CalculationProgressStreamView,
+                    AsyncCalculationProgressStreamView,
+                    CalculationJobListView,
+                    CalculationJobDetailView,
+                    BuildingMonthlySummaryListView,
+                    ExpiringWaterCounterListView,
+                    CalculateBatchPaymentView,
+                    BatchCalculationProgressView,)
 
 app_name = 'counter'
 
+# в режиме ASGI показания, прогресс расчета и выгрузка начислений обрабатываются асинхронными представлениями
+# с теми же ответами
+add_meter_reading_view = (AsyncAddMeterReadingView if settings.ASYNC_VIEWS else AddMeterReadingView).as_view()
+calculation_progress_view = (AsyncCalculationProgressView if settings.ASYNC_VIEWS else CalculationProgressView).as_view()
+calculation_progress_stream_view = (AsyncCalculationProgressStreamView if settings.ASYNC_VIEWS else CalculationProgressStreamView).as_view()
+charge_export_view = (AsyncChargeExportView if settings.ASYNC_VIEWS else ChargeExportView).as_view()
+
 urlpatterns = [
     path('apartment-building/<int:pk>/', ApartmentBuildingDetailView.as_view(), name='apartment_building_detail'),
     path('create/apartment-building/', ApartmentBuildingCreateView.as_view(), name='apartment_building_create'),
     path('create/flat/', FlatCreateView.as_view(), name='flat-create'),
     path('create/water-counter/', WaterCounterCreateView.as_view(), name='water_counter_create'),
-    path('add-meter-reading/', AddMeterReadingView.as_view(), name='add_meter_reading'),
+    path('water-counters/expiring/', ExpiringWaterCounterListView.as_view(), name='expiring_water_counters'),
+    path('add-meter-reading/', add_meter_reading_view, name='add_meter_reading'),
+    path('add-meter-reading/bulk/', BulkMeterReadingView.as_view(), name='add_meter_reading_bulk'),
+    path('import-meter-readings/', ReadingImportCreateView.as_view(), name='reading_import_create'),
+    path('import-meter-readings/<int:pk>/', ReadingImportDetailView.as_view(), name='reading_import_detail'),
+    path('export-charges/', charge_export_view, name='charges_export'),
     path('calculate-payment', CalculatePaymentView.as_view(), name='calculate_payment'),
-    path('calculate-progress/<int:apartment_building_id>/', CalculationProgressView.as_view(), name='calculate_progress'),
+    path('calculate-payment/preview', CalculatePaymentPreviewView.as_view(), name='calculate_payment_preview'),
+    path('calculate-progress/<int:apartment_building_id>/', calculation_progress_view, name='calculate_progress'),
+    path('calculate-progress/stream/', calculation_progress_stream_view, name='calculate_progress_stream'),
+    path('calculation-jobs/', CalculationJobListView.as_view(), name='calculation_job_list'),
+    path('calculation-jobs/<uuid:pk>/', CalculationJobDetailView.as_view(), name='calculation_job_detail'),
+    path('billing-summary/', BuildingMonthlySummaryListView.as_view(), name='billing_summary'),
+    path('calculate-payment/batch', CalculateBatchPaymentView.as_view(), name='calculate_batch_payment'),
+    path('calculate-progress/batch/<str:job_id>/', BatchCalculationProgressView.as_view(), name='calculate_batch_progress'),
 ]
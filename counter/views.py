@@ -1,21 +1,50 @@
+import datetime
+import json
+import os
+import uuid
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
 from rest_framework import generics
 from rest_framework.views import APIView
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework.response import Response
 from django_filters import rest_framework as django_filters
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiExample
-from django.db.models import Count
+from django.db.models import Count, Prefetch
 
-from .models import ApartmentBuilding, Flat, WaterCounter
+from .export import EXPORT_FORMATS, aexport_charges, export_charges
+from .imports import detect_format
+from .jobs import submit_calculation_job
+from .metrics import collect, metrics_access_allowed, render_prometheus
+from .models import ApartmentBuilding, BuildingMonthlySummary, CalculationJob, Flat, MeterReading, MonthlyCharge, ReadingImport, Tariff, WaterCounter
 from .serializers import (ApartmentBuildingSerializer, 
                         FlatSerializer, 
                         ApartmentBuildingCreateSerializer, 
                         FlatCreateSerializer,
                         WaterCounterCreateSerializer,
                         MeterReadingSerializer,
-                        CalculatorPaymentSerializer,)
-from .calculator import get_calculation_progress
-from .task import calculate_payment_task
+                        CalculatorPaymentSerializer,
+                        CalculatorBatchPaymentSerializer,
+                        CalculationJobSerializer,
+                        BuildingMonthlySummarySerializer,
+                        ExpiringWaterCounterSerializer,
+                        ReadingImportSerializer,
+                        ReadingImportCreateSerializer,
+                        ChargeExportSerializer,)
+from .parsers import NDJSONParser
+from .preview import preview_payment
+from .progress import aget_calculation_progress, get_calculation_progress, get_job_progress
+from .readings import ingest_readings
+from .streams import ProgressStream, astream_progress, stream_progress
+from .task import calculate_payment_task, calculate_batch_payment_task, import_readings_task
 
 
 class FlatFilter(django_filters.FilterSet):
@@ -36,37 +65,95 @@ class FlatFilter(django_filters.FilterSet):
         return queryset
     
 
+# срок, в течение которого счетчики считаются истекающими, если граница отчета не задана, в днях
+EXPIRING_COUNTERS_DAYS = 30
+
+
+class ExpiringWaterCounterFilter(django_filters.FilterSet):
+    """
+    Границы срока окончания поверки для отчета об истекающих счетчиках
+    """
+    expires_after = django_filters.DateFilter(field_name='expiration_date', lookup_expr='gte', label='Поверка истекает не раньше')
+    expires_before = django_filters.DateFilter(field_name='expiration_date', lookup_expr='lte', label='Поверка истекает не позже')
+
+    class Meta:
+        model = WaterCounter
+        fields = ['type_water_counter']
+
+
+class ExpiringWaterCounterPagination(CursorPagination):
+    """
+    Постраничная выдача счетчиков по дате окончания поверки (keyset) в порядке индекса counter_expiration_idx
+    """
+    ordering = ('expiration_date', 'id')
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class FlatCursorPagination(CursorPagination):
+    """
+    Постраничная выдача квартир дома по номеру квартиры (keyset), 
+    стоимость получения страницы не зависит от ее номера
+    """
+    ordering = 'number'
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def get_ordering(self, request, queryset, view):
+        ordering = request.query_params.get('ordering', self.ordering)
+        return (ordering,) if ordering in ('number', '-number') else (self.ordering,)
+
+
 @extend_schema(
         tags=['Data'],
-        description='Получение данны о доме, находящихся в нем квартирах и переданных показаниях',
+        description='Получение данны о доме, находящихся в нем квартирах и переданных показаниях. '
+                    'Квартиры выдаются постранично, ссылки на соседние страницы передаются в полях next и previous',
         parameters=[
             OpenApiParameter('ordering', description='Поле для сортировки, можно указать номер квартиры, например, "number" или "-number" для убывания.', required=False, type=str),
             OpenApiParameter('no_water_counters', description='Получить только те квартиры, где нет счетчиков воды', required=False, type=bool),
+            OpenApiParameter('cursor', description='Курсор страницы из полей next или previous', required=False, type=str),
+            OpenApiParameter('page_size', description='Количество квартир на странице', required=False, type=int),
+            OpenApiParameter('include_meters', description='Передавать последние показания счетчиков (не больше METER_READINGS_RETENTION на счетчик), по умолчанию true', required=False, type=bool),
+            OpenApiParameter('include_charges', description='Передавать начисления по квартирам, по умолчанию false', required=False, type=bool),
         ]
     )
 class ApartmentBuildingDetailView(generics.RetrieveAPIView):
     queryset = ApartmentBuilding.objects.all()
     serializer_class = ApartmentBuildingSerializer
-    ordering_fields = ['flats__number']
-    ordering = ['flats__number']
+    pagination_class = FlatCursorPagination
 
     http_method_names = ['get']
 
     def get(self, request, *args, **kwargs):
         building = self.get_object()
+        context = {
+            'include_flats': False,
+            'include_meters': request.GET.get('include_meters', 'true').lower() != 'false',
+            'include_charges': request.GET.get('include_charges', 'false').lower() == 'true',
+        }
             
         flats = Flat.objects.filter(apartment_building=building)
             
         flats_filtered = FlatFilter(request.GET, queryset=flats).qs
 
-        ordering = request.GET.get('ordering', 'number')
-        if ordering:
-            flats_filtered = flats_filtered.order_by(ordering)
+        # счетчики, показания и начисления страницы загружаются одним запросом каждые,
+        # история показаний не ограничена, поэтому передаются только последние показания каждого счетчика
+        prefetch = ['water_counters']
+        if context['include_meters']:
+            prefetch.append(Prefetch(
+                'water_counters__readings', queryset=MeterReading.objects.last_per_counter(settings.METER_READINGS_RETENTION),
+            ))
+        if context['include_charges']:
+            prefetch.append(Prefetch('charges', queryset=MonthlyCharge.objects.order_by('year_month')))
+        flats_filtered = flats_filtered.prefetch_related(*prefetch)
 
-        flat_serializer = FlatSerializer(flats_filtered, many=True)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(flats_filtered, request, view=self)
 
-        building_data = ApartmentBuildingSerializer(building).data
-        building_data['flats'] = flat_serializer.data
+        building_data = ApartmentBuildingSerializer(building, context=context).data
+        building_data['flats'] = FlatSerializer(page, many=True, context=context).data
+        building_data['next'] = paginator.get_next_link()
+        building_data['previous'] = paginator.get_previous_link()
 
         return Response(building_data)
     
@@ -151,6 +238,110 @@ class AddMeterReadingView(generics.CreateAPIView):
     serializer_class = MeterReadingSerializer
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAddMeterReadingView(View):
+    """
+    Асинхронная версия AddMeterReadingView для режима ASGI (ASYNC_VIEWS) с теми же ответами.
+    Проверка и запись показаний выполняются одним вызовом в потоке запроса: запись идет в транзакции,
+    которую асинхронный ORM не поддерживает, а цикл событий в это время обслуживает другие запросы
+    """
+    async def post(self, request):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body)
+            except ValueError as e:
+                return JsonResponse({"detail": f"JSON parse error - {e}"}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            data = request.POST
+
+        serializer = MeterReadingSerializer(data=data)
+        if not await sync_to_async(save_serializer)(serializer):
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def save_serializer(serializer) -> bool:
+    if not serializer.is_valid():
+        return False
+    serializer.save()
+    return True
+
+
+@extend_schema(
+    tags=['Data'],
+    description='Пакетная передача показаний счетчиков: массив JSON или поток NDJSON (Content-Type: application/x-ndjson), '
+                'по одному показанию в элементе. Дата показаний необязательна, по умолчанию - текущая. '
+                'Результат возвращается по каждому элементу в порядке передачи',
+    request={
+        'application/json': {'type': 'array', 'items': {'type': 'object'}},
+        'application/x-ndjson': {'type': 'string'},
+    },
+    examples=[
+        OpenApiExample(
+            'Example Request',
+            value=[
+                {"serial_number": "1234567890", "meter_reading_value": 110, "meter_reading_date": "2024-07-20"},
+                {"serial_number": "1234567891", "meter_reading_value": 56}
+            ]
+        )
+    ],
+)
+class BulkMeterReadingView(APIView):
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request):
+        items = request.data
+        if isinstance(items, dict):
+            return Response({"status": "error", "message": "Ожидается массив показаний."}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = ingest_readings(items)
+        failed = sum(1 for result in results if result['status'] == 'error')
+
+        return Response(
+            {"total": len(results), "saved": len(results) - failed, "failed": failed, "results": results},
+            status=status.HTTP_200_OK,
+        )
+
+
+@extend_schema(
+    tags=['Data'],
+    request={'multipart/form-data': ReadingImportCreateSerializer},
+    responses=ReadingImportSerializer,
+    description='Загрузка файла показаний CSV или XLSX с колонками serial_number, meter_reading_value '
+                'и необязательной meter_reading_date. Файл обрабатывается в фоне, '
+                'состояние загрузки доступно по возвращенному ID',
+)
+class ReadingImportCreateView(APIView):
+    parser_classes = [MultiPartParser]
+
+    def post(self, request):
+        serializer = ReadingImportCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        file = serializer.validated_data['file']
+        file_format = detect_format(file.name)
+        os.makedirs(settings.READING_IMPORTS_DIR, exist_ok=True)
+        file_path = os.path.join(settings.READING_IMPORTS_DIR, f'{uuid.uuid4().hex}.{file_format}')
+        with open(file_path, 'wb') as destination:
+            for chunk in file.chunks():
+                destination.write(chunk)
+
+        reading_import = ReadingImport.objects.create(file_path=file_path, file_format=file_format)
+        import_readings_task.delay(reading_import.id)
+
+        return Response(ReadingImportSerializer(reading_import).data, status=status.HTTP_202_ACCEPTED)
+
+
+@extend_schema(
+    tags=['Data'],
+    description='Состояние загрузки файла показаний: обработанные строки, количество записанных показаний и ошибки',
+)
+class ReadingImportDetailView(generics.RetrieveAPIView):
+    queryset = ReadingImport.objects.all()
+    serializer_class = ReadingImportSerializer
+
+
 @extend_schema(
     tags=['Calculator'],
     request=CalculatorPaymentSerializer,
@@ -174,25 +365,292 @@ class CalculatePaymentView(APIView):
             year = serializer.validated_data['year']
             month = serializer.validated_data['month']
             
+            job, created = submit_calculation_job(apartment_building_id, f"{year}-{month}")
+            job_id = str(job.id)
+            if not created:
+                return Response({"status": "success", "message": "Расчет уже запущен.", "job_id": job_id}, status=status.HTTP_200_OK)
+
             # Запускаем задачу в Celery
-            calculate_payment_task.delay(apartment_building_id, year, month)
+            calculate_payment_task.delay(apartment_building_id, year, month, job_id=job_id)
             
-            return Response({"status": "success", "message": "Расчет запущен."}, status=status.HTTP_202_ACCEPTED)
+            return Response({"status": "success", "message": "Расчет запущен.", "job_id": job_id}, status=status.HTTP_202_ACCEPTED)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
 @extend_schema(
     tags=['Calculator'],
-    description='Получение данных о прогрессе расчета кварплаты. Передайте ID дома, для которого запущен расчет',
+    request=CalculatorPaymentSerializer,
+    description='Предварительный расчет платы за месяц для всех квартир дома без сохранения начислений. '
+                'Результат кешируется до изменения тарифов, показаний, счетчиков или квартир дома',
+)
+class CalculatePaymentPreviewView(APIView):
+    def post(self, request):
+        serializer = CalculatorPaymentSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            preview = preview_payment(
+                serializer.validated_data['apartment_building_id'],
+                serializer.validated_data['year'],
+                serializer.validated_data['month'],
+            )
+        except Tariff.DoesNotExist as e:
+            return Response({"status": "error", "message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(preview, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    tags=['Calculator'],
+    description='Получение данных о прогрессе расчета кварплаты: количество рассчитанных квартир, время начала, '
+                'скорость расчета и оценка оставшегося времени. Передайте ID дома, для которого запущен расчет',
+    parameters=[
+        OpenApiParameter('job_id', description='ID задания расчета. По умолчанию - последнее задание для дома', required=False, type=str),
+    ]
 )
 class CalculationProgressView(APIView):
     def get(self, request, apartment_building_id, *args, **kwargs):
         if not ApartmentBuilding.objects.filter(id=apartment_building_id).exists():
             return Response({"status": "error", "message": "Apartment building with this ID does not exist."}, status=status.HTTP_404_NOT_FOUND)
         
-        progress = get_calculation_progress(apartment_building_id)
+        progress = get_calculation_progress(apartment_building_id, request.GET.get('job_id'))
         if isinstance(progress, dict) and 'status' in progress and progress['status'] == 'error':
             return Response(progress, status=status.HTTP_404_NOT_FOUND)
         
         return Response(progress, status=status.HTTP_200_OK)
+
+
+class AsyncCalculationProgressView(View):
+    """
+    Асинхронная версия CalculationProgressView для режима ASGI (ASYNC_VIEWS): проверка дома и чтение прогресса
+    из кеша не занимают поток на время запроса
+    """
+    async def get(self, request, apartment_building_id, *args, **kwargs):
+        if not await ApartmentBuilding.objects.filter(id=apartment_building_id).aexists():
+            return JsonResponse({"status": "error", "message": "Apartment building with this ID does not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+        progress = await aget_calculation_progress(apartment_building_id, request.GET.get('job_id'))
+        if progress.get('status') == 'error':
+            return JsonResponse(progress, status=status.HTTP_404_NOT_FOUND)
+
+        return JsonResponse(progress, status=status.HTTP_200_OK)
+
+
+def parse_stream_request(request):
+    """
+    ID домов (apartment_building_ids через запятую) и пакетного задания (job_id) для потока прогресса
+    или ответ с ошибкой
+    """
+    job_id = request.GET.get('job_id') or None
+    try:
+        apartment_building_ids = sorted({int(value) for value in request.GET.get('apartment_building_ids', '').split(',') if value.strip()})
+    except ValueError:
+        return None, JsonResponse({"status": "error", "message": "apartment_building_ids must be comma-separated integers."}, status=status.HTTP_400_BAD_REQUEST)
+    if not apartment_building_ids and job_id is None:
+        return None, JsonResponse({"status": "error", "message": "apartment_building_ids or job_id is required."}, status=status.HTTP_400_BAD_REQUEST)
+    return ProgressStream(apartment_building_ids, job_id), None
+
+
+def missing_buildings_response(stream: ProgressStream, existing: set):
+    missing = [apartment_building_id for apartment_building_id in stream.apartment_building_ids if apartment_building_id not in existing]
+    if not missing:
+        return None
+    return JsonResponse({"status": "error", "message": f"Apartment buildings with IDs {missing} do not exist."}, status=status.HTTP_404_NOT_FOUND)
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен буферизовать события
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class CalculationProgressStreamView(View):
+    """
+    Поток событий прогресса расчета домов и (или) пакетного задания (server-sent events) вместо опроса
+    calculate-progress: события отправляются только при изменении прогресса, дома проверяются один раз
+    при подключении. Формат событий описан в streams.py
+    """
+    def get(self, request, *args, **kwargs):
+        stream, error = parse_stream_request(request)
+        if error:
+            return error
+        existing = set(ApartmentBuilding.objects.filter(id__in=stream.apartment_building_ids).values_list('id', flat=True))
+        error = missing_buildings_response(stream, existing)
+        if error:
+            return error
+        return event_stream_response(stream_progress(stream))
+
+
+class AsyncCalculationProgressStreamView(View):
+    """
+    Асинхронная версия CalculationProgressStreamView для режима ASGI (ASYNC_VIEWS): ожидание событий
+    не занимает поток сервера
+    """
+    async def get(self, request, *args, **kwargs):
+        stream, error = parse_stream_request(request)
+        if error:
+            return error
+        existing = {
+            apartment_building_id
+            async for apartment_building_id in ApartmentBuilding.objects.filter(id__in=stream.apartment_building_ids).values_list('id', flat=True)
+        }
+        error = missing_buildings_response(stream, existing)
+        if error:
+            return error
+        return event_stream_response(astream_progress(stream))
+
+
+@extend_schema(
+    tags=['Calculator'],
+    description='Задания расчета домов со статусом, временем ожидания и расчета и количеством квартир. '
+                'Фильтры: apartment_building, year_month, status',
+)
+class CalculationJobListView(generics.ListAPIView):
+    queryset = CalculationJob.objects.order_by('-created_at')
+    serializer_class = CalculationJobSerializer
+    filterset_fields = ['apartment_building', 'year_month', 'status']
+
+
+@extend_schema(
+    tags=['Calculator'],
+    description='Состояние задания расчета по ID, полученному при запуске расчета. '
+                'Для выполняющегося расчета возвращается также текущий прогресс',
+)
+class CalculationJobDetailView(generics.RetrieveAPIView):
+    queryset = CalculationJob.objects.all()
+    serializer_class = CalculationJobSerializer
+
+
+@extend_schema(
+    tags=['Data'],
+    description='Отчет о счетчиках всех домов с истекшим или истекающим сроком поверки в порядке даты окончания поверки. '
+                f'Без expires_before выводятся счетчики, поверка которых истекла или истекает в ближайшие {EXPIRING_COUNTERS_DAYS} дней, '
+                'expires_after исключает счетчики, поверка которых истекла раньше. Например, истекающие в следующем месяце: '
+                'expires_after=2024-08-01&expires_before=2024-08-31',
+)
+class ExpiringWaterCounterListView(generics.ListAPIView):
+    serializer_class = ExpiringWaterCounterSerializer
+    filterset_class = ExpiringWaterCounterFilter
+    pagination_class = ExpiringWaterCounterPagination
+
+    def get_queryset(self):
+        queryset = WaterCounter.objects.select_related('flat__apartment_building')
+        if 'expires_before' not in self.request.query_params:
+            queryset = queryset.filter(expiration_date__lte=datetime.date.today() + datetime.timedelta(days=EXPIRING_COUNTERS_DAYS))
+        return queryset
+
+
+@extend_schema(
+    tags=['Calculator'],
+    description='Итоги начислений домов по месяцам: суммы по видам начислений и количество квартир, рассчитанных '
+                'по нормативу и по счетчикам. Итоги обновляются при записи начислений, начисления квартир не читаются. '
+                'Фильтры: apartment_building, year_month',
+)
+class BuildingMonthlySummaryListView(generics.ListAPIView):
+    queryset = BuildingMonthlySummary.objects.order_by('-year_month', 'apartment_building_id')
+    serializer_class = BuildingMonthlySummarySerializer
+    filterset_fields = ['apartment_building', 'year_month']
+
+
+@extend_schema(
+    tags=['Calculator'],
+    request=CalculatorBatchPaymentSerializer,
+    description='Пакетный расчет платы для нескольких домов или для всех домов ("all"). '
+                'Возвращает ID задания для получения прогресса расчета',
+    examples=[
+        OpenApiExample(
+            'Example Request',
+            value={
+                "apartment_building_ids": [1, 2, 3],
+                "year": "2024",
+                "month": "07"
+            }
+        )
+    ],
+)
+class CalculateBatchPaymentView(APIView):
+    def post(self, request):
+        serializer = CalculatorBatchPaymentSerializer(data=request.data)
+        if serializer.is_valid():
+            job_id = uuid.uuid4().hex
+
+            calculate_batch_payment_task.delay(
+                job_id,
+                serializer.validated_data['apartment_building_ids'],
+                serializer.validated_data['year'],
+                serializer.validated_data['month'],
+            )
+
+            return Response({"status": "success", "message": "Расчет запущен.", "job_id": job_id}, status=status.HTTP_202_ACCEPTED)
+
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@extend_schema(
+    tags=['Calculator'],
+    description='Получение данных о прогрессе пакетного расчета: общий прогресс, прогресс по каждому дому и скорость расчета. '
+                'Передайте ID задания, полученный при запуске расчета',
+)
+class BatchCalculationProgressView(APIView):
+    def get(self, request, job_id, *args, **kwargs):
+        progress = get_job_progress(job_id)
+        if progress.get('status') == 'error':
+            return Response(progress, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(progress, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    tags=['Calculator'],
+    parameters=[ChargeExportSerializer],
+    responses={(200, 'text/csv'): str, (200, 'application/x-ndjson'): str},
+    description='Потоковая выгрузка начислений по квартирам в CSV или NDJSON для списка домов или всех домов '
+                'за период. Начисления отдаются по мере чтения из бд, без загрузки выгрузки в память',
+)
+class ChargeExportView(APIView):
+
+    def get(self, request):
+        serializer = ChargeExportSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        params = serializer.validated_data
+        return export_response(export_charges, params)
+
+
+class AsyncChargeExportView(View):
+    """
+    Асинхронная версия ChargeExportView для режима ASGI (ASYNC_VIEWS): синхронный итератор выгрузки под ASGI
+    читается целиком до отправки ответа, асинхронный отдает начисления по мере чтения из бд
+    """
+    async def get(self, request, *args, **kwargs):
+        serializer = ChargeExportSerializer(data=request.GET)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return export_response(aexport_charges, serializer.validated_data)
+
+
+def export_response(export, params: dict):
+    file_format = params['file_format']
+    response = StreamingHttpResponse(
+        export(params.get('apartment_building_id'), params.get('month_from'), params.get('month_to'), file_format),
+        content_type=EXPORT_FORMATS[file_format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="charges.{file_format}"'
+    return response
+
+
+def metrics_view(request):
+    """
+    Метрики в текстовом формате Prometheus, доступны только с адресов и сетей из METRICS_ALLOWED_IPS
+    или с заголовком Authorization: Bearer {METRICS_TOKEN}
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    if not metrics_access_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
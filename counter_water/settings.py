@@ -13,9 +13,33 @@ env = environ.Env(
     DATABASE_PASSWORD=(str, 'postgres'),
     DATABASE_HOST=(str, 'db'),
     DATABASE_PORT=(str, '5432'),
+    DATABASE_CONN_MAX_AGE=(int, 60),
+    DATABASE_CONN_HEALTH_CHECKS=(bool, True),
 
     REDIS_HOST=(str, 'redis'),
     REDIS_PORT=(str, '6379'),
+
+    METER_READINGS_RETENTION=(int, 12),
+    READING_IMPORTS_DIR=(str, ''),
+    SERIAL_NUMBER_CACHE_TTL=(int, 86400),
+    CALCULATION_PREVIEW_TTL=(int, 3600),
+    CALCULATION_KERNEL=(str, 'decimal'),
+    CALCULATION_FAN_OUT=(bool, False),
+    CALCULATION_CHUNK_SIZE=(int, 1000),
+    CALCULATION_BATCH_SIZE=(int, 500),
+    CALCULATION_JOB_TIMEOUT=(int, 60 * 60),
+    CALCULATION_BATCH_CONCURRENCY=(int, 4),
+    CALCULATION_PROGRESS_TTL=(int, 24 * 60 * 60),
+    CALCULATION_PROGRESS_FINISHED_TTL=(int, 60 * 60),
+    CALCULATION_PROGRESS_STREAM_TIMEOUT=(int, 5 * 60),
+    CALCULATION_PROGRESS_STREAM_KEEPALIVE=(int, 15),
+
+    ASYNC_VIEWS=(bool, False),
+
+    METRICS_ENABLED=(bool, False),
+    METRICS_FLUSH_INTERVAL=(int, 10),
+    METRICS_ALLOWED_IPS=(list, ['127.0.0.1', '::1']),
+    METRICS_TOKEN=(str, ''),
 )
 
 
@@ -26,6 +50,12 @@ environ.Env.read_env(os.path.join(BASE_DIR, '.env'))
 
 SECRET_KEY =  env('SECRET_KEY')
 
+# асинхронные представления передачи показаний и прогресса расчета, включаются при запуске через ASGI (SERVER_MODE=asgi)
+ASYNC_VIEWS = env('ASYNC_VIEWS')
+
+# метрики запросов к API и расчета начислений (counter/metrics.py), при выключенных метриках замеры не выполняются
+METRICS_ENABLED = env('METRICS_ENABLED')
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = env('DEBUG')
 
@@ -53,6 +83,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'counter.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -92,7 +123,7 @@ CACHES = {
         'BACKEND': 'django_redis.cache.RedisCache',
         'LOCATION': f'redis://{REDIS_HOST}:{REDIS_PORT}/1',
         'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CLIENT_CLASS': 'counter.metrics.InstrumentedRedisClient' if METRICS_ENABLED else 'django_redis.client.DefaultClient',
         }
     }
 }
@@ -109,6 +140,11 @@ DATABASES = {
         'PASSWORD': env('DATABASE_PASSWORD'),
         'HOST': env('DATABASE_HOST'),
         'PORT': env('DATABASE_PORT'),
+        # соединение переиспользуется запросами и задачами Celery одного процесса в течение CONN_MAX_AGE секунд,
+        # 0 - новое соединение на каждый запрос (при ASGI соединения держит pgbouncer)
+        'CONN_MAX_AGE': env('DATABASE_CONN_MAX_AGE'),
+        # перед первым обращением в запросе или задаче соединение проверяется и при разрыве открывается заново
+        'CONN_HEALTH_CHECKS': env('DATABASE_CONN_HEALTH_CHECKS'),
     }
 }
 
@@ -175,3 +211,70 @@ SPECTACULAR_SETTINGS = {
 
 CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}'
 CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}'
+
+# расчет дома частями по CALCULATION_CHUNK_SIZE квартир в параллельных задачах
+CALCULATION_FAN_OUT = env('CALCULATION_FAN_OUT')
+CALCULATION_CHUNK_SIZE = env('CALCULATION_CHUNK_SIZE')
+# количество квартир, начисления которых записываются в бд одной транзакцией вместе с контрольной точкой расчета
+CALCULATION_BATCH_SIZE = env('CALCULATION_BATCH_SIZE')
+# 'numpy' - расчет векторным ядром в целых числах (нужен пакет numpy), 'decimal' - расчет по квартирам в Decimal
+CALCULATION_KERNEL = env('CALCULATION_KERNEL')
+
+# время, после которого незавершенное задание расчета дома считается прерванным и не мешает запуску нового, в секундах
+CALCULATION_JOB_TIMEOUT = env('CALCULATION_JOB_TIMEOUT')
+
+# максимальное количество домов, которые рассчитываются одновременно при пакетном расчете
+CALCULATION_BATCH_CONCURRENCY = env('CALCULATION_BATCH_CONCURRENCY')
+
+# время хранения прогресса расчета: во время расчета и после его окончания, в секундах
+CALCULATION_PROGRESS_TTL = env('CALCULATION_PROGRESS_TTL')
+CALCULATION_PROGRESS_FINISHED_TTL = env('CALCULATION_PROGRESS_FINISHED_TTL')
+
+# время, через которое сервер закрывает поток событий прогресса (клиент переподключается),
+# и интервал комментариев, не дающих прокси закрыть поток без событий, в секундах
+CALCULATION_PROGRESS_STREAM_TIMEOUT = env('CALCULATION_PROGRESS_STREAM_TIMEOUT')
+CALCULATION_PROGRESS_STREAM_KEEPALIVE = env('CALCULATION_PROGRESS_STREAM_KEEPALIVE')
+
+
+# Counter
+
+# сколько последних показаний каждого счетчика хранится после очистки командой prune_meter_readings
+METER_READINGS_RETENTION = env('METER_READINGS_RETENTION')
+
+# каталог для загруженных файлов показаний, должен быть доступен и веб-приложению, и воркерам Celery
+READING_IMPORTS_DIR = env('READING_IMPORTS_DIR') or os.path.join(BASE_DIR, 'imports')
+
+# время хранения в кеше данных счетчика, найденного по серийному номеру
+SERIAL_NUMBER_CACHE_TTL = env('SERIAL_NUMBER_CACHE_TTL')
+
+# время хранения в кеше результата предварительного расчета
+CALCULATION_PREVIEW_TTL = env('CALCULATION_PREVIEW_TTL')
+
+
+# Metrics
+
+# интервал записи метрик процесса в кеш, в секундах
+METRICS_FLUSH_INTERVAL = env('METRICS_FLUSH_INTERVAL')
+# адреса и сети (CIDR), с которых доступен эндпоинт /metrics
+METRICS_ALLOWED_IPS = env('METRICS_ALLOWED_IPS')
+# токен доступа к /metrics с любого адреса (заголовок Authorization: Bearer), пустой - доступ только по адресам
+METRICS_TOKEN = env('METRICS_TOKEN')
+
+# запросы и расчеты пишутся в лог counter.metrics строками JSON
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'metrics': {'class': 'logging.StreamHandler', 'formatter': 'message'},
+    },
+    'loggers': {
+        'counter.metrics': {
+            'handlers': ['metrics'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -4,4 +4,6 @@ python manage.py loaddatautf8 counter/fixtures/flats.json
 
 python manage.py loaddatautf8 counter/fixtures/watercounters.json
 
+python manage.py loaddatautf8 counter/fixtures/meterreadings.json
+
 python manage.py loaddatautf8 counter/fixtures/tariffs.json
\ No newline at end of file
@@ -14,4 +14,15 @@ python manage.py migrate counter
 
 echo "from django.contrib.auth import get_user_model; User = get_user_model(); User.objects.create_superuser('admin', 'admin@myproject.com', 'password')" | python manage.py shell
 
+# SERVER_MODE=asgi - рабочий режим: gunicorn с воркерами uvicorn и асинхронными представлениями (ASYNC_VIEWS=true):
+# синхронные потоковые ответы (выгрузка, поток прогресса) под ASGI буферизуются целиком, поэтому ASYNC_VIEWS
+# включается здесь. При ASGI запросы выполняются в разных потоках, постоянные соединения отключены,
+# их переиспользует pgbouncer
+if [ "$SERVER_MODE" = "asgi" ]; then
+  exec env DATABASE_CONN_MAX_AGE=0 ASYNC_VIEWS=true gunicorn counter_water.asgi:application \
+    --worker-class uvicorn_worker.UvicornWorker \
+    --workers "${WEB_CONCURRENCY:-4}" \
+    --bind 0.0.0.0:8000
+fi
+
 exec python manage.py runserver 0.0.0.0:8000
\ No newline at end of file